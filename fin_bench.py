@@ -0,0 +1,329 @@
+"""
+Нагрузочные замеры FinanceApp на синтетических данных.
+
+    python fin_bench.py --operations 100000 --output bench.json
+    python fin_bench.py --db-url postgresql://localhost/fin_bench --operations 1000000
+    python fin_bench.py --operations 100000 --compare bench.json
+
+Генерирует справочники и операции в локальную SQLite (по умолчанию во временный файл)
+или PostgreSQL, затем замеряет импорт, выборки операций, страницы журнала и расчёт
+данных каждой панели дашборда (без отрисовки Streamlit). Результат — JSON с задержками
+(p50/p90/p99), пропускной способностью и пиковой памятью для сравнения версий.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import create_engine, text
+
+# Кэш запросов искажает замеры — по умолчанию отключаем (см. --with-cache)
+if "--with-cache" not in sys.argv:
+    os.environ["QUERY_CACHE_TTL"] = "0"
+
+import fin_dash  # noqa: E402
+
+
+# === Генерация данных ===
+
+def _insert_level(conn, table, id_col, rows, name_col='name', parent_col=None):
+    """Вставляет строки справочника и возвращает их id в порядке вставки"""
+    cols = list(rows[0])
+    conn.execute(
+        text(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})"),
+        rows
+    )
+    select_cols = f"{id_col}, {name_col}, {parent_col or 'NULL'}"
+    found = {(r[1], r[2]): r[0] for r in conn.execute(text(f"SELECT {select_cols} FROM {table}"))}
+    return [found[(r[name_col], r.get(parent_col))] for r in rows]
+
+
+def generate_dimensions(engine, args):
+    """Дерево справочников с заданным ветвлением; возвращает массивы id по уровням"""
+    with engine.begin() as conn:
+        # Типы операций создаёт первая миграция
+        found = dict(conn.execute(text("SELECT name_operation, id_operation FROM operation_types")).all())
+        types = [found[name] for name in fin_dash.OPERATION_TYPES]
+        categories = _insert_level(conn, 'categories', 'id_categories', [
+            {'name': f"{name} {i}", 'operation_type_id': type_id}
+            for type_id, name in zip(types, fin_dash.OPERATION_TYPES)
+            for i in range(args.categories)
+        ])
+        subcategories = _insert_level(conn, 'subcategories', 'id_subcategories', [
+            {'name': f"Подкатегория {i}", 'category_id': parent}
+            for parent in categories for i in range(args.subcategories)
+        ], parent_col='category_id')
+        groups = _insert_level(conn, 'groups', 'id_groups', [
+            {'name': f"Группа {i}", 'subcategory_id': parent}
+            for parent in subcategories for i in range(args.groups)
+        ], parent_col='subcategory_id')
+        subgroups = _insert_level(conn, 'subgroups', 'id_subgroups', [
+            {'name': f"Подгруппа {i}", 'group_id': parent}
+            for parent in groups for i in range(args.subgroups)
+        ], parent_col='group_id')
+        lesson_types = _insert_level(conn, 'lesson_types', 'id_lesson_type', [
+            {'name': f"Тип занятия {i}"} for i in range(args.lesson_types)
+        ])
+    return {
+        'types': np.array(types),
+        'categories': np.array(categories).reshape(len(types), args.categories),
+        'subcategories': np.array(subcategories).reshape(len(categories), args.subcategories),
+        'groups': np.array(groups).reshape(len(subcategories), args.groups),
+        'subgroups': np.array(subgroups).reshape(len(groups), args.subgroups),
+        'lesson_types': np.array(lesson_types),
+    }
+
+
+def generate_operations(rng, dims, n, start, days):
+    """DataFrame операций в формате OPERATION_COLUMNS со случайным путём по дереву справочников"""
+    type_idx = (rng.random(n) < 0.6).astype(np.int64)  # 0 — доход, 1 — расход
+    cat_local = rng.integers(0, dims['categories'].shape[1], n)
+    cat_idx = type_idx * dims['categories'].shape[1] + cat_local
+    sub_idx = cat_idx * dims['subcategories'].shape[1] + rng.integers(0, dims['subcategories'].shape[1], n)
+    group_idx = sub_idx * dims['groups'].shape[1] + rng.integers(0, dims['groups'].shape[1], n)
+    subgroup_idx = group_idx * dims['subgroups'].shape[1] + rng.integers(0, dims['subgroups'].shape[1], n)
+
+    has_sub = rng.random(n) < 0.85
+    has_group = has_sub & (rng.random(n) < 0.6)
+    has_subgroup = has_group & (rng.random(n) < 0.5)
+    has_lesson = (type_idx == 0) & (rng.random(n) < 0.4) & (len(dims['lesson_types']) > 0)
+
+    def optional(mask, values):
+        return pd.Series(np.where(mask, values, 0), dtype="Int64").mask(~mask)
+
+    dates = pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n), unit='D')
+    return pd.DataFrame({
+        'operation_date': dates.strftime('%Y-%m-%d'),
+        'operation_type_id': dims['types'][type_idx],
+        'amount': np.round(rng.lognormal(7.5, 1.0, n), 2),
+        'category_id': dims['categories'].ravel()[cat_idx],
+        'subcategory_id': optional(has_sub, dims['subcategories'].ravel()[sub_idx]),
+        'group_id': optional(has_group, dims['groups'].ravel()[group_idx]),
+        'subgroup_id': optional(has_subgroup, dims['subgroups'].ravel()[subgroup_idx]),
+        'lesson_type_id': optional(
+            has_lesson,
+            dims['lesson_types'][rng.integers(0, max(len(dims['lesson_types']), 1), n)]
+            if len(dims['lesson_types']) else np.zeros(n, dtype=np.int64)
+        ),
+    })
+
+
+def excel_frame(app, frame):
+    """Переводит сгенерированные операции в формат Excel-файла импорта (имена вместо id)"""
+    result = pd.DataFrame({'Дата': frame['operation_date'], 'Сумма': frame['amount']})
+    excel_names = {v: k for k, v in fin_dash.IMPORT_COLUMNS.items()}
+    for column, table in fin_dash.OPERATION_DIMENSION_COLUMNS.items():
+        names = app.dimensions.names(table)
+        result[excel_names[fin_dash.OPERATION_NAME_COLUMNS[column]]] = frame[column].map(names)
+    return result[list(fin_dash.IMPORT_COLUMNS)]
+
+
+def populate(engine, args):
+    fin_dash.migrate(engine)
+    with engine.connect() as conn:
+        existing = conn.execute(text("SELECT COUNT(*) FROM financial_operations")).scalar()
+    if existing and not args.append:
+        raise SystemExit(
+            f"В базе уже {existing} операций. Используйте пустую базу или --append."
+        )
+
+    rng = np.random.default_rng(args.seed)
+    dims = generate_dimensions(engine, args)
+    start = date.today() - timedelta(days=args.days)
+
+    started = time.perf_counter()
+    for offset in range(0, args.operations, args.chunk):
+        chunk = generate_operations(rng, dims, min(args.chunk, args.operations - offset), start, args.days)
+        with engine.begin() as conn:
+            fin_dash._insert_operations(conn, chunk)
+    return dims, start, time.perf_counter() - started
+
+
+# === Замеры ===
+
+def _rows(result):
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, tuple):
+        return sum(_rows(r) for r in result)
+    if isinstance(result, dict):
+        return sum(_rows(r) for r in result.values())
+    return 0
+
+
+def measure(fn, repeat, warmup=1):
+    """Задержки (мс), число строк результата и пиковая память (отдельный прогон под tracemalloc)"""
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    rows = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = _rows(fn())
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lat = np.array(latencies)
+    p50 = float(np.percentile(lat, 50))
+    return {
+        "rows": rows,
+        "repeat": repeat,
+        "p50_ms": p50,
+        "p90_ms": float(np.percentile(lat, 90)),
+        "p99_ms": float(np.percentile(lat, 99)),
+        "mean_ms": float(lat.mean()),
+        "min_ms": float(lat.min()),
+        "max_ms": float(lat.max()),
+        "rows_per_sec": rows / (p50 / 1000) if p50 else None,
+        "peak_mb": peak / 1024 / 1024,
+    }
+
+
+def cases(app, args, dims, start):
+    """Сценарии замеров: имя -> функция без аргументов"""
+    end = date.today()
+    full = (start.isoformat(), end.isoformat())
+    month = ((end - timedelta(days=30)).isoformat(), end.isoformat())
+
+    expense_categories = [app.dimensions.names('categories')[int(c)] for c in dims['categories'][1][:2]]
+    with app.get_connection() as conn:
+        middle = conn.execute(text(
+            "SELECT operation_date, id FROM financial_operations ORDER BY operation_date DESC, id DESC "
+            "LIMIT 1 OFFSET :offset"), {"offset": args.operations // 2}).first()
+
+    result = {
+        "get_operations[full]": lambda: app.get_operations(*full),
+        "get_operations[month]": lambda: app.get_operations(*month),
+        "get_operations_frame[full]": lambda: app.get_operations_frame(*full),
+        "journal_summary[filtered]": lambda: fin_dash.load_journal_summary(
+            app, *full, operation_types=['расход'], categories=expense_categories,
+            min_amount=100.0, max_amount=10000.0),
+        "journal[first_page]": lambda: app.get_journal_page(*full, limit=100),
+        "journal[filtered]": lambda: app.get_journal_page(
+            *full, operation_types=['расход'], categories=expense_categories,
+            min_amount=100.0, max_amount=10000.0, limit=100),
+    }
+    if middle is not None:
+        key = (str(middle[0]), int(middle[1]))
+        result["journal[deep_page]"] = lambda: app.get_journal_page(*full, limit=100, after=key)
+    for name, loader in fin_dash.DASHBOARD_PANELS.items():
+        result[f"panel[{name}][full]"] = lambda loader=loader: loader(app, *full)
+        result[f"panel[{name}][month]"] = lambda loader=loader: loader(app, *month)
+    result["reports[month][full]"] = lambda: fin_dash.build_reports(app, *full, period='month')
+    return result
+
+
+def bench_import(app, rng, dims, start, args):
+    """Импорт DataFrame в формате Excel через import_excel_to_db (каждый прогон — новые строки)"""
+    frames = iter([
+        excel_frame(app, generate_operations(rng, dims, args.import_rows, start, args.days))
+        for _ in range(args.repeat + 1)
+    ])
+    return measure(lambda: fin_dash.import_excel_to_db(app, next(frames)), args.repeat, warmup=0)
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline_path):
+    """Печатает отношение p50 текущего прогона к базовому"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    print(f"{'сценарий':<36} {'база p50':>10} {'сейчас p50':>11} {'отношение':>10}", file=sys.stderr)
+    for name, res in current["results"].items():
+        if name in baseline and baseline[name]["p50_ms"]:
+            ratio = res["p50_ms"] / baseline[name]["p50_ms"]
+            flag = "  ⚠️" if ratio > 1.2 else ""
+            print(f"{name:<36} {baseline[name]['p50_ms']:>10.1f} {res['p50_ms']:>11.1f} {ratio:>10.2f}{flag}",
+                  file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности FinanceApp")
+    parser.add_argument("--db-url", help="локальная БД (по умолчанию временный файл SQLite)")
+    parser.add_argument("--operations", type=int, default=10_000, help="число операций (10k..10M)")
+    parser.add_argument("--days", type=int, default=3 * 365, help="глубина истории в днях")
+    parser.add_argument("--categories", type=int, default=6, help="категорий на тип операции")
+    parser.add_argument("--subcategories", type=int, default=5, help="подкатегорий на категорию")
+    parser.add_argument("--groups", type=int, default=4, help="групп на подкатегорию")
+    parser.add_argument("--subgroups", type=int, default=3, help="подгрупп на группу")
+    parser.add_argument("--lesson-types", type=int, default=5, help="типов занятий")
+    parser.add_argument("--import-rows", type=int, default=10_000, help="строк в одном замере импорта")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов каждого замера")
+    parser.add_argument("--chunk", type=int, default=200_000, help="размер пакета при генерации")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--append", action="store_true", help="разрешить непустую базу")
+    parser.add_argument("--with-cache", action="store_true", help="не отключать кэш запросов")
+    parser.add_argument("--output", help="файл для JSON (по умолчанию stdout)")
+    parser.add_argument("--compare", help="JSON предыдущего прогона для сравнения")
+    args = parser.parse_args(argv)
+
+    db_url = args.db_url or f"sqlite:///{tempfile.mkdtemp(prefix='fin_bench_')}/fin_bench.db"
+    engine = create_engine(db_url)
+    dims, start, generate_sec = populate(engine, args)
+    engine.dispose()
+
+    app = fin_dash.FinanceApp(db_url)
+    # Справочники и операции вставлены в обход приложения — пересчитываем дерево и агрегаты целиком
+    app.rebuild_dimension_tree()
+    app.rebuild_daily_rollup()
+    results = {"import_excel_to_db": bench_import(app, np.random.default_rng(args.seed + 1), dims, start, args)}
+    for name, fn in cases(app, args, dims, start).items():
+        results[name] = measure(fn, args.repeat)
+        print(f"{name:<36} p50 {results[name]['p50_ms']:9.1f} мс", file=sys.stderr)
+
+    report = {
+        "meta": {
+            "revision": _git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "dialect": app.engine.dialect.name,
+            "operations": args.operations,
+            "fan_out": {
+                "categories": args.categories, "subcategories": args.subcategories,
+                "groups": args.groups, "subgroups": args.subgroups, "lesson_types": args.lesson_types,
+            },
+            "days": args.days,
+            "generate_sec": generate_sec,
+            "query_cache": args.with_cache,
+        },
+        "results": results,
+    }
+
+    payload = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload)
+    else:
+        print(payload)
+    if args.compare:
+        compare(report, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
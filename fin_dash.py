@@ -1,399 +1,4072 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import bindparam, create_engine, event, text
+from sqlalchemy import inspect as inspect_db
+from sqlalchemy.engine import make_url
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import contextvars
+import copy
+import csv
+import functools
+import hashlib
+import inspect
+import io
+import json
+import logging
+import multiprocessing
 import os
+import re
+import shutil
+import tempfile
+import numpy as np
 import pandas as pd
-import streamlit as st
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import calendar
-import plotly.express as px
+import codecs
+import operator
+import threading
+import time
+from openpyxl import Workbook, load_workbook
+
+try:
+    import plotly.express as px
+    import streamlit as st
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+except ImportError:
+    # Без Streamlit и plotly модуль служит пакетным отчётам и fin_manage; дашборд их требует
+    px = st = None
+
+# === Схема БД: версионные миграции ===
+
+# Подстановки в DDL по диалекту
+SCHEMA_TYPES = {
+    'sqlite': {'pk': 'INTEGER PRIMARY KEY AUTOINCREMENT'},
+    'postgresql': {'pk': 'SERIAL PRIMARY KEY'},
+}
+
+SCHEMA_MIGRATIONS_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR(200) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+ROLLUP_DDL = """
+    CREATE TABLE IF NOT EXISTS operations_daily_rollup (
+        operation_date DATE NOT NULL,
+        operation_type_id INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        subcategory_id INTEGER NOT NULL DEFAULT 0,
+        group_id INTEGER NOT NULL DEFAULT 0,
+        subgroup_id INTEGER NOT NULL DEFAULT 0,
+        lesson_type_id INTEGER NOT NULL DEFAULT 0,
+        total DECIMAL(15, 2) NOT NULL,
+        operations_count INTEGER NOT NULL,
+        PRIMARY KEY (operation_date, operation_type_id, category_id,
+                     subcategory_id, group_id, subgroup_id, lesson_type_id)
+    )
+"""
+
+
+def _add_lesson_type_column(conn):
+    """В ранних базах financial_operations создавалась без lesson_type_id"""
+    columns = {col['name'] for col in inspect_db(conn).get_columns('financial_operations')}
+    if 'lesson_type_id' not in columns:
+        conn.execute(text(
+            "ALTER TABLE financial_operations "
+            "ADD COLUMN lesson_type_id INTEGER REFERENCES lesson_types(id_lesson_type)"
+        ))
+
+
+def _fill_daily_rollup(conn):
+    """Заполняет пустую таблицу дневных агрегатов по всем операциям"""
+    if conn.execute(text("SELECT 1 FROM operations_daily_rollup LIMIT 1")).first() is None:
+        conn.execute(text(f"""
+            INSERT INTO operations_daily_rollup ({', '.join(ROLLUP_KEYS)}, total, operations_count)
+            SELECT {ROLLUP_SOURCE_KEYS}, SUM(amount), COUNT(*)
+            FROM financial_operations
+            GROUP BY {ROLLUP_SOURCE_KEYS}
+        """))
+
+
+# Фоновые задачи импорта: исходные файлы, контрольная точка (лист, записанных порций листа),
+# счётчики и отметка жизни (heartbeat_at) для возобновления после падения процесса
+IMPORT_JOBS_DDL = """
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        id {pk},
+        status VARCHAR(10) NOT NULL DEFAULT 'queued'
+            CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        sources TEXT NOT NULL,
+        dry_run BOOLEAN NOT NULL DEFAULT FALSE,
+        chunk_size INTEGER NOT NULL,
+        rows_total INTEGER,
+        rows_done INTEGER NOT NULL DEFAULT 0,
+        resumed_rows INTEGER NOT NULL DEFAULT 0,
+        new_rows INTEGER NOT NULL DEFAULT 0,
+        duplicates INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        sheets INTEGER NOT NULL DEFAULT 0,
+        checkpoint_unit INTEGER NOT NULL DEFAULT 0,
+        checkpoint_chunk INTEGER NOT NULL DEFAULT 0,
+        messages TEXT,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at TIMESTAMP,
+        heartbeat_at TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+"""
+
+
+# Дерево справочников: по строке на узел (категория, подкатегория, группа, подгруппа)
+# с id и именами всех предков; у отсутствующих уровней id = 0, как в дневных агрегатах
+DIMENSION_TREE_DDL = """
+    CREATE TABLE IF NOT EXISTS dimension_tree (
+        category_id INTEGER NOT NULL,
+        subcategory_id INTEGER NOT NULL DEFAULT 0,
+        group_id INTEGER NOT NULL DEFAULT 0,
+        subgroup_id INTEGER NOT NULL DEFAULT 0,
+        level INTEGER NOT NULL,
+        operation_type_id INTEGER NOT NULL,
+        category VARCHAR(100) NOT NULL,
+        subcategory VARCHAR(100),
+        group_name VARCHAR(100),
+        subgroup VARCHAR(100),
+        path TEXT NOT NULL,
+        PRIMARY KEY (category_id, subcategory_id, group_id, subgroup_id)
+    )
+"""
+
+DIMENSION_TREE_SOURCE = """
+    SELECT c.id_categories, 0, 0, 0, 1, c.operation_type_id,
+           c.name, NULL, NULL, NULL, c.name
+    FROM categories c
+    UNION ALL
+    SELECT c.id_categories, s.id_subcategories, 0, 0, 2, c.operation_type_id,
+           c.name, s.name, NULL, NULL, c.name || ' / ' || s.name
+    FROM subcategories s
+    JOIN categories c ON s.category_id = c.id_categories
+    UNION ALL
+    SELECT c.id_categories, s.id_subcategories, g.id_groups, 0, 3, c.operation_type_id,
+           c.name, s.name, g.name, NULL, c.name || ' / ' || s.name || ' / ' || g.name
+    FROM groups g
+    JOIN subcategories s ON g.subcategory_id = s.id_subcategories
+    JOIN categories c ON s.category_id = c.id_categories
+    UNION ALL
+    SELECT c.id_categories, s.id_subcategories, g.id_groups, sg.id_subgroups, 4, c.operation_type_id,
+           c.name, s.name, g.name, sg.name, c.name || ' / ' || s.name || ' / ' || g.name || ' / ' || sg.name
+    FROM subgroups sg
+    JOIN groups g ON sg.group_id = g.id_groups
+    JOIN subcategories s ON g.subcategory_id = s.id_subcategories
+    JOIN categories c ON s.category_id = c.id_categories
+"""
+
+
+def _refresh_dimension_tree(conn):
+    """
+    Пересобирает дерево справочников целиком: справочники малы, а пересборка идёт в той же
+    транзакции, что и их изменение (импорт), поэтому дерево не расходится со справочниками.
+    """
+    conn.execute(text("DELETE FROM dimension_tree"))
+    return conn.execute(text(f"""
+        INSERT INTO dimension_tree (category_id, subcategory_id, group_id, subgroup_id, level,
+                                    operation_type_id, category, subcategory, group_name, subgroup, path)
+        {DIMENSION_TREE_SOURCE}
+    """)).rowcount
+
+
+# Триггер updated_at в SQLite (в PostgreSQL — функция set_updated_at, см. миграцию 2)
+UPDATED_AT_TRIGGER_SQLITE = """
+    CREATE TRIGGER IF NOT EXISTS update_operations_timestamp
+    AFTER UPDATE ON financial_operations
+    FOR EACH ROW
+    BEGIN
+        UPDATE financial_operations SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
+    END
+"""
+
+
+@contextmanager
+def _updated_at_trigger_disabled(conn):
+    """Служебные обновления операций без сдвига updated_at (внутри транзакции миграции)"""
+    # При исключении транзакция откатывается вместе с отключением триггера
+    if _is_postgres(conn):
+        conn.execute(text("ALTER TABLE financial_operations DISABLE TRIGGER update_operations_timestamp"))
+        yield
+        conn.execute(text("ALTER TABLE financial_operations ENABLE TRIGGER update_operations_timestamp"))
+    else:
+        conn.execute(text("DROP TRIGGER IF EXISTS update_operations_timestamp"))
+        yield
+        conn.execute(text(UPDATED_AT_TRIGGER_SQLITE))
+
+
+def _add_fingerprint_column(conn):
+    """Отпечаток строки импорта (см. _fingerprints)"""
+    columns = {col['name'] for col in inspect_db(conn).get_columns('financial_operations')}
+    if 'fingerprint' not in columns:
+        conn.execute(text("ALTER TABLE financial_operations ADD COLUMN fingerprint VARCHAR(32)"))
+
+
+def _fill_fingerprints(conn):
+    """
+    Проставляет отпечатки уже загруженным операциям. Одинаковые строки нумеруются по id,
+    поэтому прежние дубли получают разные отпечатки и уникальный индекс строится без ошибок.
+    """
+    operations = pd.read_sql(text(JOURNAL_QUERY + " WHERE f.fingerprint IS NULL ORDER BY f.id"), conn)
+    if operations.empty:
+        return
+    operations['operation_date'] = operations['operation_date'].astype(str).str[:10]
+    updates = pd.DataFrame({'id': operations['id'], 'fingerprint': _fingerprints(operations)})
+    with _updated_at_trigger_disabled(conn):
+        if _is_postgres(conn):
+            conn.execute(text(
+                "CREATE TEMP TABLE fingerprint_fill (id INTEGER, fingerprint VARCHAR(32)) ON COMMIT DROP"
+            ))
+            _copy_frame(conn, 'fingerprint_fill', updates)
+            conn.execute(text(
+                "UPDATE financial_operations f SET fingerprint = u.fingerprint "
+                "FROM fingerprint_fill u WHERE f.id = u.id"
+            ))
+        else:
+            conn.execute(
+                text("UPDATE financial_operations SET fingerprint = :fingerprint WHERE id = :id"),
+                updates.to_dict('records')
+            )
+
+
+# (версия, название, шаги). Шаг — DDL-строка (с подстановками SCHEMA_TYPES),
+# словарь диалект -> DDL или функция(conn). Шаги идемпотентны: базы, созданные
+# до появления миграций, проходят их без изменений уже существующих объектов.
+MIGRATIONS = [
+    (1, "Справочники и операции", [
+        """CREATE TABLE IF NOT EXISTS operation_types (
+            id_operation {pk},
+            name_operation VARCHAR(10) NOT NULL UNIQUE CHECK (name_operation IN ('доход', 'расход')),
+            description TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS categories (
+            id_categories {pk},
+            operation_type_id INTEGER NOT NULL REFERENCES operation_types(id_operation) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            description TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS subcategories (
+            id_subcategories {pk},
+            category_id INTEGER NOT NULL REFERENCES categories(id_categories) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            description TEXT,
+            UNIQUE (category_id, name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS groups (
+            id_groups {pk},
+            subcategory_id INTEGER NOT NULL REFERENCES subcategories(id_subcategories) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            description TEXT,
+            UNIQUE (subcategory_id, name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS subgroups (
+            id_subgroups {pk},
+            group_id INTEGER NOT NULL REFERENCES groups(id_groups) ON DELETE CASCADE,
+            name VARCHAR(100) NOT NULL,
+            description TEXT,
+            UNIQUE (group_id, name)
+        )""",
+        """CREATE TABLE IF NOT EXISTS lesson_types (
+            id_lesson_type {pk},
+            name VARCHAR(100) NOT NULL UNIQUE
+        )""",
+        """CREATE TABLE IF NOT EXISTS financial_operations (
+            id {pk},
+            operation_date DATE NOT NULL,
+            operation_type_id INTEGER NOT NULL REFERENCES operation_types(id_operation),
+            amount DECIMAL(15, 2) NOT NULL CHECK (amount >= 0),
+            category_id INTEGER NOT NULL REFERENCES categories(id_categories),
+            subcategory_id INTEGER REFERENCES subcategories(id_subcategories),
+            group_id INTEGER REFERENCES groups(id_groups),
+            subgroup_id INTEGER REFERENCES subgroups(id_subgroups),
+            comment TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            lesson_type_id INTEGER REFERENCES lesson_types(id_lesson_type)
+        )""",
+        _add_lesson_type_column,
+        """INSERT INTO operation_types (name_operation) VALUES ('доход'), ('расход')
+           ON CONFLICT (name_operation) DO NOTHING""",
+    ]),
+    (2, "Обновление updated_at", [{
+        'sqlite': UPDATED_AT_TRIGGER_SQLITE,
+        'postgresql': [
+            """CREATE OR REPLACE FUNCTION set_updated_at() RETURNS trigger AS $$
+               BEGIN
+                   NEW.updated_at = CURRENT_TIMESTAMP;
+                   RETURN NEW;
+               END;
+               $$ LANGUAGE plpgsql""",
+            "DROP TRIGGER IF EXISTS update_operations_timestamp ON financial_operations",
+            """CREATE TRIGGER update_operations_timestamp
+               BEFORE UPDATE ON financial_operations
+               FOR EACH ROW EXECUTE FUNCTION set_updated_at()""",
+        ],
+    }]),
+    (3, "Индексы журнала и внешних ключей", [
+        # Журнал и выборки за период: BETWEEN по дате и keyset-пагинация по (дата, id)
+        "CREATE INDEX IF NOT EXISTS ix_operations_date_id ON financial_operations (operation_date, id)",
+        # Фильтр журнала по типу операции за период
+        "CREATE INDEX IF NOT EXISTS ix_operations_type_date ON financial_operations (operation_type_id, operation_date)",
+        "CREATE INDEX IF NOT EXISTS ix_operations_category ON financial_operations (category_id)",
+        "CREATE INDEX IF NOT EXISTS ix_operations_subcategory ON financial_operations (subcategory_id)",
+        "CREATE INDEX IF NOT EXISTS ix_operations_group ON financial_operations (group_id)",
+        "CREATE INDEX IF NOT EXISTS ix_operations_subgroup ON financial_operations (subgroup_id)",
+        "CREATE INDEX IF NOT EXISTS ix_operations_lesson_type ON financial_operations (lesson_type_id)",
+        # У subcategories/groups/subgroups родитель — первая колонка UNIQUE, отдельный индекс не нужен
+        "CREATE INDEX IF NOT EXISTS ix_categories_operation_type ON categories (operation_type_id)",
+    ]),
+    (4, "Дневные агрегаты", [
+        ROLLUP_DDL,
+        _fill_daily_rollup,
+    ]),
+    (5, "Отпечатки строк импорта", [
+        _add_fingerprint_column,
+        _fill_fingerprints,
+        # Повторная загрузка файла отсекается вставкой с ON CONFLICT DO NOTHING по этому индексу
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_operations_fingerprint ON financial_operations (fingerprint)",
+    ]),
+    (6, "Дерево справочников", [
+        DIMENSION_TREE_DDL,
+        _refresh_dimension_tree,
+    ]),
+    (7, "Фоновые задачи импорта", [
+        IMPORT_JOBS_DDL,
+        "CREATE INDEX IF NOT EXISTS ix_import_jobs_status ON import_jobs (status)",
+    ]),
+    (8, "Индекс водяного знака updated_at", [
+        # MAX(updated_at) и выборка изменённых строк при сверке резидентных окон операций
+        "CREATE INDEX IF NOT EXISTS ix_operations_updated_at ON financial_operations (updated_at)",
+    ]),
+]
+
+# Ключ pg_advisory_xact_lock: миграции из нескольких процессов выполняются по очереди
+MIGRATION_LOCK_KEY = 7_140_2025
+
+
+def _run_step(conn, step):
+    dialect = conn.dialect.name
+    if callable(step):
+        step(conn)
+    elif isinstance(step, dict):
+        statements = step.get(dialect, [])
+        for statement in [statements] if isinstance(statements, str) else statements:
+            _run_step(conn, statement)
+    else:
+        conn.execute(text(step.format(**SCHEMA_TYPES[dialect])))
+
+
+def migrate(engine, target=None):
+    """
+    Применяет недостающие миграции MIGRATIONS (до версии target включительно).
+    Каждая миграция выполняется в своей транзакции и записывается в schema_migrations.
+    Возвращает список применённых (версия, название).
+    """
+    with engine.begin() as conn:
+        conn.execute(text(SCHEMA_MIGRATIONS_DDL))
+
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            done = conn.execute(
+                text("SELECT 1 FROM schema_migrations WHERE version = :version"), {"version": version}
+            ).first()
+            if done:
+                continue
+            for step in steps:
+                _run_step(conn, step)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": version, "name": name}
+            )
+        applied.append((version, name))
+    return applied
+
+
+def migration_status(engine):
+    """Все миграции и время их применения (None — ещё не применена)"""
+    with engine.connect() as conn:
+        if inspect_db(conn).has_table('schema_migrations'):
+            applied = dict(conn.execute(text("SELECT version, applied_at FROM schema_migrations")).all())
+        else:
+            applied = {}
+    return pd.DataFrame(
+        [(version, name, applied.get(version)) for version, name, _ in MIGRATIONS],
+        columns=['version', 'name', 'applied_at']
+    )
+
+
+def _engine_options(db_url):
+    """
+    Параметры create_engine: пул настраивается через DB_POOL_* (st.secrets или окружение).
+    sslmode PostgreSQL — из DB_SSLMODE (по умолчанию require, для Supabase; пустое значение —
+    не передавать); sslmode, заданный в самом DB_URL, имеет приоритет.
+    """
+    options = {
+        "pool_pre_ping": str(get_setting("DB_POOL_PRE_PING", "true")).lower() in ("1", "true", "yes"),
+    }
+    if db_url.startswith("postgres"):
+        sslmode = get_setting("DB_SSLMODE", "require")
+        if sslmode and "sslmode" not in make_url(db_url).query:
+            options["connect_args"] = {"sslmode": sslmode}
+        options.update(
+            pool_size=int(get_setting("DB_POOL_SIZE", 5)),
+            max_overflow=int(get_setting("DB_MAX_OVERFLOW", 10)),
+            pool_recycle=int(get_setting("DB_POOL_RECYCLE", 1800)),
+            pool_timeout=float(get_setting("DB_POOL_TIMEOUT", 30)),
+        )
+    return options
+
+
+class PooledEngine:
+    """
+    Долгоживущий движок SQLAlchemy для одного DB_URL, общий для всех сессий.
+    Считает выдачи соединений из пула, открытия новых соединений и время ожидания выдачи;
+    кэширует результат проверки доступности БД на DB_HEALTH_TTL секунд.
+    """
+
+    def __init__(self, db_url):
+        self.engine = create_engine(db_url, **_engine_options(db_url))
+        self.health_ttl = float(get_setting("DB_HEALTH_TTL", 30))
+        self._lock = threading.Lock()
+        self._health = None  # (проверено в, ok, текст)
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        event.listen(self.engine, "connect", self._on_connect)
+        event.listen(self.engine, "invalidate", self._on_invalidate)
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+    # Начало запроса хранится в его контексте выполнения: у упавшего запроса
+    # after_cursor_execute не вызывается, и метка пропадает вместе с контекстом
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "query_started", None)
+        recorder = _perf_var().get()
+        if recorder is not None and started is not None:
+            recorder.add_query(time.perf_counter() - started)
+
+    def connect(self):
+        """Выдаёт соединение из пула, замеряя время ожидания"""
+        started = time.perf_counter()
+        conn = self.engine.connect()
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return conn
+
+    @contextmanager
+    def begin(self):
+        """Соединение с транзакцией: коммит при выходе, откат при исключении"""
+        with self.connect() as conn, conn.begin():
+            yield conn
+
+    def health_check(self):
+        """(ok, время сервера или текст ошибки); результат кэшируется на health_ttl секунд"""
+        with self._lock:
+            if self._health and time.monotonic() - self._health[0] < self.health_ttl:
+                return self._health[1], self._health[2]
+        try:
+            with self.connect() as conn:
+                result = True, str(conn.execute(text("SELECT CURRENT_TIMESTAMP")).scalar())
+        except Exception as e:
+            result = False, str(e)
+        with self._lock:
+            self._health = (time.monotonic(),) + result
+        return result
+
+    def metrics(self):
+        pool = self.engine.pool
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "wait_avg_ms": self.wait_total / self.checkouts * 1000 if self.checkouts else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                "pool_size": pool.size() if hasattr(pool, "size") else None,
+                "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+            }
+
+
+# Справочники: таблица -> (колонка id, колонка имени, родитель, входит ли родитель в ключ уникальности)
+DIMENSIONS = {
+    'operation_types': ('id_operation', 'name_operation', None, False),
+    'categories': ('id_categories', 'name', 'operation_type_id', False),
+    'subcategories': ('id_subcategories', 'name', 'category_id', True),
+    'groups': ('id_groups', 'name', 'subcategory_id', True),
+    'subgroups': ('id_subgroups', 'name', 'group_id', True),
+    'lesson_types': ('id_lesson_type', 'name', None, False),
+}
+
+# Внешние ключи financial_operations -> справочник
+OPERATION_DIMENSION_COLUMNS = {
+    'operation_type_id': 'operation_types',
+    'category_id': 'categories',
+    'subcategory_id': 'subcategories',
+    'group_id': 'groups',
+    'subgroup_id': 'subgroups',
+    'lesson_type_id': 'lesson_types',
+}
+
+
+# Колонки с именами справочников во фреймах операций (как в get_operations)
+OPERATION_NAME_COLUMNS = {
+    'operation_type_id': 'operation_type',
+    'category_id': 'category',
+    'subcategory_id': 'subcategory',
+    'group_id': 'group_name',
+    'subgroup_id': 'subgroup',
+    'lesson_type_id': 'lesson_type',
+}
+
+
+class DimensionCache:
+    """
+    Кэш справочников в памяти процесса, общий для всех сессий Streamlit.
+    Для каждой таблицы хранит её строки и индексы id -> имя и (родитель, имя) -> id.
+    Таблица загружается при первом обращении и перечитывается через refresh/invalidate.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.RLock()
+        self._tables = {}
+
+    def _load(self, conn, table):
+        id_col, name_col, parent_col, scoped = DIMENSIONS[table]
+        df = pd.read_sql(text(f"SELECT * FROM {table} ORDER BY {id_col}"), conn)
+        ids = df[id_col].tolist()
+        names = df[name_col].tolist()
+        parents = df[parent_col].tolist() if scoped else [None] * len(df)
+        entry = {
+            'frame': df,
+            'names': dict(zip(ids, names)),
+            'ids': dict(zip(zip(parents, names), ids)),
+        }
+        with self._lock:
+            self._tables[table] = entry
+        return entry
+
+    def _entry(self, table, conn=None):
+        entry = self._tables.get(table)
+        if entry is not None:
+            return entry
+        if conn is not None:
+            return self._load(conn, table)
+        with self.db.connect() as conn:
+            return self._load(conn, table)
+
+    def frame(self, table, conn=None):
+        """Строки справочника (DataFrame, не изменять)"""
+        return self._entry(table, conn)['frame']
+
+    def names(self, table, conn=None):
+        """Индекс id -> имя"""
+        return self._entry(table, conn)['names']
+
+    def ids(self, table, conn=None):
+        """Индекс (родитель, имя) -> id; для справочников без родителя в ключе родитель = None"""
+        return self._entry(table, conn)['ids']
+
+    def refresh(self, table, conn=None):
+        """Перечитывает таблицу и обновляет кэш на месте"""
+        with self._lock:
+            self._tables.pop(table, None)
+        return self._entry(table, conn)
+
+    def invalidate(self, table=None):
+        """Сбрасывает одну таблицу или весь кэш"""
+        with self._lock:
+            if table is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(table, None)
+
+
+class QueryCache:
+    """
+    Общий для всех сессий кэш результатов чтения FinanceApp.
+    Записи живут ttl секунд (ttl <= 0 отключает кэш), суммарный объём ограничен max_bytes
+    (вытесняются давно не читанные).
+    Каждая запись помнит период запроса, чтобы запись операций сбрасывала только пересекающиеся.
+    """
+
+    def __init__(self, ttl=300, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, nbytes, span, df)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3].copy()
+
+    def put(self, key, df, span=None):
+        if self.ttl <= 0:
+            return
+        nbytes = int(df.memory_usage(deep=True).sum())
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, nbytes, span, df.copy())
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        self._bytes -= self._entries.pop(key)[1]
+
+    def invalidate(self, start_date=None, end_date=None):
+        """
+        Сбрасывает записи, чей период пересекается с [start_date, end_date].
+        Записи без периода сбрасываются всегда; без аргументов сбрасывается весь кэш.
+        """
+        with self._lock:
+            for key, (_, _, span, _) in list(self._entries.items()):
+                if (start_date is None or span is None
+                        or (span[0] <= str(end_date) and str(start_date) <= span[1])):
+                    self._drop(key)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+# Период «все операции» для резидентных окон
+FULL_PERIOD = ('1900-01-01', '2200-12-31')
+
+
+class ResidentOperations:
+    """
+    Окна операций (период -> компактный фрейм), постоянно находящиеся в памяти процесса
+    и общие для всех сессий. Хранит не больше max_windows окон (вытесняются давно не читанные).
+    Для каждого окна помнит состояние БД на момент синхронизации: водяной знак updated_at,
+    число строк окна и сумму их id.
+    """
+
+    def __init__(self, max_windows=4):
+        self.max_windows = max_windows
+        self._lock = threading.Lock()
+        self._windows = OrderedDict()  # (start, end) -> {'raw', 'frame', 'state'}
+        self._syncing = {}  # (start, end) -> Lock загрузки и сверки окна
+        self.full_loads = 0
+        self.delta_syncs = 0
+        self.unchanged = 0
+
+    def find(self, start, end):
+        """Ключ и окно, целиком покрывающее период 'YYYY-MM-DD' (None, None — такого нет)"""
+        with self._lock:
+            for key, window in reversed(self._windows.items()):
+                if key[0] <= start and end <= key[1]:
+                    self._windows.move_to_end(key)
+                    return key, window
+        return None, None
+
+    def get(self, key):
+        with self._lock:
+            return self._windows.get(key)
+
+    def sync_lock(self, key):
+        """
+        Блокировка загрузки и сверки окна: сессии, одновременно запросившие одно окно,
+        читают строки из БД один раз, остальные получают уже сверенное окно.
+        """
+        with self._lock:
+            return self._syncing.setdefault(key, threading.Lock())
+
+    def put(self, key, window, counter):
+        """Сохраняет окно; counter — счётчик, который увеличить ('full_loads' или 'delta_syncs')"""
+        with self._lock:
+            self._windows[key] = window
+            self._windows.move_to_end(key)
+            while len(self._windows) > self.max_windows:
+                evicted, _ = self._windows.popitem(last=False)
+                self._syncing.pop(evicted, None)
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def mark_unchanged(self):
+        with self._lock:
+            self.unchanged += 1
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "windows": len(self._windows),
+                "rows": sum(len(w['raw']) for w in self._windows.values()),
+                "full_loads": self.full_loads,
+                "delta_syncs": self.delta_syncs,
+                "unchanged": self.unchanged,
+            }
+
+
+def _normalize_param(value):
+    """Приводит параметр запроса к хешируемому каноническому виду для ключа кэша"""
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, (list, tuple, set)):
+        return tuple(sorted(_normalize_param(v) for v in value))
+    if hasattr(value, 'item'):  # numpy-скаляры
+        return value.item()
+    return value
+
+
+def cached_query(method):
+    """Кэширует результат метода чтения FinanceApp в общем QueryCache по имени метода и параметрам"""
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        params = {k: _normalize_param(v) for k, v in bound.arguments.items() if k != 'self'}
+        key = (method.__name__, tuple(params.items()))
+
+        df = self.query_cache.get(key)
+        if df is not None:
+            perf_annotate(cached=True)
+        else:
+            df = method(self, *args, **kwargs)
+            span = None
+            if params.get('start_date') and params.get('end_date'):
+                span = (str(params['start_date']), str(params['end_date']))
+            self.query_cache.put(key, df, span)
+        return df
+
+    return wrapper
+
+
+def in_streamlit():
+    """Исполняется ли код в скрипте Streamlit (streamlit run, AppTest), а не в fin_manage или cron"""
+    return st is not None and get_script_run_ctx(suppress_warning=True) is not None
+
+
+def get_setting(name, default=None):
+    """Значение настройки из st.secrets (если есть Streamlit), затем из переменных окружения"""
+    if st is not None:
+        try:
+            return st.secrets[name]
+        except Exception:
+            pass
+    return os.getenv(name, default)
+
+
+def notify_error(message):
+    """Ошибка для пользователя: st.error в дашборде, вне Streamlit — в журнал fin_dash"""
+    if in_streamlit():
+        st.error(message)
+    else:
+        logging.getLogger("fin_dash").error(message)
+
+
+def _cache_resource(func):
+    """
+    st.cache_resource в скрипте Streamlit (объект переживает перезапуски скрипта),
+    вне его — обычный кэш процесса, без предупреждений bare mode
+    """
+    if in_streamlit():
+        return st.cache_resource(func)
+    return functools.cache(func)
+
+
+def _fragment(func=None, **kwargs):
+    """st.fragment; без Streamlit функция остаётся как есть"""
+    if st is None:
+        return func if func is not None else (lambda f: f)
+    return st.fragment(func, **kwargs)
+
+
+@_cache_resource
+def _shared_registry():
+    # Streamlit исполняет скрипт заново при каждом перезапуске, поэтому глобальные
+    # переменные модуля не переживают rerun — реестр хранится в cache_resource
+    return {}, threading.Lock()
+
+
+def _get_shared(kind, db_url, factory):
+    """Объект, общий для всех сессий процесса: один на пару (вид, DB_URL)"""
+    objects, lock = _shared_registry()
+    with lock:
+        key = (kind, db_url)
+        if key not in objects:
+            objects[key] = factory()
+        return objects[key]
+
+
+# === Замеры производительности ===
+
+@_cache_resource
+def _perf_context():
+    # Переменная контекста должна быть одной на процесс: общий движок из прошлого
+    # перезапуска скрипта ищет замеры текущего через неё
+    return contextvars.ContextVar("fin_dash_perf", default=None)
+
+
+_perf_var_cached = None
+
+
+def _perf_var():
+    """Переменная с замерами текущего перезапуска (у каждой сессии Streamlit свой поток и контекст)"""
+    global _perf_var_cached
+    if _perf_var_cached is None:
+        _perf_var_cached = _perf_context()
+    return _perf_var_cached
+
+
+def _result_size(result):
+    """(строк, байт) в результате метода: DataFrame, кортеж/словарь с DataFrame или пусто"""
+    if isinstance(result, pd.DataFrame):
+        return len(result), int(result.memory_usage(deep=True).sum())
+    if isinstance(result, dict):
+        result = list(result.values())
+    if isinstance(result, (tuple, list)):
+        frames = [r for r in result if isinstance(r, pd.DataFrame)]
+        if frames:
+            sizes = [_result_size(f) for f in frames]
+            return sizes[0][0], sum(size[1] for size in sizes)
+    return None, None
+
+
+class PerfRecorder:
+    """
+    Замеры одного перезапуска скрипта: участки (методы FinanceApp, панели, построение графиков)
+    с временем, числом строк и байт результата, числом запросов к БД и временем их выполнения.
+    Участки вкладываются; запрос засчитывается всем открытым участкам своего потока.
+    """
+
+    def __init__(self, name="rerun"):
+        self.name = name
+        self.started = time.perf_counter()
+        self.finished = None
+        self.sections = []  # в порядке начала
+        self.queries = 0
+        self.db_time = 0.0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def section(self, name):
+        stack = self._stack()
+        entry = {
+            "name": name, "depth": len(stack), "ms": 0.0, "rows": None, "bytes": None,
+            "queries": 0, "db_ms": 0.0, "cached": False,
+        }
+        with self._lock:
+            self.sections.append(entry)
+        stack.append(entry)
+        started = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry["ms"] = (time.perf_counter() - started) * 1000
+            stack.pop()
+
+    def add_query(self, elapsed):
+        with self._lock:
+            self.queries += 1
+            self.db_time += elapsed
+            for entry in self._stack():
+                entry["queries"] += 1
+                entry["db_ms"] += elapsed * 1000
+
+    def annotate(self, **fields):
+        """Дополняет самый внутренний открытый участок (например, cached=True)"""
+        stack = self._stack()
+        if stack:
+            stack[-1].update(fields)
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+        return self
+
+    def summary(self):
+        """Итоги перезапуска в виде словаря (для JSON-лога)"""
+        end = self.finished or time.perf_counter()
+        return {
+            "event": "perf",
+            "name": self.name,
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "total_ms": round((end - self.started) * 1000, 2),
+            "queries": self.queries,
+            "db_ms": round(self.db_time * 1000, 2),
+            "sections": [
+                dict(entry, ms=round(entry["ms"], 2), db_ms=round(entry["db_ms"], 2))
+                for entry in self.sections
+            ],
+        }
+
+    def frame(self):
+        """Участки перезапуска таблицей для панели «Производительность»"""
+        return pd.DataFrame([
+            {
+                "Участок": "  " * entry["depth"] + entry["name"],
+                "мс": round(entry["ms"], 1),
+                "запросов": entry["queries"],
+                "БД, мс": round(entry["db_ms"], 1),
+                "строк": entry["rows"],
+                "КБ": round(entry["bytes"] / 1024, 1) if entry["bytes"] is not None else None,
+                "кэш": "✓" if entry["cached"] else "",
+            }
+            for entry in self.sections
+        ], columns=["Участок", "мс", "запросов", "БД, мс", "строк", "КБ", "кэш"]).astype({"строк": "Int64"})
+
+
+class PerfHistory:
+    """Последние size замеров каждого участка (общие для всех сессий) для скользящих перцентилей"""
+
+    def __init__(self, size=200):
+        self.size = size
+        self._lock = threading.Lock()
+        self._samples = {}  # имя участка -> deque(мс)
+
+    def add(self, recorder):
+        with self._lock:
+            samples = [(recorder.name, (recorder.finished - recorder.started) * 1000)]
+            samples += [(entry["name"], entry["ms"]) for entry in recorder.sections]
+            for name, ms in samples:
+                self._samples.setdefault(name, deque(maxlen=self.size)).append(ms)
+
+    def percentiles(self):
+        with self._lock:
+            items = [(name, np.array(values)) for name, values in self._samples.items()]
+        return pd.DataFrame([
+            {
+                "Участок": name,
+                "замеров": len(values),
+                "p50, мс": round(float(np.percentile(values, 50)), 1),
+                "p90, мс": round(float(np.percentile(values, 90)), 1),
+                "p99, мс": round(float(np.percentile(values, 99)), 1),
+            }
+            for name, values in items
+        ])
+
+
+@contextmanager
+def perf_section(name):
+    """Замер участка кода в текущем перезапуске; вне перезапуска ничего не делает"""
+    recorder = _perf_var().get()
+    if recorder is None:
+        yield None
+        return
+    with recorder.section(name) as entry:
+        yield entry
+
+
+def perf_annotate(**fields):
+    recorder = _perf_var().get()
+    if recorder is not None:
+        recorder.annotate(**fields)
+
+
+def timed(name):
+    """Декоратор: замеряет вызов как участок name и запоминает размер результата"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _perf_var().get() is None:
+                return func(*args, **kwargs)
+            with perf_section(name) as entry:
+                result = func(*args, **kwargs)
+                entry["rows"], entry["bytes"] = _result_size(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def instrument_methods(exclude=()):
+    """
+    Декоратор класса: оборачивает публичные методы (кроме exclude) в timed("Класс.метод").
+    Генераторы пропускаются: timed замерил бы только создание генератора, а не чтение данных.
+    """
+    def decorator(cls):
+        for attr, value in list(vars(cls).items()):
+            if (not attr.startswith("_") and attr not in exclude and inspect.isfunction(value)
+                    and not inspect.isgeneratorfunction(value)):
+                setattr(cls, attr, timed(f"{cls.__name__}.{attr}")(value))
+        return cls
+    return decorator
+
+
+def _perf_logger():
+    logger = logging.getLogger("fin_dash.perf")
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+    return logger
+
+
+def start_perf(name="rerun"):
+    """Начинает замеры перезапуска в текущем контексте"""
+    recorder = PerfRecorder(name)
+    _perf_var().set(recorder)
+    return recorder
+
+
+def finish_perf(recorder, history=None):
+    """
+    Завершает замеры: добавляет их в скользящую историю и, если PERF_LOG включён,
+    пишет одной строкой JSON в логгер fin_dash.perf
+    """
+    recorder.finish()
+    _perf_var().set(None)
+    if history is not None:
+        history.add(recorder)
+    if str(get_setting("PERF_LOG", "false")).lower() in ("1", "true", "yes", "json"):
+        _perf_logger().info(json.dumps(recorder.summary(), ensure_ascii=False, default=str))
+    return recorder
+
+
+def perf_panel_enabled():
+    """Скрытая панель «Производительность»: PERF_PANEL=true в настройках или ?perf=1 в адресе"""
+    return (str(get_setting("PERF_PANEL", "false")).lower() in ("1", "true", "yes")
+            or st.query_params.get("perf") == "1")
+
+
+# === Колоночное чтение результатов (Arrow) ===
+
+def arrow_fetch_enabled():
+    """
+    Режим чтения выборок FinanceApp (DB_FETCH): arrow — колоночно в pyarrow (fetch_arrow),
+    pandas — pd.read_sql, auto (по умолчанию) — arrow, если установлен pyarrow.
+    """
+    mode = str(get_setting("DB_FETCH", "auto")).lower()
+    if mode == "pandas":
+        return False
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        if mode == "arrow":
+            raise RuntimeError("для DB_FETCH=arrow нужен пакет pyarrow")
+        return False
+    return True
+
+
+# Типы колонок get_operations и _operation_rows: в SQLite даты — строки, суммы — то int, то float
+OPERATIONS_ARROW_TYPES = {
+    'id': 'int64', 'operation_date': 'date32', 'amount': 'float64', 'comment': 'string',
+    'created_at': 'timestamp[us]', 'updated_at': 'timestamp[us]',
+    **{name: 'string' for name in ('operation_type', 'category', 'subcategory', 'group_name', 'subgroup', 'lesson_type')},
+}
+# Дата сразу как timestamp[ns]: переход к datetime64 без разбора дат в pandas
+OPERATION_ROWS_ARROW_TYPES = {
+    'id': 'int64', 'operation_date': 'timestamp[ns]', 'amount_kop': 'int64',
+    **{column: 'int64' for column in OPERATION_DIMENSION_COLUMNS},
+}
+
+# Типы колонок журнала (JOURNAL_QUERY) — без вывода типов по данным
+JOURNAL_ARROW_TYPES = {
+    'id': 'int64', 'operation_date': 'date32', 'amount': 'float64', 'comment': 'string',
+    'created_at': 'timestamp[us]',
+    **{name: 'string' for name in ('operation_type', 'category', 'subcategory', 'group_name', 'subgroup', 'lesson_type')},
+}
+
+
+def _copy_csv(conn, statement, params, file):
+    """
+    Выполняет запрос через COPY (...) TO STDOUT в CSV с заголовком и пишет результат в file.
+    COPY параметров не принимает: они подставляются драйвером (списки bindparam раскрываются).
+    Запрос идёт мимо событий SQLAlchemy, поэтому время учитывается в замерах здесь.
+    """
+    started = time.perf_counter()
+    compiled = statement.bindparams(**params).compile(
+        dialect=conn.dialect, compile_kwargs={"render_postcompile": True},
+    )
+    with conn.connection.cursor() as cur:
+        query = cur.mogrify(str(compiled), compiled.params).decode()
+        cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true)", file)
+    file.seek(0)
+    recorder = _perf_var().get()
+    if recorder is not None:
+        recorder.add_query(time.perf_counter() - started)
+
+
+def _csv_convert_options(types):
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    return pa_csv.ConvertOptions(
+        column_types={name: pa.type_for_alias(alias) for name, alias in (types or {}).items()},
+        strings_can_be_null=True, quoted_strings_can_be_null=False,
+    )
+
+
+def _arrow_column(values, arrow_type=None):
+    """Массив Arrow из значений колонки; даты и время SQLite (строки ISO) приводятся к типу разбором в Arrow"""
+    import pyarrow as pa
+    try:
+        if arrow_type is not None and pa.types.is_temporal(arrow_type):
+            return pa.array(values, type=pa.string()).cast(arrow_type)
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Колонка со смешанными типами или нестандартными датами (SQLite это допускает) — как текст
+        return pa.array([None if v is None else str(v) for v in values], type=pa.string())
+
+
+def _sqlite_arrow(conn, statement, params, types):
+    """
+    Результат запроса SQLite как pyarrow.Table: курсор драйвера напрямую, без объектов строк
+    SQLAlchemy; кортежи раскладываются по колонкам и собираются в типизированные массивы Arrow.
+    """
+    import pyarrow as pa
+    started = time.perf_counter()
+    compiled = statement.bindparams(**params).compile(
+        dialect=conn.dialect, compile_kwargs={"render_postcompile": True},
+    )
+    cur = conn.connection.driver_connection.cursor()
+    try:
+        cur.execute(str(compiled), [compiled.params[name] for name in compiled.positiontup])
+        names = [d[0] for d in cur.description]
+        rows = cur.fetchall()
+    finally:
+        cur.close()
+    recorder = _perf_var().get()
+    if recorder is not None:
+        recorder.add_query(time.perf_counter() - started)
+    types = {name: pa.type_for_alias(alias) for name, alias in (types or {}).items()}
+    columns = zip(*rows) if rows else [()] * len(names)
+    return pa.table({name: _arrow_column(list(values), types.get(name)) for name, values in zip(names, columns)})
+
+
+def fetch_arrow(conn, statement, params=None, types=None):
+    """
+    Результат запроса как pyarrow.Table. PostgreSQL: COPY в CSV и разбор многопоточным
+    CSV-парсером Arrow, без кортежа драйвера и Python-объекта на каждое значение.
+    SQLite: кортежи курсора драйвера сразу в массивы Arrow (_sqlite_arrow).
+    types — {колонка: псевдоним типа Arrow ('date32', 'float64', ...)}; остальные типы выводятся по данным.
+    """
+    if not _is_postgres(conn):
+        return _sqlite_arrow(conn, statement, params or {}, types)
+    import pyarrow.csv as pa_csv
+    buf = io.BytesIO()
+    _copy_csv(conn, statement, params or {}, buf)
+    return pa_csv.read_csv(buf, convert_options=_csv_convert_options(types))
+
+
+def iter_arrow_batches(conn, statement, params=None, types=None):
+    """
+    Результат запроса PostgreSQL потоком pyarrow.RecordBatch (для выгрузок): CSV из COPY
+    идёт во временный файл на диске и читается из него блоками — память не растёт с объёмом.
+    """
+    import pyarrow.csv as pa_csv
+    with tempfile.TemporaryFile() as file:
+        _copy_csv(conn, statement, params or {}, file)
+        yield from pa_csv.open_csv(file, convert_options=_csv_convert_options(types))
+
+
+# Строки журнала с именами справочников; условия, сортировка и лимит добавляются к запросу
+JOURNAL_QUERY = '''
+        SELECT
+            f.id,
+            f.operation_date,
+            ot.name_operation AS operation_type,
+            c.name AS category,
+            s.name AS subcategory,
+            g.name AS group_name,
+            sg.name AS subgroup,
+            lt.name AS lesson_type,
+            f.amount,
+            f.comment,
+            f.created_at
+        FROM financial_operations f
+        JOIN operation_types ot ON f.operation_type_id = ot.id_operation
+        JOIN categories c ON f.category_id = c.id_categories
+        LEFT JOIN subcategories s ON f.subcategory_id = s.id_subcategories
+        LEFT JOIN groups g ON f.group_id = g.id_groups
+        LEFT JOIN subgroups sg ON f.subgroup_id = sg.id_subgroups
+        LEFT JOIN lesson_types lt ON f.lesson_type_id = lt.id_lesson_type
+        '''
+
+
+# Корзины графика динамики: имя -> (примерная длина в днях, шаг PostgreSQL, шаг SQLite, подписи)
+TIME_BUCKETS = {
+    'day': (1, '1 day', '+1 day', ('День', 'по дням')),
+    'week': (7, '7 days', '+7 days', ('Неделя', 'по неделям')),
+    'month': (30.44, '1 month', '+1 month', ('Месяц', 'по месяцам')),
+    'quarter': (91.31, '3 months', '+3 months', ('Квартал', 'по кварталам')),
+}
+
+
+def choose_bucket(start_date, end_date, points=None):
+    """Самая мелкая корзина, при которой период укладывается в целевое число точек (CHART_BUCKETS)"""
+    if not (start_date and end_date):
+        return 'month'
+    points = int(points or get_setting("CHART_BUCKETS", 60))
+    span = (pd.Timestamp(end_date) - pd.Timestamp(start_date)).days + 1
+    for bucket, (days, *_) in TIME_BUCKETS.items():
+        if span / days <= points:
+            return bucket
+    return 'quarter'
+
+
+@instrument_methods(exclude=('get_connection', 'begin'))
+class FinanceApp:
+
+    def __init__(self, db_url=None):
+        if db_url is None:
+            # Streamlit Cloud: st.secrets
+            db_url = get_setting("DB_URL")
+        if not db_url:
+            raise RuntimeError("DB_URL не задан")
+        self.db_url = db_url
+        self.arrow_fetch = arrow_fetch_enabled()
+        # Один движок и пул на DB_URL для всех сессий и перезапусков скрипта
+        self.db = _get_shared('engine', db_url, lambda: PooledEngine(db_url))
+        self.engine = self.db.engine
+        self.dimensions = _get_shared('dimensions', db_url, lambda: DimensionCache(self.db))
+        self.query_cache = _get_shared('queries', db_url, lambda: QueryCache(
+            ttl=float(get_setting("QUERY_CACHE_TTL", 300)),
+            max_bytes=int(float(get_setting("QUERY_CACHE_MAX_MB", 64)) * 1024 * 1024),
+        ))
+        if str(get_setting("DB_AUTO_MIGRATE", "true")).lower() in ("1", "true", "yes"):
+            # Схема доводится до последней версии один раз на процесс
+            _get_shared('schema', db_url, lambda: migrate(self.engine))
+        self.perf_history = _get_shared('perf', db_url, lambda: PerfHistory(
+            size=int(get_setting("PERF_HISTORY_SIZE", 200)),
+        ))
+        self.resident = _get_shared('resident', db_url, lambda: ResidentOperations(
+            max_windows=int(get_setting("RESIDENT_MAX_WINDOWS", 4)),
+        ))
+
+
+    def get_connection(self):
+        # """Устанавливает соединение с базой данных"""
+        # conn = sqlite3.connect(self.db_name)
+        # conn.execute("PRAGMA foreign_keys = ON")
+        # return conn
+        """Возвращает SQLAlchemy connection (использовать с pandas.read_sql и .execute)"""
+        return self.db.connect()
+
+
+    def begin(self):
+        """Контекст транзакции: with app.begin() as conn"""
+        return self.db.begin()
+
+
+    def check_connection(self):
+        """Проверка доступности БД (кэшируется на DB_HEALTH_TTL секунд)"""
+        return self.db.health_check()
+
+
+    def get_operation_types(self):
+        """Получает список всех типов операций"""
+        return self.dimensions.frame('operation_types').copy()
+
+
+    def get_categories(self, operation_type_id=None):
+        """Получает список категорий"""
+        df = self.dimensions.frame('categories')
+        if operation_type_id:
+            return df.loc[df['operation_type_id'] == int(operation_type_id), ['id_categories', 'name']].copy()
+        return df[['id_categories', 'name', 'operation_type_id']].copy()
+
+
+    def get_subcategories(self, category_id):
+        """Получает список подкатегорий для категории"""
+        df = self.dimensions.frame('subcategories')
+        return df.loc[df['category_id'] == category_id, ['id_subcategories', 'name']].copy()
+
+
+    def find_fingerprints(self, fingerprints, batch_size=1000):
+        """Какие из отпечатков строк импорта уже есть в БД — поиск по уникальному индексу"""
+        with self.get_connection() as conn:
+            return _find_fingerprints(conn, fingerprints, batch_size)
+
+
+    def add_operation(self, operation_data):
+        """Добавляет новую финансовую операцию (operation_data — tuple в порядке OPERATION_FIELDS)"""
+        try:
+            result = self.add_operations([operation_data])
+        except Exception as e:
+            notify_error(f"Ошибка при добавлении операции: {e}")
+            return False
+        if result['error'].notna().any():
+            notify_error(f"Ошибка при добавлении операции: {result['error'].iloc[0]}")
+            return False
+        return True
+
+
+    def add_operations(self, operations):
+        """
+        Пакетная запись операций: DataFrame, список словарей или кортежей add_operation
+        (поля OPERATION_FIELDS). Строки проверяются по колонкам целиком (_validate_operations),
+        прошедшие пишутся одной транзакцией: id резервируются заранее, сами строки уходят
+        одним COPY (executemany в SQLite), вместе с ними обновляются дневные агрегаты.
+        Отпечатки считаются как при импорте (_manual_fingerprints), так что файл с этими
+        операциями потом не задвоит их.
+        Возвращает DataFrame с индексом входных строк: id новой операции или error — причина отказа.
+        Ошибка БД откатывает весь пакет и пробрасывается.
+        """
+        frame = _operations_frame(operations)
+        result = pd.DataFrame({'id': pd.array([None] * len(frame), dtype="Int64"), 'error': None},
+                              index=frame.index)
+        if frame.empty:
+            return result
+
+        with self.begin() as conn:
+            valid, rejected = _validate_operations(conn, self.dimensions, frame)
+            if not valid.empty:
+                valid.insert(0, 'id', _reserve_operation_ids(conn, len(valid)))
+                valid['fingerprint'] = _manual_fingerprints(conn, self.dimensions, valid)
+                _insert_operations(conn, valid[['id'] + OPERATION_FIELDS + ['fingerprint']])
+                _upsert_rollup(conn, valid)
+
+        result.loc[valid.index, 'id'] = valid['id'].values if not valid.empty else []
+        result.loc[rejected.index, 'error'] = rejected
+        if not valid.empty:
+            self.query_cache.invalidate(valid['operation_date'].min(), valid['operation_date'].max())
+        return result
+
+
+    @cached_query
+    def get_operations(self, start_date=None, end_date=None):
+        """Получает операции за период с правильными JOIN по вашей схеме"""
+        query = '''
+        SELECT 
+            f.id,
+            f.operation_date,
+            ot.name_operation AS operation_type,
+            c.name AS category,
+            s.name AS subcategory,
+            g.name AS group_name,
+            sg.name AS subgroup,
+            lt.name AS lesson_type,
+            f.amount,
+            f.comment,
+            f.created_at,
+            f.updated_at
+        FROM financial_operations f
+        JOIN operation_types ot ON f.operation_type_id = ot.id_operation
+        JOIN categories c ON f.category_id = c.id_categories
+        LEFT JOIN subcategories s ON f.subcategory_id = s.id_subcategories
+        LEFT JOIN groups g ON f.group_id = g.id_groups
+        LEFT JOIN subgroups sg ON f.subgroup_id = sg.id_subgroups
+        LEFT JOIN lesson_types lt ON f.lesson_type_id = lt.id_lesson_type
+    '''
+
+        where, params = self._period_clause(start_date, end_date)
+        query += where + " ORDER BY f.operation_date DESC, f.id DESC"
+        return self._read_sql(query, params, types=OPERATIONS_ARROW_TYPES)
+
+
+    def _dimension_categorical(self, table, ids):
+        """
+        Categorical с именами справочника по колонке id.
+        Категории — уникальные имена таблицы, коды получаются векторно через массив id -> код.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        names = self.dimensions.names(table)
+        if not set(np.unique(ids[ids >= 0]).tolist()) <= names.keys():
+            names = self.dimensions.refresh(table)['names']
+
+        categories = sorted(set(names.values()), key=str)
+        code_of = {name: code for code, name in enumerate(categories)}
+        lookup = np.full(max(names, default=0) + 1, -1, dtype=np.int32)
+        for id_, name in names.items():
+            lookup[id_] = code_of[name]
+
+        codes = np.full(len(ids), -1, dtype=np.int32)
+        known = (ids >= 0) & (ids < len(lookup))
+        codes[known] = lookup[ids[known]]
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+
+    def _operation_rows(self, where, params):
+        """Строки financial_operations без текстов: id справочников (-1 вместо NULL) и сумма в копейках"""
+        query = f'''
+            SELECT
+                f.id, f.operation_date, f.operation_type_id, f.category_id, f.subcategory_id,
+                f.group_id, f.subgroup_id, f.lesson_type_id,
+                CAST(ROUND(f.amount * 100) AS BIGINT) AS amount_kop
+            FROM financial_operations f
+            {where}
+        '''
+        raw = self._read_sql(query, params, types=OPERATION_ROWS_ARROW_TYPES)
+
+        raw['id'] = raw['id'].to_numpy(dtype=np.int64)
+        raw['operation_date'] = raw['operation_date'].astype('datetime64[ns]')
+        for column in OPERATION_DIMENSION_COLUMNS:
+            raw[column] = raw[column].to_numpy(dtype=np.int64, na_value=-1)
+        raw['amount_kop'] = raw['amount_kop'].to_numpy(dtype=np.int64)
+        return raw
+
+
+    def _operations_frame(self, raw):
+        """Компактный фрейм из строк _operation_rows: справочники — categorical, сумма со знаком"""
+        expense_ids = [id_ for (_, name), id_ in self.dimensions.ids('operation_types').items()
+                       if name == 'расход']
+        sign = np.where(raw['operation_type_id'].isin(expense_ids), -1, 1)
+
+        df = pd.DataFrame({
+            'id': raw['id'].to_numpy(),
+            'operation_date': raw['operation_date'].to_numpy(),
+        })
+        for column, table in OPERATION_DIMENSION_COLUMNS.items():
+            df[OPERATION_NAME_COLUMNS[column]] = self._dimension_categorical(table, raw[column])
+        df['amount_kop'] = raw['amount_kop'].to_numpy() * sign
+        return df
+
+
+    def _window_state(self, start_date, end_date):
+        """Состояние окна в БД одним запросом: (водяной знак updated_at, число строк, сумма id)"""
+        where, params = self._period_clause(start_date, end_date)
+        conn = self.get_connection()
+        row = conn.execute(text(f'''
+            SELECT
+                (SELECT MAX(updated_at) FROM financial_operations) AS watermark,
+                COUNT(*) AS rows_count,
+                COALESCE(SUM(f.id), 0) AS id_sum
+            FROM financial_operations f
+            {where}
+        '''), params).one()
+        conn.close()
+        return str(row.watermark) if row.watermark is not None else None, int(row.rows_count), int(row.id_sum)
+
+
+    def get_operations_frame(self, start_date=None, end_date=None):
+        """
+        Компактное представление операций за период.
+        Справочники — categorical по id из кэша справочников (без JOIN), сумма — int64 в копейках
+        со знаком (доход +, расход -), дата — datetime64. Комментарий и даты создания/изменения
+        не загружаются: журнал читает их постранично (get_journal_page).
+
+        Строки берутся из резидентного окна (ResidentOperations), покрывающего период, или окно
+        загружается заново. Перед выдачей окно сверяется с БД одним лёгким запросом (_window_state);
+        при изменениях догружаются только строки с updated_at не старше водяного знака
+        (с запасом RESIDENT_SYNC_LAG секунд), а удаления обнаруживаются по числу строк и сумме id.
+        """
+        period = (_normalize_param(start_date or FULL_PERIOD[0]), _normalize_param(end_date or FULL_PERIOD[1]))
+        key, _ = self.resident.find(*period)
+        key = key or period
+        with self.resident.sync_lock(key):
+            # Пока ждали блокировку, окно могла загрузить или сверить другая сессия
+            window = self.resident.get(key)
+            state = self._window_state(*key)
+            if window is None:
+                window = self._load_window(key, state)
+            elif window['state'] != state:
+                window = self._sync_window(key, window, state)
+            else:
+                self.resident.mark_unchanged()
+
+        frame = window['frame']
+        if key != period:
+            dates = frame['operation_date']
+            frame = frame[(dates >= pd.Timestamp(period[0])) & (dates <= pd.Timestamp(period[1]))]
+        return frame.reset_index(drop=True)
+
+
+    def _load_window(self, key, state):
+        # Состояние снято до чтения строк: изменённое в промежутке придёт повторно и сольётся по id
+        where, params = self._period_clause(*key)
+        raw = self._operation_rows(where, params).sort_values(['operation_date', 'id'], ignore_index=True)
+        window = {'raw': raw, 'frame': self._operations_frame(raw), 'state': state}
+        self.resident.put(key, window, 'full_loads')
+        return window
+
+
+    def _sync_window(self, key, window, state):
+        watermark = window['state'][0]
+        if watermark is None:
+            return self._load_window(key, state)
+
+        # Запас на часы и долгие транзакции: updated_at ставится в начале транзакции
+        lag = pd.Timedelta(seconds=float(get_setting("RESIDENT_SYNC_LAG", 60)))
+        since = (pd.Timestamp(watermark) - lag).strftime('%Y-%m-%d %H:%M:%S')
+        delta = self._operation_rows("WHERE f.updated_at >= :since", {"since": since})
+
+        inside = (delta['operation_date'] >= pd.Timestamp(key[0])) & (delta['operation_date'] <= pd.Timestamp(key[1]))
+        raw = window['raw']
+        raw = pd.concat([raw[~raw['id'].isin(delta['id'])], delta[inside]], ignore_index=True)
+        raw = raw.sort_values(['operation_date', 'id'], ignore_index=True)
+
+        if len(raw) != state[1] or int(raw['id'].sum()) != state[2]:
+            # Строки удалены: сверяем только список id окна, без самих строк
+            where, params = self._period_clause(*key)
+            ids = self._read_sql(f"SELECT f.id FROM financial_operations f {where}", params, types={'id': 'int64'})
+            raw = raw[raw['id'].isin(ids['id'].to_numpy(dtype=np.int64))].reset_index(drop=True)
+            if len(raw) != state[1] or int(raw['id'].sum()) != state[2]:
+                # Изменения задним числом (старше водяного знака) — окно перечитывается целиком
+                return self._load_window(key, state)
+
+        window = {'raw': raw, 'frame': self._operations_frame(raw), 'state': state}
+        self.resident.put(key, window, 'delta_syncs')
+        return window
+
+
+    def rebuild_daily_rollup(self, start_date=None, end_date=None):
+        """Пересчитывает дневные агрегаты за период (или целиком) по financial_operations"""
+        where, params = self._period_clause(start_date, end_date, column='operation_date')
+        with self.begin() as conn:
+            conn.execute(text("DELETE FROM operations_daily_rollup" + where), params)
+            result = conn.execute(text(f'''
+                INSERT INTO operations_daily_rollup ({', '.join(ROLLUP_KEYS)}, total, operations_count)
+                SELECT {ROLLUP_SOURCE_KEYS}, SUM(amount), COUNT(*)
+                FROM financial_operations
+                {where}
+                GROUP BY {ROLLUP_SOURCE_KEYS}
+            '''), params)
+        self.query_cache.invalidate(start_date, end_date)
+        return result.rowcount
+
+
+    def check_daily_rollup(self, start_date=None, end_date=None):
+        """
+        Сверяет дневные агрегаты с financial_operations.
+        Возвращает расхождения: ключ, сумма и количество в агрегате (rollup_*) и по операциям (source_*).
+        """
+        where, params = self._period_clause(start_date, end_date, column='operation_date')
+        conn = self.get_connection()
+        source = pd.read_sql(text(f'''
+            SELECT {ROLLUP_SOURCE_KEYS}, SUM(amount) AS total, COUNT(*) AS operations_count
+            FROM financial_operations
+            {where}
+            GROUP BY {ROLLUP_SOURCE_KEYS}
+        '''), conn, params=params)
+        rollup = pd.read_sql(text(f'''
+            SELECT {', '.join(ROLLUP_KEYS)}, total, operations_count
+            FROM operations_daily_rollup
+            {where}
+        '''), conn, params=params)
+        conn.close()
+
+        source.columns = rollup.columns
+        for df in (source, rollup):
+            df['operation_date'] = df['operation_date'].astype(str)
+            df['total'] = df['total'].astype(float).round(2)
+        merged = rollup.merge(source, on=ROLLUP_KEYS, how='outer', suffixes=('_rollup', '_source'))
+        merged = merged.fillna({'total_rollup': 0, 'total_source': 0,
+                                'operations_count_rollup': 0, 'operations_count_source': 0})
+        mismatch = ((merged['total_rollup'] - merged['total_source']).abs() > 0.005) | (
+            merged['operations_count_rollup'] != merged['operations_count_source'])
+        return merged[mismatch].reset_index(drop=True)
+
+
+    def _dimension_ids(self, table, names):
+        """id записей справочника без родителя в ключе (типы операций, категории) по именам"""
+        ids = self.dimensions.ids(table)
+        return [ids[(None, name)] for name in names if (None, name) in ids]
+
+
+    def _journal_filters(self, start_date=None, end_date=None, operation_types=None, categories=None,
+                         min_amount=None, max_amount=None):
+        """Условия WHERE журнала, их параметры и списочные bindparam"""
+        conditions = []
+        params = {}
+        bind = []
+
+        if start_date and end_date:
+            conditions.append("f.operation_date BETWEEN :start_date AND :end_date")
+            params.update(start_date=str(start_date), end_date=str(end_date))
+        if operation_types:
+            conditions.append("f.operation_type_id IN :type_ids")
+            params["type_ids"] = self._dimension_ids('operation_types', operation_types)
+            bind.append(bindparam("type_ids", expanding=True))
+        if categories:
+            conditions.append("f.category_id IN :category_ids")
+            params["category_ids"] = self._dimension_ids('categories', categories)
+            bind.append(bindparam("category_ids", expanding=True))
+        if min_amount is not None and max_amount is not None:
+            conditions.append("f.amount BETWEEN :min_amount AND :max_amount")
+            params.update(min_amount=min_amount, max_amount=max_amount)
+        return conditions, params, bind
+
+
+    def get_journal_page(self, start_date=None, end_date=None, operation_types=None, categories=None,
+                         min_amount=None, max_amount=None, limit=100, after=None, before=None):
+        """
+        Страница журнала операций: фильтры, сортировка и лимит выполняются в БД.
+        Пагинация по ключу (operation_date, id): after — ключ последней строки текущей страницы
+        (следующая, более старая страница), before — ключ первой строки (предыдущая страница).
+        Возвращает (DataFrame, есть ли ещё строки в направлении листания).
+        """
+        conditions, params, bind = self._journal_filters(
+            start_date, end_date, operation_types, categories, min_amount, max_amount
+        )
+        params["limit"] = int(limit) + 1
+
+        order = "DESC"
+        key = after or before
+        if key is not None:
+            op = "<" if after is not None else ">"
+            conditions.append(
+                f"(f.operation_date {op} :key_date OR (f.operation_date = :key_date AND f.id {op} :key_id))"
+            )
+            params.update(key_date=str(key[0]), key_id=int(key[1]))
+            if before is not None:
+                order = "ASC"
+
+        query = JOURNAL_QUERY
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY f.operation_date {order}, f.id {order} LIMIT :limit"
+
+        df = self._read_sql(query, params, bind, types=JOURNAL_ARROW_TYPES)
+
+        has_more = len(df) > limit
+        df = df.head(limit)
+        if before is not None:
+            df = df.iloc[::-1].reset_index(drop=True)
+        return df, has_more
+
+
+    def iter_journal(self, start_date=None, end_date=None, operation_types=None, categories=None,
+                     min_amount=None, max_amount=None, chunk_size=None):
+        """
+        Весь отфильтрованный журнал порциями строк прямо из курсора БД (stream_results),
+        в порядке страниц журнала. Первым отдаётся список имён колонок, затем списки кортежей.
+        """
+        chunk_size = int(chunk_size or get_setting("EXPORT_CHUNK_SIZE", 10000))
+        statement, params = self._journal_export_query(
+            start_date, end_date, operation_types, categories, min_amount, max_amount
+        )
+        with self.get_connection() as conn:
+            result = conn.execution_options(yield_per=chunk_size).execute(statement, params)
+            yield list(result.keys())
+            for rows in result.partitions(chunk_size):
+                yield rows
+
+
+    def iter_journal_batches(self, start_date=None, end_date=None, operation_types=None, categories=None,
+                             min_amount=None, max_amount=None):
+        """
+        Весь отфильтрованный журнал из PostgreSQL потоком pyarrow.RecordBatch (iter_arrow_batches)
+        в порядке страниц журнала — для колоночных выгрузок без Python-объекта на значение.
+        """
+        statement, params = self._journal_export_query(
+            start_date, end_date, operation_types, categories, min_amount, max_amount
+        )
+        with self.get_connection() as conn:
+            yield from iter_arrow_batches(conn, statement, params, JOURNAL_ARROW_TYPES)
+
+
+    def _journal_export_query(self, *filters):
+        """Запрос всего отфильтрованного журнала (без лимита) и его параметры"""
+        conditions, params, bind = self._journal_filters(*filters)
+        query = JOURNAL_QUERY
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY f.operation_date DESC, f.id DESC"
+        return text(query).bindparams(*bind), params
+
+
+    @staticmethod
+    def _period_clause(start_date, end_date, column='f.operation_date', keyword='WHERE'):
+        """Условие на период и его параметры"""
+        if start_date and end_date:
+            return f" {keyword} {column} BETWEEN :start_date AND :end_date", {
+                "start_date": str(start_date), "end_date": str(end_date)
+            }
+        return "", {}
+
+
+    def _month_expr(self, column):
+        """Месяц даты в виде 'YYYY-MM' на диалекте текущей БД"""
+        if _is_postgres(self.engine):
+            return f"to_char(date_trunc('month', {column}), 'YYYY-MM')"
+        return f"strftime('%Y-%m', {column})"
+
+
+    def _bucket_expr(self, column, bucket):
+        """Начало корзины (день, неделя с понедельника, месяц, квартал) для даты на диалекте БД"""
+        if _is_postgres(self.engine):
+            return f"CAST(date_trunc('{bucket}', CAST({column} AS timestamp)) AS date)"
+        return {
+            'day': f"date({column})",
+            'week': f"date({column}, 'weekday 0', '-6 days')",
+            'month': f"strftime('%Y-%m-01', {column})",
+            'quarter': f"printf('%s-%02d-01', strftime('%Y', {column}), "
+                       f"(CAST(strftime('%m', {column}) AS INTEGER) - 1) / 3 * 3 + 1)",
+        }[bucket]
+
+
+    def _read_sql(self, query, params, bind=(), types=None):
+        """
+        DataFrame по запросу: при arrow_fetch — колоночно (fetch_arrow) с колонками pd.ArrowDtype
+        (тексты — string[pyarrow], даты — date32[pyarrow], без Python-объекта на значение),
+        иначе pd.read_sql. types — типы Arrow для колонок, см. fetch_arrow.
+        """
+        statement = text(query).bindparams(*bind)
+        conn = self.get_connection()
+        try:
+            if self.arrow_fetch:
+                return fetch_arrow(conn, statement, params, types).to_pandas(types_mapper=pd.ArrowDtype)
+            return pd.read_sql(statement, conn, params=params)
+        finally:
+            conn.close()
+
+
+    def _read_totals(self, query, params):
+        """Агрегаты через _read_sql; total — float64 (из БД приходит Decimal или смесь int и float)"""
+        df = self._read_sql(query, params, types={'total': 'float64'})
+        df['total'] = df['total'].astype(float)
+        return df
+
+
+    @cached_query
+    def get_financial_summary(self, start_date=None, end_date=None):
+        """Получает финансовую сводку: сумма по типу операции и категории"""
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        query = f'''
+            SELECT
+                ot.name_operation AS operation_type,
+                c.name AS category,
+                SUM(r.total) AS total,
+                SUM(r.operations_count) AS operations_count
+            FROM operations_daily_rollup r
+            JOIN operation_types ot ON r.operation_type_id = ot.id_operation
+            JOIN categories c ON r.category_id = c.id_categories
+            {where}
+            GROUP BY ot.name_operation, c.name
+            ORDER BY total DESC
+            '''
+        return self._read_totals(query, params)
+
+
+    @cached_query
+    def get_monthly_summary(self, start_date=None, end_date=None):
+        """Получает помесячную статистику: сумма по месяцу и типу операции"""
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        month = self._month_expr('r.operation_date')
+        query = f'''
+            SELECT
+                {month} AS month,
+                ot.name_operation AS operation_type,
+                SUM(r.total) AS total
+            FROM operations_daily_rollup r
+            JOIN operation_types ot ON r.operation_type_id = ot.id_operation
+            {where}
+            GROUP BY {month}, ot.name_operation
+            ORDER BY month
+            '''
+        return self._read_totals(query, params)
+
+
+    @cached_query
+    def get_dynamics(self, start_date=None, end_date=None, bucket='month'):
+        """
+        Суммы по корзинам времени (TIME_BUCKETS) и типам операций. Ряд корзин строится в БД
+        (generate_series / рекурсивный CTE) на весь период, пустые корзины — нули: результат
+        плотный, и его размер зависит от числа корзин, а не операций.
+        """
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        bucket_of = functools.partial(self._bucket_expr, bucket=bucket)
+        _, pg_step, sqlite_step, _ = TIME_BUCKETS[bucket]
+        postgres = _is_postgres(self.engine)
+        if params:
+            # В SQLite даты — строки 'YYYY-MM-DD', приведение не нужно
+            lo, hi = (("CAST(:start_date AS date)", "CAST(:end_date AS date)") if postgres
+                      else (":start_date", ":end_date"))
+            bounds = f"SELECT {lo} AS lo, {hi} AS hi"
+        else:
+            bounds = "SELECT MIN(operation_date) AS lo, MAX(operation_date) AS hi FROM operations_daily_rollup"
+        if postgres:
+            series = f'''
+                buckets AS (
+                    SELECT CAST(generate_series(date_trunc('{bucket}', CAST(lo AS timestamp)),
+                                                CAST(hi AS timestamp), interval '{pg_step}') AS date) AS bucket
+                    FROM bounds
+                )'''
+        else:
+            series = f'''
+                buckets(bucket) AS (
+                    SELECT {bucket_of('lo')} FROM bounds WHERE lo IS NOT NULL
+                    UNION ALL
+                    SELECT date(bucket, '{sqlite_step}') FROM buckets, bounds
+                    WHERE date(bucket, '{sqlite_step}') <= hi
+                )'''
+        query = f'''
+            WITH RECURSIVE bounds AS ({bounds}),
+            {series},
+            totals AS (
+                SELECT {bucket_of('r.operation_date')} AS bucket, r.operation_type_id, SUM(r.total) AS total
+                FROM operations_daily_rollup r
+                {where}
+                GROUP BY {bucket_of('r.operation_date')}, r.operation_type_id
+            )
+            SELECT b.bucket, ot.name_operation AS operation_type, COALESCE(t.total, 0) AS total
+            FROM buckets b
+            CROSS JOIN operation_types ot
+            LEFT JOIN totals t ON t.bucket = b.bucket AND t.operation_type_id = ot.id_operation
+            ORDER BY b.bucket, ot.name_operation
+            '''
+        df = self._read_totals(query, params)
+        df['bucket'] = pd.to_datetime(df['bucket'])
+        return df
+
+
+    @cached_query
+    def get_breakdown(self, operation_type, start_date=None, end_date=None):
+        """
+        Суммы операций одного типа в разрезе категория / подкатегория / группа / тип занятия.
+        Результат мал, поэтому каскадные фильтры и круговые диаграммы считаются по нему в pandas.
+        """
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date', keyword='AND')
+        params["operation_type"] = operation_type
+        query = f'''
+            SELECT
+                c.name AS category,
+                s.name AS subcategory,
+                g.name AS group_name,
+                lt.name AS lesson_type,
+                SUM(r.total) AS total
+            FROM operations_daily_rollup r
+            JOIN operation_types ot ON r.operation_type_id = ot.id_operation
+            JOIN categories c ON r.category_id = c.id_categories
+            LEFT JOIN subcategories s ON r.subcategory_id = s.id_subcategories
+            LEFT JOIN groups g ON r.group_id = g.id_groups
+            LEFT JOIN lesson_types lt ON r.lesson_type_id = lt.id_lesson_type
+            WHERE ot.name_operation = :operation_type{where}
+            GROUP BY c.name, s.name, g.name, lt.name
+            '''
+        return self._read_totals(query, params)
+
+
+    def _tree_rollup(self, where):
+        """
+        Суммы по типу операции для всех уровней дерева, в целом и по типам занятий.
+        Свёрнутые уровни — NULL; отсутствующие в операциях подкатегория/группа/подгруппа — 0.
+        """
+        measures = "SUM(r.total) AS total, SUM(r.operations_count) AS operations_count"
+        if _is_postgres(self.engine):
+            levels = ', '.join(f"r.{col}" for col in TREE_LEVELS)
+            return f'''
+                SELECT r.operation_type_id, r.lesson_type_id, {levels}, {measures}
+                FROM operations_daily_rollup r
+                {where}
+                GROUP BY r.operation_type_id, ROLLUP (r.lesson_type_id), ROLLUP ({levels})
+                '''
+        # SQLite не знает ROLLUP: период сворачивается один раз, затем по запросу на набор группировки
+        branches = []
+        for lesson in ("lesson_type_id", "NULL"):
+            for depth in range(len(TREE_LEVELS) + 1):
+                grouped = ["operation_type_id"] + ([lesson] if lesson != "NULL" else []) + TREE_LEVELS[:depth]
+                columns = [col if col in grouped else f"NULL AS {col}" for col in ["lesson_type_id"] + TREE_LEVELS]
+                branches.append(
+                    f"SELECT operation_type_id, {', '.join(columns)}, "
+                    f"SUM(total) AS total, SUM(operations_count) AS operations_count "
+                    f"FROM period GROUP BY {', '.join(grouped)}"
+                )
+        return f'''
+            WITH period AS (
+                SELECT r.operation_type_id, r.lesson_type_id, {', '.join(f"r.{col}" for col in TREE_LEVELS)},
+                       {measures}
+                FROM operations_daily_rollup r
+                {where}
+                GROUP BY r.operation_type_id, r.lesson_type_id, {', '.join(f"r.{col}" for col in TREE_LEVELS)}
+            )
+            {" UNION ALL ".join(branches)}
+            '''
+
+    @cached_query
+    def get_tree_totals(self, start_date=None, end_date=None):
+        """
+        Итоги за период для каждого узла дерева справочников одним запросом (ROLLUP, в SQLite —
+        его эмуляция): level 0 — тип операции целиком, 1..4 — категория … подгруппа.
+        Строки с lesson_type_id = NA — по всем типам занятий, остальные — в разрезе типа занятия.
+        Имена узлов берутся из dimension_tree; выборки из результата — tree_slice.
+        """
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        query = f'''
+            SELECT
+                ot.name_operation AS operation_type,
+                CASE
+                    WHEN a.category_id IS NULL THEN 0
+                    WHEN a.subcategory_id IS NULL THEN 1
+                    WHEN a.group_id IS NULL THEN 2
+                    WHEN a.subgroup_id IS NULL THEN 3
+                    ELSE 4
+                END AS level,
+                a.lesson_type_id,
+                lt.name AS lesson_type,
+                a.category_id, a.subcategory_id, a.group_id, a.subgroup_id,
+                t.category, t.subcategory, t.group_name, t.subgroup, t.path,
+                a.total,
+                a.operations_count
+            FROM ({self._tree_rollup(where)}) a
+            JOIN operation_types ot ON a.operation_type_id = ot.id_operation
+            LEFT JOIN lesson_types lt ON a.lesson_type_id = lt.id_lesson_type
+            LEFT JOIN dimension_tree t
+                ON t.category_id = a.category_id
+                AND t.subcategory_id = COALESCE(a.subcategory_id, 0)
+                AND t.group_id = COALESCE(a.group_id, 0)
+                AND t.subgroup_id = COALESCE(a.subgroup_id, 0)
+            '''
+        df = self._read_tree_totals(query, params)
+        ids = ['lesson_type_id'] + TREE_LEVELS
+        df[ids] = df[ids].astype('Int64')
+        df['operations_count'] = df['operations_count'].astype('int64')
+        return df
+
+
+    def _read_tree_totals(self, query, params):
+        """
+        _read_totals для запросов с именами узлов из dimension_tree. Узел с category_id, но без
+        имени означает, что справочники меняли в обход импорта (только он обновляет дерево):
+        дерево пересобирается, запрос читается заново.
+        """
+        def stale(df):
+            return (df['category_id'].notna() & df['category'].isna()).any()
+
+        df = self._read_totals(query, params)
+        if stale(df):
+            # Один пересборщик на процесс: параллельные DELETE + INSERT дерева конфликтуют по ключу
+            with _get_shared('tree_rebuild', self.db_url, threading.Lock):
+                df = self._read_totals(query, params)
+                if stale(df):
+                    self.rebuild_dimension_tree()
+                    df = self._read_totals(query, params)
+        return df
+
+
+    def rebuild_dimension_tree(self):
+        """Пересобирает дерево справочников (если справочники меняли в обход приложения)"""
+        with self.begin() as conn:
+            nodes = _refresh_dimension_tree(conn)
+        self.query_cache.invalidate()
+        return nodes
+
+
+    @cached_query
+    def get_daily_profit(self, start_date=None, end_date=None):
+        """Прибыль по дням (доход минус расход) и её накопленная с начала периода сумма"""
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        signed = "SUM(CASE WHEN ot.name_operation = 'доход' THEN r.total ELSE -r.total END)"
+        query = f'''
+            SELECT
+                r.operation_date,
+                {signed} AS total,
+                SUM({signed}) OVER (ORDER BY r.operation_date) AS cum_profit
+            FROM operations_daily_rollup r
+            JOIN operation_types ot ON r.operation_type_id = ot.id_operation
+            {where}
+            GROUP BY r.operation_date
+            ORDER BY r.operation_date
+            '''
+        df = self._read_totals(query, params)
+        df['cum_profit'] = df['cum_profit'].astype(float)
+        df['operation_date'] = pd.to_datetime(df['operation_date'])
+        return df
+
+
+    def get_monthly_tree(self, start_date=None, end_date=None):
+        """
+        Суммы по месяцам и листьям дерева справочников (тип операции, категория … подгруппа)
+        одним проходом по дневным агрегатам — из них build_reports сворачивает отчёты за любые периоды.
+        Отсутствующие подкатегория/группа/подгруппа — 0, имена узлов — из dimension_tree.
+        """
+        where, params = self._period_clause(start_date, end_date, column='r.operation_date')
+        month = self._bucket_expr('r.operation_date', 'month')
+        levels = ', '.join(f"r.{col}" for col in TREE_LEVELS)
+        query = f'''
+            SELECT
+                m.month,
+                ot.name_operation AS operation_type,
+                {', '.join(f"m.{col}" for col in TREE_LEVELS)},
+                t.category, t.subcategory, t.group_name, t.subgroup,
+                m.total,
+                m.operations_count
+            FROM (
+                SELECT {month} AS month, r.operation_type_id, {levels},
+                       SUM(r.total) AS total, SUM(r.operations_count) AS operations_count
+                FROM operations_daily_rollup r
+                {where}
+                GROUP BY {month}, r.operation_type_id, {levels}
+            ) m
+            JOIN operation_types ot ON m.operation_type_id = ot.id_operation
+            LEFT JOIN dimension_tree t
+                ON t.category_id = m.category_id
+                AND t.subcategory_id = m.subcategory_id
+                AND t.group_id = m.group_id
+                AND t.subgroup_id = m.subgroup_id
+            '''
+        df = self._read_tree_totals(query, params)
+        df['month'] = pd.to_datetime(df['month'].astype(str)).dt.strftime('%Y-%m')
+        # Имена — обычные строки с None: сортировка по нескольким колонкам Arrow с пропусками падает
+        names = df[TREE_NAMES].astype(object)
+        df[TREE_NAMES] = names.where(names.notna(), None)
+        df[TREE_LEVELS] = df[TREE_LEVELS].astype('int64')
+        df['operations_count'] = df['operations_count'].astype('int64')
+        return df
+
+# === Проверка планов запросов ===
+
+# Большие таблицы: полный просмотр любой из них в горячем запросе — признак недостающего индекса
+PLAN_CHECK_TABLES = ('financial_operations', 'operations_daily_rollup')
+
+# Горячие запросы приложения: название -> вызов FinanceApp за период
+PLAN_CHECKS = {
+    'журнал: первая страница': lambda app, s, e: app.get_journal_page(s, e),
+    'журнал: следующая страница': lambda app, s, e: app.get_journal_page(s, e, after=(e, 2 ** 31 - 1)),
+    'журнал: по типу операции': lambda app, s, e: app.get_journal_page(
+        s, e, operation_types=[OPERATION_TYPES[0]]),
+    'журнал: по категории': lambda app, s, e: app.get_journal_page(
+        s, e, categories=app.get_categories()['name'].head(1).tolist()),
+    'операции за период': lambda app, s, e: app.get_operations(s, e),
+    'сводка': lambda app, s, e: app.get_financial_summary(s, e),
+    'по месяцам': lambda app, s, e: app.get_monthly_summary(s, e),
+    'динамика': lambda app, s, e: app.get_dynamics(s, e, choose_bucket(s, e)),
+    'структура расходов': lambda app, s, e: app.get_breakdown('расход', s, e),
+    'прибыль по дням': lambda app, s, e: app.get_daily_profit(s, e),
+    'отпечатки импорта': lambda app, s, e: app.find_fingerprints(['0' * 32]),
+    'дерево справочников': lambda app, s, e: app.get_tree_totals(s, e),
+    'окно операций: сверка': lambda app, s, e: app._window_state(s, e),
+    'окно операций: изменённые строки': lambda app, s, e: app._operation_rows(
+        "WHERE f.updated_at >= :since", {"since": e}),
+}
+
+
+def _plan_nodes(plan):
+    """Узлы плана PostgreSQL (EXPLAIN FORMAT JSON) в глубину"""
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def _explain(conn, statement, parameters):
+    """[(таблица, шаг плана, полный просмотр ли)] для запроса к большим таблицам"""
+    steps = []
+    if _is_postgres(conn):
+        # Без seqscan планировщик выберет полный просмотр, только если подходящего индекса нет:
+        # на маленькой базе иначе полный просмотр дешевле и флагов было бы много ложных
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + statement, parameters).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        for node in _plan_nodes(plan[0]['Plan']):
+            table = node.get('Relation Name')
+            if table in PLAN_CHECK_TABLES:
+                # У Bitmap Heap Scan индекс и условие указаны в дочернем Bitmap Index Scan
+                index = next((n['Index Name'] for n in _plan_nodes(node) if n.get('Index Name')), None)
+                condition = next((n['Index Cond'] for n in _plan_nodes(node) if n.get('Index Cond')), None)
+                detail = f"{node['Node Type']} on {table}" + (f" using {index}" if index else "")
+                if condition:
+                    detail += f" ({condition})"
+                # Индекс без условия — тот же полный просмотр, только в порядке индекса
+                steps.append((table, detail, node['Node Type'] == 'Seq Scan' or not condition))
+        return steps
+
+    # SQLite: алиасы таблиц берём из текста запроса («FROM financial_operations f»)
+    aliases = {}
+    for table in PLAN_CHECK_TABLES:
+        for match in re.finditer(rf"\b{table}\b(?:\s+(?:AS\s+)?(\w+))?", statement, re.IGNORECASE):
+            aliases[table] = table
+            if match.group(1):
+                aliases[match.group(1)] = table
+    for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters):
+        detail = row[-1]
+        words = detail.split()
+        if len(words) > 1 and words[0] in ('SCAN', 'SEARCH') and words[1] in aliases:
+            # SCAN — полный просмотр таблицы или индекса целиком, SEARCH — поиск по условию
+            steps.append((aliases[words[1]], detail, words[0] == 'SCAN'))
+    return steps
+
+
+def check_query_plans(app, start_date=None, end_date=None):
+    """
+    Выполняет горячие запросы PLAN_CHECKS за период (по умолчанию последние 30 дней)
+    в обход кэша, перехватывает их SQL и разбирает планы.
+    Возвращает DataFrame: проверка, таблица, шаг плана, seq_scan — полный просмотр без индекса.
+    """
+    end_date = end_date or date.today().strftime('%Y-%m-%d')
+    start_date = start_date or (pd.Timestamp(end_date) - pd.Timedelta(days=30)).strftime('%Y-%m-%d')
+    probe = copy.copy(app)
+    probe.query_cache = QueryCache(ttl=0)
+    # fetch_arrow идёт мимо событий SQLAlchemy — пробник читает через pd.read_sql
+    probe.arrow_fetch = False
+
+    rows = []
+    for check, call in PLAN_CHECKS.items():
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')) and any(
+                    table in statement for table in PLAN_CHECK_TABLES):
+                statements.append((statement, parameters))
+
+        event.listen(app.engine, "before_cursor_execute", capture)
+        try:
+            call(probe, start_date, end_date)
+        finally:
+            event.remove(app.engine, "before_cursor_execute", capture)
+
+        with app.begin() as conn:
+            for statement, parameters in statements:
+                for table, detail, seq_scan in _explain(conn, statement, parameters):
+                    rows.append((check, table, detail, seq_scan))
+    return pd.DataFrame(rows, columns=['check', 'table', 'plan', 'seq_scan'])
+
+
+# Колонки Excel-файла и их имена во внутреннем представлении импорта
+IMPORT_COLUMNS = {
+    'Дата': 'operation_date',
+    'Тип операции': 'operation_type',
+    'Сумма': 'amount',
+    'Категория': 'category',
+    'Подкатегория': 'subcategory',
+    'Группа': 'group_name',
+    'Подгруппа': 'subgroup',
+    'Тип занятия': 'lesson_type',
+}
+
+OPERATION_TYPES = ('доход', 'расход')
+
+OPERATION_COLUMNS = [
+    'operation_date', 'operation_type_id', 'amount', 'category_id',
+    'subcategory_id', 'group_id', 'subgroup_id', 'lesson_type_id'
+]
+
+
+def _is_postgres(engine):
+    return engine.dialect.name == "postgresql"
+
+
+def _clean_text(series):
+    """Приводит текстовую колонку к str без пробелов по краям; пустые значения -> None"""
+    # astype(object): в пустой колонке CSV (float NaN) None иначе снова станет NaN -> 'nan'
+    cleaned = series.astype(object).where(series.notna(), None).map(
+        lambda v: str(v).strip() if v is not None else None
+    )
+    return cleaned.where(cleaned != '', None)
+
+
+def _parse_dates(series):
+    """Даты из Excel/CSV: сначала ISO (и объекты datetime), остальное — как день.месяц.год"""
+    dates = pd.to_datetime(series, errors='coerce', format='ISO8601')
+    rest = dates.isna() & series.notna()
+    if rest.any():
+        dates[rest] = pd.to_datetime(series[rest], errors='coerce', dayfirst=True)
+    return dates
+
+
+def _prepare_import_frame(df):
+    """
+    Нормализует строки Excel и отбраковывает некорректные.
+    Возвращает (frame, rejected), где rejected — Series {индекс строки: причина}.
+    """
+    frame = df[list(IMPORT_COLUMNS)].rename(columns=IMPORT_COLUMNS)
+
+    for col in ('operation_type', 'category', 'subcategory', 'group_name', 'subgroup', 'lesson_type'):
+        frame[col] = _clean_text(frame[col])
+    frame['operation_type'] = frame['operation_type'].str.lower()
+
+    dates = _parse_dates(frame['operation_date'])
+    amounts = pd.to_numeric(frame['amount'], errors='coerce')
+
+    reasons = pd.Series(None, index=frame.index, dtype=object)
+    checks = [
+        (dates.isna(), "некорректная дата"),
+        (amounts.isna(), "некорректная сумма"),
+        (amounts < 0, "отрицательная сумма"),
+        (~frame['operation_type'].isin(OPERATION_TYPES), "неизвестный тип операции"),
+        (frame['category'].isna(), "не указана категория"),
+        (frame['group_name'].notna() & frame['subcategory'].isna(), "группа без подкатегории"),
+        (frame['subgroup'].notna() & frame['group_name'].isna(), "подгруппа без группы"),
+    ]
+    for mask, reason in checks:
+        reasons = reasons.where(~(mask & reasons.isna()), reason)
+
+    valid = reasons.isna()
+    frame = frame[valid].copy()
+    frame['operation_date'] = dates[valid].dt.strftime('%Y-%m-%d')
+    frame['amount'] = amounts[valid].round(2)
+    return frame, reasons[~valid]
+
+
+# Поля операции в порядке кортежа add_operation
+OPERATION_FIELDS = [
+    'operation_date', 'operation_type_id', 'amount', 'category_id', 'subcategory_id',
+    'group_id', 'subgroup_id', 'comment', 'lesson_type_id'
+]
+
+# Согласованность уровней: (колонка, колонка родителя в операции, причина отказа)
+OPERATION_PARENT_CHECKS = [
+    ('category_id', 'operation_type_id', "категория другого типа операции"),
+    ('subcategory_id', 'category_id', "подкатегория не из этой категории"),
+    ('group_id', 'subcategory_id', "группа не из этой подкатегории"),
+    ('subgroup_id', 'group_id', "подгруппа не из этой группы"),
+]
+
+
+def _operations_frame(operations):
+    """Операции в DataFrame с колонками OPERATION_FIELDS: из DataFrame, словарей или кортежей add_operation"""
+    if isinstance(operations, pd.DataFrame):
+        frame = operations.copy()
+    elif len(operations) and isinstance(operations[0], (tuple, list)):
+        frame = pd.DataFrame([list(row) + [None] * (len(OPERATION_FIELDS) - len(row)) for row in operations],
+                             columns=OPERATION_FIELDS)
+    else:
+        frame = pd.DataFrame.from_records(list(operations))
+    return frame.reindex(columns=OPERATION_FIELDS)
+
+
+def _validate_operations(conn, cache, frame):
+    """
+    Проверяет операции по колонкам целиком: дата, сумма, целые id, наличие id в справочниках
+    (по кэшу; при промахе справочник перечитывается) и согласованность уровней.
+    Возвращает (frame, rejected) как _prepare_import_frame.
+    """
+    dates = _parse_dates(frame['operation_date'])
+    amounts = pd.to_numeric(frame['amount'], errors='coerce')
+    ids = {col: pd.to_numeric(frame[col], errors='coerce') for col in OPERATION_DIMENSION_COLUMNS}
+
+    reasons = pd.Series(None, index=frame.index, dtype=object)
+
+    def reject(mask, reason):
+        nonlocal reasons
+        reasons = reasons.where(~(mask & reasons.isna()), reason)
+
+    reject(dates.isna(), "некорректная дата")
+    reject(amounts.isna(), "некорректная сумма")
+    reject(amounts < 0, "отрицательная сумма")
+    reject(frame['operation_type_id'].isna(), "не указан тип операции")
+    reject(frame['category_id'].isna(), "не указана категория")
+    for col, values in ids.items():
+        reject(frame[col].notna() & (values.isna() | (values % 1 != 0)), f"некорректный {col}")
+
+    for col, table in OPERATION_DIMENSION_COLUMNS.items():
+        given = ids[col].notna()
+        known = ids[col].isin(list(cache.names(table, conn)))
+        if (given & ~known).any():
+            known = ids[col].isin(list(cache.refresh(table, conn)['names']))
+        reject(given & ~known, "нет в справочнике " + table + ": " + ids[col].astype(str).str.removesuffix('.0'))
+
+    for col, parent_col, reason in OPERATION_PARENT_CHECKS:
+        id_col, _, dim_parent_col, _ = DIMENSIONS[OPERATION_DIMENSION_COLUMNS[col]]
+        dim = cache.frame(OPERATION_DIMENSION_COLUMNS[col], conn)
+        expected = ids[col].map(pd.Series(dim[dim_parent_col].values, index=dim[id_col].values))
+        reject(ids[col].notna() & (expected != ids[parent_col]), reason)
+
+    valid = reasons.isna()
+    frame = frame[valid].copy()
+    frame['operation_date'] = dates[valid].dt.strftime('%Y-%m-%d')
+    frame['amount'] = amounts[valid].round(2)
+    for col, values in ids.items():
+        frame[col] = values[valid].astype('Int64')
+    frame['comment'] = frame['comment'].astype(object).where(frame['comment'].notna(), None)
+    return frame, reasons[~valid]
+
+
+def _resolve_level(conn, cache, table, parents, names, extra=None, created=None):
+    """
+    Сопоставляет пары (родитель, имя) с id справочника по кэшу.
+    Промахи сначала сверяются с БД (кэш мог устареть), оставшиеся записи
+    добавляются одним пакетом, после чего уровень перечитывается в кэш.
+    extra — {колонка: Series} дополнительных значений для новых записей;
+    в created (список) добавляется имя таблицы, если записи были созданы.
+    """
+    id_col, name_col, parent_col, scoped = DIMENSIONS[table]
+    keys = list(zip(parents if scoped else [None] * len(names), names))
+
+    def find_missing(lookup):
+        missing = {}
+        for i, key in enumerate(keys):
+            if key[1] is not None and key not in lookup and key not in missing:
+                missing[key] = i
+        return missing
+
+    lookup = cache.ids(table, conn)
+    missing = find_missing(lookup)
+    if missing:
+        lookup = cache.refresh(table, conn)['ids']
+        missing = find_missing(lookup)
+
+    if missing:
+        insert_cols = [name_col] + ([parent_col] if scoped else []) + list(extra or {})
+        rows = []
+        for (parent, name), i in missing.items():
+            row = {name_col: name}
+            if scoped:
+                row[parent_col] = parent
+            for col, values in (extra or {}).items():
+                row[col] = values.iloc[i]
+            rows.append(row)
+        conn.execute(
+            text(f"INSERT INTO {table} ({', '.join(insert_cols)}) "
+                 f"VALUES ({', '.join(':' + c for c in insert_cols)})"),
+            rows
+        )
+        lookup = cache.refresh(table, conn)['ids']
+        if created is not None:
+            created.append(table)
+
+    return pd.array([lookup.get(k) if k[1] is not None else None for k in keys], dtype="Int64")
+
+
+def _resolve_dimensions(conn, cache, frame):
+    """Проставляет id справочников для нормализованного фрейма импорта"""
+    created = []
+    frame['operation_type_id'] = _resolve_level(
+        conn, cache, 'operation_types', None, frame['operation_type']
+    )
+    frame['category_id'] = _resolve_level(
+        conn, cache, 'categories', None, frame['category'],
+        extra={'operation_type_id': frame['operation_type_id'].astype(object)}, created=created
+    )
+    frame['subcategory_id'] = _resolve_level(
+        conn, cache, 'subcategories', frame['category_id'].astype(object), frame['subcategory'], created=created
+    )
+    frame['group_id'] = _resolve_level(
+        conn, cache, 'groups', frame['subcategory_id'].astype(object), frame['group_name'], created=created
+    )
+    frame['subgroup_id'] = _resolve_level(
+        conn, cache, 'subgroups', frame['group_id'].astype(object), frame['subgroup'], created=created
+    )
+    frame['lesson_type_id'] = _resolve_level(
+        conn, cache, 'lesson_types', None, frame['lesson_type']
+    )
+    if created:
+        _refresh_dimension_tree(conn)
+    return frame
+
+
+# Ключ дневного агрегата; отсутствующие подкатегория/группа/подгруппа/тип занятия хранятся как 0
+ROLLUP_KEYS = [
+    'operation_date', 'operation_type_id', 'category_id',
+    'subcategory_id', 'group_id', 'subgroup_id', 'lesson_type_id'
+]
+
+# Уровни дерева справочников в порядке вложенности и имена их узлов
+TREE_LEVELS = ['category_id', 'subcategory_id', 'group_id', 'subgroup_id']
+TREE_NAMES = ['category', 'subcategory', 'group_name', 'subgroup']
+
+# Те же ключи, вычисленные из financial_operations
+ROLLUP_SOURCE_KEYS = (
+    "operation_date, operation_type_id, category_id, COALESCE(subcategory_id, 0), "
+    "COALESCE(group_id, 0), COALESCE(subgroup_id, 0), COALESCE(lesson_type_id, 0)"
+)
+
+
+def _upsert_rollup(conn, operations):
+    """
+    Добавляет операции (DataFrame с ROLLUP_KEYS и amount) к дневным агрегатам.
+    Вызывается в той же транзакции, что и вставка операций.
+    """
+    if operations.empty:
+        return
+    deltas = operations[ROLLUP_KEYS + ['amount']].copy()
+    for col in ROLLUP_KEYS[1:]:
+        deltas[col] = pd.to_numeric(deltas[col]).fillna(0).astype('int64')
+    deltas['amount'] = pd.to_numeric(deltas['amount'])
+    deltas = (
+        deltas.groupby(ROLLUP_KEYS)['amount']
+        .agg(total='sum', operations_count='count')
+        .reset_index()
+    )
+    deltas['operation_date'] = deltas['operation_date'].astype(str)
+    columns = ROLLUP_KEYS + ['total', 'operations_count']
+    conn.execute(
+        text(f'''
+            INSERT INTO operations_daily_rollup ({', '.join(columns)})
+            VALUES ({', '.join(':' + c for c in columns)})
+            ON CONFLICT ({', '.join(ROLLUP_KEYS)}) DO UPDATE SET
+                total = operations_daily_rollup.total + excluded.total,
+                operations_count = operations_daily_rollup.operations_count + excluded.operations_count
+        '''),
+        [{k: (v.item() if hasattr(v, 'item') else v) for k, v in row.items()}
+         for row in deltas.to_dict('records')]
+    )
+
+
+def _copy_frame(conn, table, frame):
+    """COPY DataFrame в таблицу PostgreSQL через CSV в памяти"""
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    with conn.connection.cursor() as cur:
+        cur.copy_expert(
+            f"COPY {table} ({', '.join(frame.columns)}) FROM STDIN WITH (FORMAT csv)",
+            buf
+        )
+
+
+def _reserve_operation_ids(conn, count):
+    """
+    Резервирует count id операций в текущей транзакции: nextval последовательности
+    в PostgreSQL, сдвиг sqlite_sequence в SQLite (запись в неё же берёт блокировку БД,
+    так что диапазон никто не займёт до фиксации). Возвращает id по возрастанию.
+    """
+    if _is_postgres(conn.engine):
+        return sorted(conn.execute(text(
+            "SELECT nextval(pg_get_serial_sequence('financial_operations', 'id')) FROM generate_series(1, :n)"
+        ), {"n": count}).scalars())
+    top = "(SELECT COALESCE(MAX(id), 0) FROM financial_operations)"
+    last = conn.execute(text(f"""
+        UPDATE sqlite_sequence SET seq = MAX(seq, {top}) + :n
+        WHERE name = 'financial_operations'
+        RETURNING seq
+    """), {"n": count}).scalar()
+    if last is None:
+        last = conn.execute(text(f"""
+            INSERT INTO sqlite_sequence (name, seq) VALUES ('financial_operations', {top} + :n)
+            RETURNING seq
+        """), {"n": count}).scalar()
+    return list(range(last - count + 1, last + 1))
+
+
+def _insert_operations(conn, records, table='financial_operations'):
+    """Пишет операции пакетом: COPY в PostgreSQL, executemany в SQLite"""
+    if records.empty:
+        return
+    if _is_postgres(conn.engine):
+        _copy_frame(conn, table, records)
+    else:
+        rows = records.astype(object).where(records.notna(), None).to_dict('records')
+        conn.execute(
+            text(f"INSERT INTO {table} ({', '.join(records.columns)}) "
+                 f"VALUES ({', '.join(':' + c for c in records.columns)})"),
+            rows
+        )
+
+
+# Поля отпечатка строки импорта: дата, тип, сумма, полный путь по справочникам и тип занятия
+FINGERPRINT_FIELDS = [
+    'operation_date', 'operation_type', 'amount', 'category',
+    'subcategory', 'group_name', 'subgroup', 'lesson_type'
+]
+
+
+def _fingerprint_keys(frame):
+    """Ключи строк для отпечатков: поля FINGERPRINT_FIELDS через разделитель"""
+    parts = frame[FINGERPRINT_FIELDS].copy()
+    parts['amount'] = pd.to_numeric(parts['amount']).map('{:.2f}'.format)
+    parts = parts.astype(object).where(parts.notna(), '').astype(str)
+    return parts[FINGERPRINT_FIELDS[0]].str.cat([parts[col] for col in FINGERPRINT_FIELDS[1:]], sep='\x1f')
+
+
+def _fingerprint_ordinals(keys, seen=None):
+    """Номер каждой строки среди строк с тем же ключом, с учётом seen (дополняется на месте)"""
+    ordinals = keys.groupby(keys, sort=False).cumcount()
+    if seen is not None:
+        ordinals += keys.map(seen).fillna(0).astype('int64')
+        for key, count in keys.value_counts(sort=False).items():
+            seen[key] = seen.get(key, 0) + count
+    return ordinals
+
+
+def _fingerprint_hash(key, n):
+    return hashlib.blake2b(f"{key}\x1f{n}".encode(), digest_size=16).hexdigest()
+
+
+def _fingerprint_hashes(keys, ordinals):
+    return pd.Series([_fingerprint_hash(key, n) for key, n in zip(keys, ordinals)], index=keys.index)
+
+
+def _fingerprints(frame, seen=None):
+    """
+    Отпечатки строк (blake2b, 32 hex-символа) по FINGERPRINT_FIELDS и номеру строки среди
+    одинаковых: две одинаковые операции в файле дают две записи, а повторная загрузка
+    того же файла — те же отпечатки. seen — {ключ: сколько таких строк уже было}
+    для сквозной нумерации по порциям одного файла; дополняется на месте.
+    """
+    keys = _fingerprint_keys(frame)
+    return _fingerprint_hashes(keys, _fingerprint_ordinals(keys, seen))
+
+
+def _find_fingerprints(conn, fingerprints, batch_size=1000):
+    """Какие из отпечатков уже есть в БД (в том числе записанные в текущей транзакции conn)"""
+    query = text(
+        "SELECT fingerprint FROM financial_operations WHERE fingerprint IN :fingerprints"
+    ).bindparams(bindparam("fingerprints", expanding=True))
+    fingerprints = list(fingerprints)
+    found = set()
+    for i in range(0, len(fingerprints), batch_size):
+        found.update(conn.execute(query, {"fingerprints": fingerprints[i:i + batch_size]}).scalars())
+    return found
+
+
+def _manual_fingerprints(conn, cache, frame):
+    """
+    Отпечатки операций add_operations (id справочников переводятся в имена, как в файле импорта).
+    Каждая строка получает первый свободный номер среди одинаковых: повторный ввод той же
+    операции не конфликтует с уже записанными, а импорт файла с ней распознаёт дубликат.
+    Занятые номера ищутся по индексу окнами, растущими вдвое.
+    """
+    named = frame[['operation_date', 'amount']].copy()
+    for col, table in OPERATION_DIMENSION_COLUMNS.items():
+        named[OPERATION_NAME_COLUMNS[col]] = frame[col].astype(object).map(cache.names(table, conn))
+    keys = _fingerprint_keys(named)
+
+    fingerprints = pd.Series(None, index=frame.index, dtype=object)
+    waiting = {key: list(rows) for key, rows in keys.groupby(keys, sort=False).groups.items()}
+    start = dict.fromkeys(waiting, 0)
+    width = 1
+    while waiting:
+        windows = {key: range(start[key], start[key] + len(rows) + width - 1) for key, rows in waiting.items()}
+        taken = _find_fingerprints(conn, [_fingerprint_hash(key, n) for key, ns in windows.items() for n in ns])
+        for key, ns in windows.items():
+            rows = waiting.pop(key)
+            free = [fp for fp in (_fingerprint_hash(key, n) for n in ns) if fp not in taken]
+            fingerprints.loc[rows[:len(free)]] = free[:len(rows)]
+            if len(free) < len(rows):
+                waiting[key] = rows[len(free):]
+                start[key] = ns.stop
+        width *= 2
+    return fingerprints
+
+
+IMPORT_STAGING_DDL = """
+    CREATE TEMP TABLE import_staging (
+        operation_date DATE,
+        operation_type_id INTEGER,
+        amount DECIMAL(15, 2),
+        category_id INTEGER,
+        subcategory_id INTEGER,
+        group_id INTEGER,
+        subgroup_id INTEGER,
+        lesson_type_id INTEGER,
+        fingerprint VARCHAR(32)
+    )
+"""
+
+
+def _insert_new_operations(conn, records):
+    """
+    Пишет операции с отпечатками, пропуская уже загруженные: пакет идёт во временную таблицу,
+    оттуда одним INSERT ... SELECT с ON CONFLICT (fingerprint) DO NOTHING. Пропускаются только
+    совпадения отпечатков: нарушения CHECK и NOT NULL откатывают транзакцию, как и без импорта
+    (INSERT OR IGNORE в SQLite молча проглотил бы и их).
+    Возвращает множество отпечатков действительно добавленных строк.
+    """
+    columns = ', '.join(records.columns)
+    conn.execute(text(IMPORT_STAGING_DDL))
+    _insert_operations(conn, records, table='import_staging')
+    # WHERE true: без него SQLite принимает ON CONFLICT за условие соединения в SELECT
+    added = set(conn.execute(text(
+        f"INSERT INTO financial_operations ({columns}) SELECT {columns} FROM import_staging WHERE true "
+        f"ON CONFLICT (fingerprint) DO NOTHING RETURNING fingerprint"
+    )).scalars())
+    conn.execute(text("DROP TABLE import_staging"))
+    return added
+
+
+def _report_rejected(rejected, label=None):
+    """Показывает отбракованные строки импорта (не больше пяти примеров)"""
+    if rejected.empty:
+        return
+    examples = "; ".join(f"строка {idx + 2} — {reason}" for idx, reason in rejected.head(5).items())
+    where = f" ({label})" if label else ""
+    notify_error(f"Ошибка при добавлении строк{where} ({len(rejected)} шт.): {examples}")
+
+
+def _store_import_frame(app, frame, dry_run=False, on_commit=None):
+    """
+    Пишет проверенные строки с отпечатками одной транзакцией, пропуская уже загруженные.
+    С dry_run только ищет отпечатки по индексу. Возвращает (новых, дубликатов).
+    on_commit(conn, новых, дубликатов) выполняется в той же транзакции (контрольная точка задачи).
+    """
+    if dry_run:
+        duplicates = int(frame['fingerprint'].isin(app.find_fingerprints(frame['fingerprint'])).sum())
+        if on_commit:
+            with app.begin() as conn:
+                on_commit(conn, len(frame) - duplicates, duplicates)
+        return len(frame) - duplicates, duplicates
+
+    try:
+        with app.begin() as conn:
+            frame = _resolve_dimensions(conn, app.dimensions, frame)
+            added = _insert_new_operations(conn, frame[OPERATION_COLUMNS + ['fingerprint']])
+            new = frame[frame['fingerprint'].isin(added)]
+            _upsert_rollup(conn, new)
+            if on_commit:
+                on_commit(conn, len(new), len(frame) - len(new))
+    except Exception:
+        # Кэш мог получить id из откатившейся транзакции
+        app.dimensions.invalidate()
+        raise
+
+    if not new.empty:
+        app.query_cache.invalidate(new['operation_date'].min(), new['operation_date'].max())
+    return len(new), len(frame) - len(new)
+
+
+def import_excel_to_db(app, df, dry_run=False, seen=None):
+    """
+    Импортирует данные из Excel в БД.
+    Добавляет новые категории / подкатегории / группы / подгруппы / типы занятий, если их нет.
+
+    Справочники берутся из кэша FinanceApp и сопоставляются в памяти, недостающие создаются
+    одним пакетом на уровень, операции пишутся одной транзакцией — число обращений
+    к БД не зависит от количества строк в файле.
+
+    Строки, чьи отпечатки (_fingerprints) уже есть в БД, пропускаются — повторная загрузка
+    файла ничего не удваивает. dry_run=True ничего не пишет, а только считает новые строки
+    и дубликаты поиском по индексу отпечатков. seen — см. _fingerprints.
+    Возвращает {'new': ..., 'duplicates': ..., 'rejected': ...}.
+    """
+    frame, rejected = _prepare_import_frame(df)
+    _report_rejected(rejected)
+    counts = {'new': 0, 'duplicates': 0, 'rejected': len(rejected)}
+    if frame.empty:
+        return counts
+
+    frame['fingerprint'] = _fingerprints(frame, seen)
+    counts['new'], counts['duplicates'] = _store_import_frame(app, frame, dry_run)
+    return counts
+
+
+# Размер порции потокового импорта (строк)
+IMPORT_CHUNK_SIZE = 5000
+
+
+def _csv_separator(file):
+    """Определяет разделитель CSV по первой строке файла"""
+    head = file.readline()
+    file.seek(0)
+    if isinstance(head, bytes):
+        head = head.decode('utf-8-sig', errors='ignore')
+    return ';' if head.count(';') > head.count(',') else ','
+
+
+def iter_file_chunks(file, file_name, chunk_size=IMPORT_CHUNK_SIZE, sheet=None):
+    """
+    Читает .xlsx (openpyxl read-only, лист sheet или активный) или .csv порциями по chunk_size строк.
+    Отдаёт пары (DataFrame, доля прочитанного файла от 0 до 1).
+    Индекс порции продолжает нумерацию строк файла, чтобы ошибки указывали на исходную строку.
+    """
+    offset = 0
+
+    if file_name.lower().endswith('.csv'):
+        size = getattr(file, 'size', None)
+        reader = pd.read_csv(
+            file, sep=_csv_separator(file), encoding='utf-8-sig', chunksize=chunk_size
+        )
+        for chunk in reader:
+            chunk.index = range(offset, offset + len(chunk))
+            offset += len(chunk)
+            progress = min(file.tell() / size, 1.0) if size else 0.0
+            yield chunk, progress
+        return
+
+    wb = load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet] if sheet is not None else wb.active
+        total = max((ws.max_row or 1) - 1, 1)
+        rows = ws.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else None for h in next(rows, ())]
+
+        batch = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            batch.append(row[:len(header)])
+            if len(batch) == chunk_size:
+                chunk = pd.DataFrame(batch, columns=header, index=range(offset, offset + len(batch)))
+                offset += len(batch)
+                batch = []
+                yield chunk, min(offset / total, 1.0)
+        if batch or offset == 0:
+            yield pd.DataFrame(batch, columns=header, index=range(offset, offset + len(batch))), 1.0
+    finally:
+        wb.close()
+
+
+def _open_import_source(source):
+    """Источник импорта: байты загруженного файла или путь к файлу"""
+    return io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+
+
+def _import_sheets(name, source):
+    """Листы файла импорта: все листы .xlsx, у .csv — один (None)"""
+    if name.lower().endswith('.csv'):
+        return [None]
+    with _open_import_source(source) as file:
+        wb = load_workbook(file, read_only=True)
+        try:
+            return wb.sheetnames
+        finally:
+            wb.close()
+
+
+def _iter_import_sheet(name, source, sheet, chunk_size, seen):
+    """
+    Разбирает и проверяет лист порциями: отдаёт (frame с отпечатками, rejected).
+    Одинаковые строки нумеруются в пределах листа (seen); сдвиг на строки
+    предыдущих листов делает писатель (_shift_fingerprints).
+    """
+    with _open_import_source(source) as file:
+        for chunk_no, (chunk, _) in enumerate(iter_file_chunks(file, name, chunk_size, sheet), start=1):
+            if chunk_no == 1 and not all(col in chunk.columns for col in IMPORT_COLUMNS):
+                raise ValueError("отсутствуют обязательные столбцы")
+            if chunk.empty:
+                continue
+            frame, rejected = _prepare_import_frame(chunk)
+            if not frame.empty:
+                frame['fingerprint_key'] = _fingerprint_keys(frame)
+                frame['fingerprint_n'] = _fingerprint_ordinals(frame['fingerprint_key'], seen)
+                frame['fingerprint'] = _fingerprint_hashes(frame['fingerprint_key'], frame['fingerprint_n'])
+            yield frame, rejected
+
+
+def _parse_import_sheet(name, path, sheet, chunk_size, spool):
+    """
+    Задача пула процессов: разбирает лист порциями и сразу сбрасывает каждую в файл
+    каталога spool, не собирая лист в памяти. Возвращает ([файлы порций], {ключ: число строк}).
+    """
+    seen = {}
+    parts = []
+    for batch in _iter_import_sheet(name, path, sheet, chunk_size, seen):
+        fd, part = tempfile.mkstemp(suffix='.pkl', dir=spool)
+        os.close(fd)
+        pd.to_pickle(batch, part)
+        parts.append(part)
+    return parts, seen
+
+
+def _read_spooled(parts):
+    """Порции листа из файлов _parse_import_sheet — по одной; прочитанный файл удаляется"""
+    for part in parts:
+        batch = pd.read_pickle(part)
+        os.remove(part)
+        yield batch
+
+
+def _spool_sources(units, spool):
+    """
+    Заменяет байты загруженных файлов путями: каждый файл пишется в spool один раз,
+    и воркерам передаётся путь, а не копия содержимого на каждый лист.
+    """
+    paths = {}
+    spooled = []
+    for name, source, sheet in units:
+        if isinstance(source, bytes):
+            if id(source) not in paths:
+                fd, paths[id(source)] = tempfile.mkstemp(dir=spool)
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(source)
+            source = paths[id(source)]
+        spooled.append((name, source, sheet))
+    return spooled
+
+
+def _shift_fingerprints(frame, seen):
+    """
+    Продолжает нумерацию одинаковых строк листа после строк предыдущих листов и файлов (seen):
+    отпечатки пересчитываются только у строк, чей ключ уже встречался.
+    """
+    shift = frame['fingerprint_key'].map(seen)
+    shifted = shift.notna()
+    if shifted.any():
+        frame.loc[shifted, 'fingerprint'] = _fingerprint_hashes(
+            frame.loc[shifted, 'fingerprint_key'],
+            frame.loc[shifted, 'fingerprint_n'] + shift[shifted].astype('int64')
+        )
+
+
+def _import_pool(workers):
+    """Общий пул процессов разбора файлов (spawn: сервер Streamlit многопоточный)"""
+    return _get_shared('import_pool', None, lambda: ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    ))
+
+
+def import_files(app, files, chunk_size=IMPORT_CHUNK_SIZE, on_progress=None, dry_run=False, workers=None,
+                 job=None):
+    """
+    Импорт нескольких файлов .xlsx/.csv со всеми листами. files — список пар (имя, байты или путь).
+
+    Листы читаются и проверяются параллельно в пуле процессов (IMPORT_WORKERS, по умолчанию
+    по числу ядер), а записывает их один писатель — в порядке файлов и листов, порциями
+    через import-транзакции с общим кэшем справочников. Воркеры получают путь к файлу
+    (загруженные байты сначала пишутся во временный каталог) и сбрасывают разобранные
+    порции туда же, а писатель читает их по одной, так что в памяти с обеих сторон
+    не больше порции в chunk_size строк. Вперёд разбирается не больше workers + 1 листов.
+    Если лист один или процесс один, лист разбирается здесь же потоково.
+
+    Одинаковые строки нумеруются сквозь все файлы, поэтому повторная загрузка того же набора
+    ничего не удваивает. Листы без обязательных столбцов и нечитаемые файлы пропускаются.
+    on_progress(done, total, label, totals) вызывается после каждой записанной порции.
+
+    job — ImportJob: счётчики и контрольная точка пишутся в import_jobs в той же транзакции,
+    что и порция, а импорт продолжается с записанной точки. Листы и порции до неё
+    разбираются заново только ради сквозной нумерации одинаковых строк, но не пишутся.
+    Возвращает {'new', 'duplicates', 'rejected', 'sheets', 'skipped': [причины]}.
+    """
+    workers = workers or int(get_setting("IMPORT_WORKERS", os.cpu_count() or 1))
+    if job is not None:
+        totals, resume, report = job.totals, job.position, job.report
+    else:
+        totals = {'new': 0, 'duplicates': 0, 'rejected': 0, 'sheets': 0, 'skipped': []}
+        resume, report = (0, 0), _report_rejected
+
+    units = []
+    for name, source in files:
+        try:
+            units += [(name, source, sheet) for sheet in _import_sheets(name, source)]
+        except Exception as e:
+            if resume == (0, 0):
+                totals['skipped'].append(f"{name}: {e}")
+
+    pool = _import_pool(workers) if workers > 1 and len(units) > 1 else None
+    spool = None
+    if pool:
+        spool = tempfile.mkdtemp(prefix="fin_import_")
+        units = _spool_sources(units, spool)
+    queued = iter(units)
+    pending = deque()
+
+    def submit():
+        unit = next(queued, None)
+        if unit is not None:
+            pending.append((unit, pool.submit(_parse_import_sheet, *unit, chunk_size, spool) if pool else None))
+
+    def checkpoint(position, conn=None, new=0, duplicates=0):
+        if job is None:
+            return
+        saved = dict(totals, new=totals['new'] + new, duplicates=totals['duplicates'] + duplicates)
+        if conn is not None:
+            job.save(conn, position, saved)
+        else:
+            with app.begin() as conn:
+                job.save(conn, position, saved)
+
+    for _ in range(workers + 1 if pool else 1):
+        submit()
+
+    seen = {}
+    unit_no = -1
+    try:
+        while pending:
+            (name, source, sheet), future = pending.popleft()
+            unit_no += 1
+            submit()
+            label = name if sheet is None else f"{name} / {sheet}"
+            sheet_seen = {}
+            try:
+                if future is not None:
+                    parts, sheet_seen = future.result()
+                    batches = _read_spooled(parts)
+                else:
+                    batches = _iter_import_sheet(name, source, sheet, chunk_size, sheet_seen)
+                for chunk_no, (frame, rejected) in enumerate(batches):
+                    if (unit_no, chunk_no) < resume:
+                        continue
+                    report(rejected, label)
+                    totals['rejected'] += len(rejected)
+                    position = (unit_no, chunk_no + 1)
+                    if not frame.empty:
+                        _shift_fingerprints(frame, seen)
+                        new, duplicates = _store_import_frame(
+                            app, frame, dry_run,
+                            on_commit=lambda conn, new, duplicates: checkpoint(position, conn, new, duplicates)
+                        )
+                        totals['new'] += new
+                        totals['duplicates'] += duplicates
+                    else:
+                        checkpoint(position)
+                    if on_progress:
+                        on_progress(totals['sheets'], len(units), label, totals)
+            except ValueError as e:
+                if unit_no >= resume[0]:
+                    totals['skipped'].append(f"{label}: {e}")
+                    checkpoint((unit_no + 1, 0))
+                continue
+            for key, count in sheet_seen.items():
+                seen[key] = seen.get(key, 0) + count
+            if unit_no >= resume[0]:
+                totals['sheets'] += 1
+                checkpoint((unit_no + 1, 0))
+    finally:
+        for _, future in pending:
+            if future is not None:
+                future.cancel()
+        if spool:
+            shutil.rmtree(spool, ignore_errors=True)
+
+    if on_progress:
+        on_progress(totals['sheets'], len(units), None, totals)
+    return totals
+
+# === Фоновые задачи импорта ===
+
+# Примеров отбракованных строк, сохраняемых в задаче
+IMPORT_JOB_ERRORS = 20
+
+# Период обновления виджета прогресса фоновых задач (секунды)
+IMPORT_PROGRESS_EVERY = 1.0
+
+
+def _import_jobs_dir():
+    """Каталог файлов, загруженных через браузер: хранятся до завершения задачи, чтобы её можно было продолжить"""
+    return get_setting("IMPORT_JOBS_DIR", os.path.join(tempfile.gettempdir(), "fin_dash_imports"))
+
+
+def _count_import_rows(name, path):
+    """Примерное число строк данных во всех листах файла (для оценки оставшегося времени)"""
+    if name.lower().endswith('.csv'):
+        with open(path, 'rb') as file:
+            lines = sum(block.count(b'\n') for block in iter(lambda: file.read(1 << 20), b''))
+        return max(lines - 1, 0)
+    wb = load_workbook(path, read_only=True)
+    try:
+        return sum(max((ws.max_row or 1) - 1, 0) for ws in wb.worksheets)
+    finally:
+        wb.close()
+
+
+def create_import_job(app, files, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False):
+    """
+    Ставит импорт в очередь import_jobs. files — пары (имя, байты или путь); байты загруженных
+    файлов сохраняются в IMPORT_JOBS_DIR, пути запоминаются как есть. Возвращает id задачи.
+    """
+    sources, rows_total, folder = [], 0, None
+    for n, (name, source) in enumerate(files):
+        if isinstance(source, bytes):
+            if folder is None:
+                os.makedirs(_import_jobs_dir(), exist_ok=True)
+                folder = tempfile.mkdtemp(prefix="job_", dir=_import_jobs_dir())
+            path = os.path.join(folder, f"{n}_{os.path.basename(name)}")
+            with open(path, 'wb') as file:
+                file.write(source)
+        else:
+            path = os.path.abspath(source)
+        sources.append([name, path])
+        try:
+            rows_total += _count_import_rows(name, path)
+        except Exception:
+            pass  # нечитаемый файл импорт пропустит с причиной
+
+    with app.begin() as conn:
+        return conn.execute(text("""
+            INSERT INTO import_jobs (sources, dry_run, chunk_size, rows_total)
+            VALUES (:sources, :dry_run, :chunk_size, :rows_total)
+            RETURNING id
+        """), {
+            "sources": json.dumps(sources, ensure_ascii=False), "dry_run": bool(dry_run),
+            "chunk_size": int(chunk_size), "rows_total": rows_total,
+        }).scalar()
+
+
+class ImportJob:
+    """Задача импорта из import_jobs: исходные файлы, счётчики и контрольная точка для import_files"""
+
+    def __init__(self, app, job_id):
+        with app.begin() as conn:
+            row = conn.execute(
+                text("SELECT * FROM import_jobs WHERE id = :id"), {"id": job_id}
+            ).mappings().one()
+        messages = json.loads(row['messages'] or '{}')
+        self.id = job_id
+        self.sources = [tuple(source) for source in json.loads(row['sources'])]
+        self.dry_run = bool(row['dry_run'])
+        self.chunk_size = row['chunk_size']
+        # (номер листа, записанных порций листа): всё до этой точки уже зафиксировано в БД
+        self.position = (row['checkpoint_unit'], row['checkpoint_chunk'])
+        self.totals = {
+            'new': row['new_rows'], 'duplicates': row['duplicates'], 'rejected': row['rejected'],
+            'sheets': row['sheets'], 'skipped': messages.get('skipped', []),
+        }
+        self.errors = messages.get('errors', [])
+
+
+    def report(self, rejected, label=None):
+        """Запоминает примеры отбракованных строк (не больше IMPORT_JOB_ERRORS) вместо вывода на экран"""
+        room = IMPORT_JOB_ERRORS - len(self.errors)
+        if room > 0:
+            self.errors += [f"{label}: строка {idx + 2} — {reason}" for idx, reason in rejected.head(room).items()]
+
+
+    def save(self, conn, position, totals):
+        """Контрольная точка и счётчики; вызывается в транзакции записанной порции"""
+        conn.execute(text("""
+            UPDATE import_jobs SET
+                checkpoint_unit = :unit, checkpoint_chunk = :chunk,
+                rows_done = :rows_done, new_rows = :new, duplicates = :duplicates,
+                rejected = :rejected, sheets = :sheets, messages = :messages,
+                heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = :id
+        """), {
+            "id": self.id, "unit": position[0], "chunk": position[1],
+            "rows_done": totals['new'] + totals['duplicates'] + totals['rejected'],
+            "new": totals['new'], "duplicates": totals['duplicates'],
+            "rejected": totals['rejected'], "sheets": totals['sheets'],
+            "messages": json.dumps({'skipped': totals['skipped'], 'errors': self.errors}, ensure_ascii=False),
+        })
+
+
+    @contextmanager
+    def heartbeat(self, app):
+        """
+        Пока выполняется блок, отдельный поток обновляет отметку жизни каждые IMPORT_JOB_STALE / 3
+        секунд — независимо от записи порций: долгий разбор листа не выглядит зависанием,
+        и задачу не берёт второй процесс.
+        """
+        every = _stale_seconds() / 3
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(every):
+                try:
+                    with app.begin() as conn:
+                        conn.execute(text("""
+                            UPDATE import_jobs SET heartbeat_at = CURRENT_TIMESTAMP
+                            WHERE id = :id AND status = 'running'
+                        """), {"id": self.id})
+                except Exception:
+                    logging.getLogger("fin_dash.import").exception("Не удалось обновить отметку жизни задачи импорта")
+
+        thread = threading.Thread(target=beat, name=f"fin_dash_import_heartbeat_{self.id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+
+def _stale_seconds():
+    """Через сколько секунд без отметки жизни задача считается зависшей (IMPORT_JOB_STALE)"""
+    return int(get_setting("IMPORT_JOB_STALE", 300))
+
+
+def _stale_cutoff(conn):
+    """Момент, раньше которого отметка жизни задачи считается потерянной (IMPORT_JOB_STALE секунд)"""
+    stale = _stale_seconds()
+    if _is_postgres(conn.engine):
+        return f"CURRENT_TIMESTAMP - interval '{stale} seconds'"
+    return f"datetime('now', '-{stale} seconds')"
+
+
+def claim_import_job(app, job_id=None):
+    """
+    Берёт задачу в работу: первую из очереди либо «зависшую» — в статусе running без отметки
+    жизни дольше IMPORT_JOB_STALE секунд (процесс упал или перезапущен). С job_id берёт эту
+    задачу, в том числе прерванную (failed). Возвращает id или None, если брать нечего
+    или задачу уже взял другой процесс.
+    """
+    with app.begin() as conn:
+        states = ["status = 'queued'", f"(status = 'running' AND heartbeat_at < {_stale_cutoff(conn)})"]
+        if job_id is None:
+            job_id = conn.execute(
+                text(f"SELECT id FROM import_jobs WHERE {' OR '.join(states)} ORDER BY id LIMIT 1")
+            ).scalar()
+            if job_id is None:
+                return None
+        else:
+            states.append("status = 'failed'")
+        claimed = conn.execute(text(f"""
+            UPDATE import_jobs SET
+                status = 'running', error = NULL, resumed_rows = rows_done,
+                started_at = CURRENT_TIMESTAMP, heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = :id AND ({' OR '.join(states)})
+        """), {"id": job_id}).rowcount
+    return job_id if claimed else None
+
+
+def run_import_job(app, job_id, workers=None, on_progress=None):
+    """
+    Выполняет взятую задачу (claim_import_job) с её контрольной точки, обновляя отметку жизни
+    по таймеру (ImportJob.heartbeat). При ошибке или прерывании задача получает статус failed
+    и её можно продолжить; после успеха сохранённые загрузки удаляются. Возвращает счётчики import_files.
+    """
+    job = ImportJob(app, job_id)
+    try:
+        with job.heartbeat(app):
+            totals = import_files(
+                app, job.sources, job.chunk_size, on_progress=on_progress, dry_run=job.dry_run,
+                workers=workers, job=job
+            )
+    except BaseException as e:
+        with app.begin() as conn:
+            conn.execute(
+                text("UPDATE import_jobs SET status = 'failed', error = :error WHERE id = :id"),
+                {"id": job_id, "error": str(e) or type(e).__name__}
+            )
+        raise
+    with app.begin() as conn:
+        conn.execute(
+            text("UPDATE import_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = :id"),
+            {"id": job_id}
+        )
+    uploads = os.path.join(os.path.abspath(_import_jobs_dir()), '')
+    for folder in {os.path.dirname(path) for _, path in job.sources if path.startswith(uploads)}:
+        shutil.rmtree(folder, ignore_errors=True)
+    return totals
+
+
+def requeue_import_job(app, job_id):
+    """Возвращает прерванную задачу в очередь: воркер продолжит её с контрольной точки"""
+    with app.begin() as conn:
+        conn.execute(
+            text("UPDATE import_jobs SET status = 'queued', error = NULL WHERE id = :id AND status = 'failed'"),
+            {"id": job_id}
+        )
+
+
+def list_import_jobs(app, job_ids=(), statuses=(), limit=20):
+    """
+    Задачи импорта (последние limit; с job_ids/statuses — только эти) со скоростью
+    rows_per_sec по текущему запуску, оценкой оставшегося времени eta_sec и долей progress.
+    """
+    conditions, params = [], {"limit": limit}
+    if job_ids:
+        conditions.append("id IN :ids")
+        params["ids"] = [int(job_id) for job_id in job_ids]
+    if statuses:
+        conditions.append("status IN :statuses")
+        params["statuses"] = list(statuses)
+    query = text(f"""
+        SELECT id, status, sources, dry_run, rows_total, rows_done, resumed_rows, new_rows,
+               duplicates, rejected, sheets, messages, error, created_at, started_at,
+               heartbeat_at, finished_at
+        FROM import_jobs
+        {"WHERE " + " OR ".join(conditions) if conditions else ""}
+        ORDER BY id DESC
+        LIMIT :limit
+    """)
+    for name in ("ids", "statuses"):
+        if name in params:
+            query = query.bindparams(bindparam(name, expanding=True))
+    conn = app.get_connection()
+    df = pd.read_sql(query, conn, params=params)
+    conn.close()
+
+    for col in ('created_at', 'started_at', 'heartbeat_at', 'finished_at'):
+        df[col] = pd.to_datetime(df[col])
+    elapsed = (df['heartbeat_at'] - df['started_at']).dt.total_seconds()
+    df['rows_per_sec'] = ((df['rows_done'] - df['resumed_rows']) / elapsed.where(elapsed > 0)).fillna(0.0)
+    remaining = (df['rows_total'] - df['rows_done']).clip(lower=0)
+    df['eta_sec'] = remaining / df['rows_per_sec'].where(df['rows_per_sec'] > 0)
+    df['progress'] = (df['rows_done'] / df['rows_total'].where(df['rows_total'] > 0)).clip(upper=1.0).fillna(0.0)
+    df['files'] = df['sources'].map(lambda sources: ", ".join(name for name, _ in json.loads(sources)))
+    messages = df['messages'].map(lambda m: json.loads(m or '{}'))
+    df['skipped'] = messages.map(lambda m: m.get('skipped', []))
+    df['errors'] = messages.map(lambda m: m.get('errors', []))
+    return df.drop(columns=['sources', 'messages'])
+
+
+class ImportWorker:
+    """
+    Фоновый поток импорта, один на процесс и БД: по очереди выполняет задачи import_jobs
+    и подхватывает зависшие после перезапуска. wake() будит поток сразу после постановки задачи,
+    иначе очередь проверяется раз в IMPORT_JOB_POLL секунд.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.poll = float(get_setting("IMPORT_JOB_POLL", 5))
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="fin_dash_import", daemon=True)
+        self.thread.start()
+
+
+    def wake(self):
+        self.event.set()
+
+
+    def run(self):
+        while True:
+            try:
+                job_id = claim_import_job(self.app)
+                if job_id is not None:
+                    run_import_job(self.app, job_id)
+                    continue
+            except Exception:
+                logging.getLogger("fin_dash.import").exception("Фоновая задача импорта прервана")
+            self.event.wait(self.poll)
+            self.event.clear()
+
+
+def import_worker(app):
+    """Фоновый воркер импорта для БД приложения (запускается при первом обращении)"""
+    return _get_shared('import_worker', app.db_url, lambda: ImportWorker(app))
+
+# === Выгрузка журнала ===
+
+# Колонки журнала и их заголовки в таблице и выгрузках
+JOURNAL_COLUMNS = {
+    'operation_date': 'Дата',
+    'operation_type': 'Тип',
+    'category': 'Категория',
+    'subcategory': 'Подкатегория',
+    'group_name': 'Группа',
+    'subgroup': 'Подгруппа',
+    'lesson_type': 'Тип занятия',
+    'amount': 'Сумма',
+    'comment': 'Комментарий',
+    'created_at': 'Создано',
+}
+
+
+def _journal_rows(chunks):
+    """Порции строк iter_journal, урезанные до JOURNAL_COLUMNS в их порядке"""
+    keys = next(chunks)
+    project = operator.itemgetter(*(keys.index(col) for col in JOURNAL_COLUMNS))
+    for rows in chunks:
+        yield list(map(project, rows))
+
+
+def _write_csv(file, chunks):
+    file.write(codecs.BOM_UTF8)  # чтобы Excel узнал UTF-8
+    writer_file = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    writer = csv.writer(writer_file)
+    writer.writerow(JOURNAL_COLUMNS.values())
+    count = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        count += len(rows)
+    writer_file.flush()
+    writer_file.detach()
+    return count
+
+
+def _write_xlsx(file, chunks):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Журнал")
+    ws.append(list(JOURNAL_COLUMNS.values()))
+    count = 0
+    for rows in chunks:
+        for row in rows:
+            ws.append(row)
+        count += len(rows)
+    wb.save(file)
+    return count
+
+
+def _journal_parquet_schema():
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError("для выгрузки в Parquet нужен пакет pyarrow")
+    return pa.schema([
+        ('Дата', pa.date32()),
+        ('Тип', pa.string()),
+        ('Категория', pa.string()),
+        ('Подкатегория', pa.string()),
+        ('Группа', pa.string()),
+        ('Подгруппа', pa.string()),
+        ('Тип занятия', pa.string()),
+        ('Сумма', pa.float64()),
+        ('Комментарий', pa.string()),
+        ('Создано', pa.timestamp('us')),
+    ])
+
+
+def _write_parquet(file, chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _journal_parquet_schema()
+    count = 0
+    with pq.ParquetWriter(file, schema) as writer:
+        for rows in chunks:
+            columns = list(zip(*rows))
+            arrays = []
+            for field, values in zip(schema, columns):
+                if field.type == pa.date32():
+                    values = pd.to_datetime(pd.Series(values, dtype=object), format='ISO8601').dt.date
+                elif pa.types.is_timestamp(field.type):
+                    values = pd.to_datetime(pd.Series(values, dtype=object), format='ISO8601')
+                    if values.dt.tz is not None:
+                        values = values.dt.tz_convert(None)
+                elif field.type == pa.float64():
+                    values = pd.to_numeric(pd.Series(values, dtype=object)).astype('float64')
+                arrays.append(pa.array(values, type=field.type, from_pandas=True))
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            count += len(rows)
+    return count
+
+
+def _write_parquet_batches(file, batches):
+    """Parquet из батчей Arrow журнала (iter_journal_batches): колонки JOURNAL_COLUMNS, без строк Python"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _journal_parquet_schema()
+    count = 0
+    with pq.ParquetWriter(file, schema) as writer:
+        for batch in batches:
+            columns = [batch.column(name) for name in JOURNAL_COLUMNS]
+            writer.write_table(pa.Table.from_arrays(columns, names=schema.names).cast(schema))
+            count += batch.num_rows
+    return count
 
-st.title("🔗 Проверка подключения к Supabase")
 
-try:
-    engine = create_engine(
-        st.secrets["DB_URL"],
-        connect_args={"sslmode": "require"},
-        pool_pre_ping=True
-    )
-    with engine.connect() as conn:
-        res = conn.execute(text("SELECT NOW()")).fetchone()
-        st.success(f"✅ Подключение успешно! Текущее время: {res[0]}")
-except Exception as e:
-    st.error(f"❌ Ошибка подключения: {e}")
-
-# with sqlite3.connect('millimon_finsnce.db') as db:
-#     cur = db.cursor()
-#     cur.execute("PRAGMA foreign_keys = ON")
-#
-#     # Таблица вида финансов
-#     cur.execute('''
-#     CREATE TABLE IF NOT EXISTS operation_types (
-#         id_operation INTEGER PRIMARY KEY AUTOINCREMENT,
-#         name_operation VARCHAR(10) NOT NULL UNIQUE CHECK (name_operation IN ('доход', 'расход')),
-#         description TEXT
-#     )
-#     ''')
-#
-#     # 2. Таблица категорий (теперь ссылается на тип операции)
-#     cur.execute('''
-#     CREATE TABLE IF NOT EXISTS categories (
-#         id_categories INTEGER PRIMARY KEY AUTOINCREMENT,
-#         operation_type_id INTEGER NOT NULL,
-#         name VARCHAR(100) NOT NULL UNIQUE,
-#         description TEXT,
-#         FOREIGN KEY (operation_type_id) REFERENCES operation_types(id_operation) ON DELETE CASCADE
-#     )
-#     ''')
-#
-#     # 3. Таблица подкатегорий
-#     cur.execute('''
-#         CREATE TABLE IF NOT EXISTS subcategories (
-#             id_subcategories INTEGER PRIMARY KEY AUTOINCREMENT,
-#             category_id INTEGER NOT NULL,
-#             name VARCHAR(100) NOT NULL,
-#             description TEXT,
-#             UNIQUE (category_id, name),
-#             FOREIGN KEY (category_id) REFERENCES categories(id_categories) ON DELETE CASCADE
-#         )
-#         ''')
-#
-#     # 4. Таблица групп
-#     cur.execute('''
-#         CREATE TABLE IF NOT EXISTS groups (
-#             id_groups INTEGER PRIMARY KEY AUTOINCREMENT,
-#             subcategory_id INTEGER NOT NULL,
-#             name VARCHAR(100) NOT NULL,
-#             description TEXT,
-#             UNIQUE (subcategory_id, name),
-#             FOREIGN KEY (subcategory_id) REFERENCES subcategories(id_subcategories) ON DELETE CASCADE
-#         )
-#         ''')
-#
-#     # 5. Таблица подгрупп
-#     cur.execute('''
-#         CREATE TABLE IF NOT EXISTS subgroups (
-#             id_subgroups INTEGER PRIMARY KEY AUTOINCREMENT,
-#             group_id INTEGER NOT NULL,
-#             name VARCHAR(100) NOT NULL,
-#             description TEXT,
-#             UNIQUE (group_id, name),
-#             FOREIGN KEY (group_id) REFERENCES groups(id_groups) ON DELETE CASCADE
-#         )
-#         ''')
-#
-#     # 6. Таблица финансовых операций
-#     cur.execute('''
-#        CREATE TABLE IF NOT EXISTS financial_operations (
-#            id INTEGER PRIMARY KEY AUTOINCREMENT,
-#            operation_date DATE NOT NULL,
-#            operation_type_id INTEGER NOT NULL,
-#            amount DECIMAL(15, 2) NOT NULL CHECK (amount >= 0),
-#            category_id INTEGER NOT NULL,
-#            subcategory_id INTEGER,
-#            group_id INTEGER,
-#            subgroup_id INTEGER,
-#            comment TEXT,
-#            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-#            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-#            FOREIGN KEY (operation_type_id) REFERENCES operation_types(id_operation),
-#            FOREIGN KEY (category_id) REFERENCES categories(id_categories),
-#            FOREIGN KEY (subcategory_id) REFERENCES subcategories(id_subcategories),
-#            FOREIGN KEY (group_id) REFERENCES groups(id_groups),
-#            FOREIGN KEY (subgroup_id) REFERENCES subgroups(id_subgroups)
-#        )
-#        ''')
-#
-#
-#
-#
-#     # Триггер для обновления времени
-#     cur.execute('''
-#         CREATE TRIGGER IF NOT EXISTS update_operations_timestamp
-#         AFTER UPDATE ON financial_operations
-#         FOR EACH ROW
-#         BEGIN
-#             UPDATE financial_operations SET updated_at = CURRENT_TIMESTAMP WHERE id = OLD.id;
-#         END
-#         ''')
+# Формат выгрузки -> (запись в файл, MIME-тип, расширение)
+EXPORT_FORMATS = {
+    'CSV': (_write_csv, 'text/csv', 'csv'),
+    'XLSX': (_write_xlsx, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx'),
+    'Parquet': (_write_parquet, 'application/vnd.apache.parquet', 'parquet'),
+}
 
-class FinanceApp:
 
-    def __init__(self, db_url=None):
-        if db_url is None:
-            # Streamlit Cloud: st.secrets
-            try:
-                db_url = st.secrets["DB_URL"]
-            except Exception:
-                db_url = os.getenv("DB_URL")
-        if not db_url:
-            raise RuntimeError("DB_URL не задан")
-            # Подключаемся с sslmode (Supabase)
-        self.engine = create_engine(db_url, connect_args={"sslmode": "require"})
+def export_journal(app, file, fmt, chunk_size=None, **filters):
+    """
+    Выгружает весь отфильтрованный журнал в двоичный файл file в формате fmt (см. EXPORT_FORMATS).
+    Строки идут из курсора БД порциями по chunk_size прямо в файл, не собираясь в DataFrame;
+    Parquet из PostgreSQL при arrow_fetch пишется батчами Arrow из COPY (iter_journal_batches).
+    Возвращает число выгруженных строк.
+    """
+    write = EXPORT_FORMATS[fmt][0]
+    with perf_section(f"export.{fmt}") as entry:
+        if fmt == 'Parquet' and app.arrow_fetch and _is_postgres(app.engine):
+            # Колоночный путь: батчи Arrow из COPY сразу в Parquet
+            count = _write_parquet_batches(file, app.iter_journal_batches(**filters))
+        else:
+            count = write(file, _journal_rows(app.iter_journal(chunk_size=chunk_size, **filters)))
+        if entry is not None:
+            entry["rows"] = count
+    return count
 
 
-    def get_connection(self):
-        # """Устанавливает соединение с базой данных"""
-        # conn = sqlite3.connect(self.db_name)
-        # conn.execute("PRAGMA foreign_keys = ON")
-        # return conn
-        """Возвращает SQLAlchemy connection (использовать с pandas.read_sql и .execute)"""
-        return self.engine.connect()
+# === Данные панелей дашборда (без отрисовки) ===
 
+def _lttb_indices(x, y, points):
+    """
+    Номера точек, отобранных Largest-Triangle-Three-Buckets: первая, последняя и по одной из
+    каждой корзины — та, что образует наибольший треугольник с предыдущей отобранной точкой
+    и средним следующей корзины. Пики и провалы сохраняются, форма кривой не меняется.
+    """
+    n = len(y)
+    if points >= n or points < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    selected = np.empty(points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for i in range(points - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        selected[i + 1] = a
+    return selected
 
-    def get_operation_types(self):
-        """Получает список всех типов операций"""
-        conn = self.get_connection()
-        df = pd.read_sql("SELECT id_operation, name_operation, description FROM operation_types", conn)
-        conn.close()
+
+def downsample_series(df, columns, x=None, points=None):
+    """
+    Прореживает временной ряд до бюджета точек (CHART_POINTS) перед отрисовкой: объём графика
+    в браузере и время отрисовки не растут с длиной периода. Каждая колонка из columns прореживается
+    LTTB по оси x (колонка или индекс), в результат идут строки, отобранные хотя бы для одной колонки.
+    """
+    points = int(points or get_setting("CHART_POINTS", 1000))
+    if len(df) <= points:
         return df
+    axis = df.index if x is None else df[x]
+    if pd.api.types.is_datetime64_any_dtype(axis):
+        axis = axis.astype('int64').to_numpy(dtype=float)
+    elif pd.api.types.is_numeric_dtype(axis):
+        axis = np.asarray(axis, dtype=float)
+    else:
+        axis = np.arange(len(df), dtype=float)
+    keep = np.unique(np.concatenate([
+        _lttb_indices(axis, df[column].to_numpy(dtype=float), points) for column in columns
+    ]))
+    return df.iloc[keep]
 
 
-    def get_categories(self, operation_type_id=None):
-        """Получает список категорий"""
-        conn = self.get_connection()
-        if operation_type_id:
-            query = "SELECT id_categories, name FROM categories WHERE operation_type_id = ?"
-            df = pd.read_sql(query, conn, params=(int(operation_type_id),))
-        else:
-            df = pd.read_sql("SELECT id_categories, name, operation_type_id FROM categories", conn)
-        conn.close()
-        return df
+@timed("load_kpis")
+def load_kpis(app, start_date, end_date):
+    """Ключевые метрики: доходы, расходы, прибыль, число операций и сводка по категориям"""
+    summary = app.get_financial_summary(start_date, end_date)
+    total_income = summary.loc[summary['operation_type'] == 'доход', 'total'].sum()
+    total_expense = summary.loc[summary['operation_type'] == 'расход', 'total'].sum()
+    return {
+        'summary': summary,
+        'total_income': total_income,
+        'total_expense': total_expense,
+        'profit': total_income - total_expense,
+        'operations_count': int(summary['operations_count'].sum()),
+    }
 
 
-    def get_subcategories(self, category_id):
-        """Получает список подкатегорий для категории"""
-        conn = self.get_connection()
-        query = "SELECT id_subcategories, name FROM subcategories WHERE category_id = ?"
-        df = pd.read_sql(query, conn, params=(category_id,))
-        conn.close()
-        return df
+@timed("load_dynamics")
+def load_dynamics(app, start_date, end_date):
+    """
+    Суммы по корзинам времени: корзина (день … квартал) выбирается по длине периода,
+    строки — корзины без пропусков, колонки — типы операций. Не прореживается: корзин
+    порядка CHART_BUCKETS, это меньше бюджета точек графика (CHART_POINTS).
+    """
+    bucket = choose_bucket(start_date, end_date)
+    dynamics = app.get_dynamics(start_date, end_date, bucket)
+    return dynamics.pivot(index='bucket', columns='operation_type', values='total'), bucket
 
 
-    def add_operation(self, operation_data):
-        """Добавляет новую финансовую операцию (operation_data — tuple)"""
-        # operation_data: (operation_date, type_id, amount, category_id, subcat_id, group_id, subgroup_id, comment, lesson_type_id?)
-        insert_sql = text('''
-            INSERT INTO financial_operations
-            (operation_date, operation_type_id, amount, category_id, subcategory_id, group_id, subgroup_id, comment, lesson_type_id)
-            VALUES (:operation_date, :operation_type_id, :amount, :category_id, :subcategory_id, :group_id, :subgroup_id, :comment, :lesson_type_id)
-        ''')
-        params = {
-            "operation_date": operation_data[0],
-            "operation_type_id": operation_data[1],
-            "amount": operation_data[2],
-            "category_id": operation_data[3],
-            "subcategory_id": operation_data[4],
-            "group_id": operation_data[5],
-            "subgroup_id": operation_data[6],
-            "comment": operation_data[7],
-            "lesson_type_id": operation_data[8] if len(operation_data) > 8 else None
-        }
-        try:
-            with self.engine.begin() as conn:
-                conn.execute(insert_sql, params)
-            return True
-        except Exception as e:
-            st.error(f"Ошибка при добавлении операции: {e}")
-            return False
+def tree_slice(totals, operation_type, level, lesson_type=None, by_lesson_type=False, **names):
+    """
+    Узлы уровня level из итогов get_tree_totals — выборка из готового результата, без БД.
+    lesson_type — строки одного типа занятия, by_lesson_type — строки всех типов занятий
+    по отдельности, иначе итоги по всем типам. names — фильтры по именам предков (category='Урок').
+    """
+    rows = totals[(totals['operation_type'] == operation_type) & (totals['level'] == level)]
+    if lesson_type is not None:
+        rows = rows[rows['lesson_type'] == lesson_type]
+    else:
+        rows = rows[rows['lesson_type_id'].notna() == by_lesson_type]
+    for column, value in names.items():
+        rows = rows[rows[column] == value]
+    return rows
 
-    def get_operations(self, start_date=None, end_date=None):
-        """Получает операции за период с правильными JOIN по вашей схеме"""
-        conn = self.get_connection()
 
-        query = '''
-        SELECT 
-            f.id,
-            f.operation_date,
-            ot.name_operation AS operation_type,
-            c.name AS category,
-            s.name AS subcategory,
-            g.name AS group_name,
-            sg.name AS subgroup,
-            lt.name AS lesson_type,
-            f.amount,
-            f.comment,
-            f.created_at,
-            f.updated_at
-        FROM financial_operations f
-        JOIN operation_types ot ON f.operation_type_id = ot.id_operation
-        JOIN categories c ON f.category_id = c.id_categories
-        LEFT JOIN subcategories s ON f.subcategory_id = s.id_subcategories
-        LEFT JOIN groups g ON f.group_id = g.id_groups
-        LEFT JOIN subgroups sg ON f.subgroup_id = sg.id_subgroups
-        LEFT JOIN lesson_types lt ON f.lesson_type_id = lt.id_lesson_type
-    '''
+@timed("load_journal_summary")
+def load_journal_summary(app, start_date, end_date, operation_types=None, categories=None,
+                         min_amount=None, max_amount=None):
+    """
+    Итоги всей выборки журнала (не только страницы) по тем же фильтрам, что и get_journal_page:
+    число операций, доходы, расходы, сальдо и суммы по категориям. Фильтры и группировка
+    выполняются в pandas по компактному фрейму get_operations_frame (categorical, копейки int64),
+    поэтому смена фильтров не стоит ни одного запроса к БД.
+    """
+    frame = app.get_operations_frame(start_date, end_date)
+    mask = np.ones(len(frame), dtype=bool)
+    if operation_types:
+        mask &= frame['operation_type'].isin(operation_types).to_numpy()
+    if categories:
+        mask &= frame['category'].isin(categories).to_numpy()
+    if min_amount is not None and max_amount is not None:
+        amount = np.abs(frame['amount_kop'].to_numpy())
+        mask &= (amount >= round(min_amount * 100)) & (amount <= round(max_amount * 100))
+    rows = frame[mask]
 
-        params = []
-        if start_date and end_date:
-            query += " WHERE f.operation_date BETWEEN ? AND ?"
-            params.extend([start_date, end_date])
+    kop = rows['amount_kop'].to_numpy()
+    by_category = (
+        rows.groupby('category', observed=True)['amount_kop']
+        .agg(total='sum', operations_count='size')
+        .reset_index()
+    )
+    by_category['total'] = by_category['total'] / 100
+    by_category = by_category.sort_values('total', key=abs, ascending=False, ignore_index=True)
+    return {
+        'operations_count': len(rows),
+        'total_income': int(kop[kop > 0].sum()) / 100,
+        'total_expense': -int(kop[kop < 0].sum()) / 100,
+        'balance': int(kop.sum()) / 100,
+        'by_category': by_category,
+    }
 
-        query += " ORDER BY f.operation_date DESC, f.id DESC"
 
-        df = pd.read_sql(query, conn, params=params)
-        conn.close()
-        return df
+@timed("load_tree_totals")
+def load_tree_totals(app, start_date, end_date):
+    """Итоги дерева справочников за период — общие данные панелей расходов и доходов"""
+    return app.get_tree_totals(start_date, end_date)
 
 
-    def get_financial_summary(self, start_date=None, end_date=None):
-        """Получает финансовую сводку"""
-        conn = self.get_connection()
+@timed("load_cumulative_profit")
+def load_cumulative_profit(app, start_date, end_date):
+    """Накопленная прибыль по дням (сумма считается в БД), прореженная до бюджета точек графика"""
+    df = app.get_daily_profit(start_date, end_date)
+    return downsample_series(df, ['cum_profit'], x='operation_date')
 
-        query = '''
-            SELECT 
-                ot.name as operation_type,
-                c.name as category,
-                SUM(f.amount) as total
-            FROM financial_operations f
-            JOIN operation_types ot ON f.operation_type_id = ot.id
-            JOIN categories c ON f.category_id = c.id
-            '''
 
-        params = []
-        if start_date and end_date:
-            query += " WHERE f.operation_date BETWEEN ? AND ?"
-            params.extend([start_date, end_date])
+# Данные панелей: один запрос на источник, даже если из него рисуются несколько панелей
+DASHBOARD_PANELS = {
+    'kpi': load_kpis,
+    'monthly': load_dynamics,
+    'tree': load_tree_totals,
+    'profit': load_cumulative_profit,
+}
 
-        query += " GROUP BY ot.name, c.name ORDER BY total DESC"
 
-        df = pd.read_sql(query, conn, params=params)
-        conn.close()
-        return df
+def _panel_pool():
+    """
+    Общий для всех сессий пул потоков загрузки панелей. По умолчанию потоков столько, сколько
+    соединений может выдать пул SQLAlchemy (DB_POOL_SIZE + DB_MAX_OVERFLOW): поток панели
+    не простаивает в ожидании соединения, а нагрузка всех сессий на БД ограничена пулом.
+    """
+    workers = get_setting("DASHBOARD_WORKERS") or (
+        int(get_setting("DB_POOL_SIZE", 5)) + int(get_setting("DB_MAX_OVERFLOW", 10))
+    )
+    return _get_shared('panel_pool', None, lambda: ThreadPoolExecutor(
+        max_workers=int(workers), thread_name_prefix="fin_dash_panel",
+    ))
 
 
-    def get_monthly_summary(self):
-        """Получает помесячную статистику"""
-        conn = self.get_connection()
+# Как часто load_dashboard проверяет, начались ли загрузки, стоящие в очереди пула (секунды)
+PANEL_POLL_INTERVAL = 0.25
 
-        query = '''
-            SELECT 
-                strftime('%Y-%m', operation_date) as month,
-                ot.name as operation_type,
-                SUM(amount) as total
-            FROM financial_operations f
-            JOIN operation_types ot ON f.operation_type_id = ot.id
-            GROUP BY month, operation_type
-            ORDER BY month
-            '''
 
-        df = pd.read_sql(query, conn)
-        conn.close()
-        return df
+def _submit_panel(app, name, start_date, end_date):
+    """
+    Загрузка панели за период в общем пуле: (future, run), run['started'] — когда она начала
+    выполняться (None — ещё в очереди). Если такая же загрузка ещё идёт (например, не успела
+    к сроку в прошлом перезапуске или её запросила другая сессия), возвращается она:
+    незавершённая работа не ставится в пул повторно и не занимает ещё поток и соединение.
+    """
+    runs, lock = _get_shared('panel_runs', app.db_url, lambda: ({}, threading.Lock()))
+    key = (name, str(start_date), str(end_date))
+    with lock:
+        for done in [k for k, (future, _) in runs.items() if future.done()]:
+            del runs[done]
+        if key in runs:
+            return runs[key]
+
+        run = {'started': None}
+        # Копия контекста: замеры из потока пула попадают в замеры текущего перезапуска
+        context = contextvars.copy_context()
+
+        def task():
+            run['started'] = time.monotonic()
+            return context.run(DASHBOARD_PANELS[name], app, start_date, end_date)
 
-def import_excel_to_db(app, df):
+        runs[key] = _panel_pool().submit(task), run
+        return runs[key]
+
+
+def load_dashboard(app, start_date, end_date, panels=None, timeout=None):
     """
-    Импортирует данные из Excel в БД.
-    Добавляет новые категории / подкатегории / группы / подгруппы / типы занятий, если их нет.
+    Загружает данные панелей параллельно и отдаёт (панель, данные, ошибка) по мере готовности.
+    timeout — секунды на панель с начала её выполнения (по умолчанию DASHBOARD_PANEL_TIMEOUT)
+    или словарь {панель: секунды}; ожидание в очереди общего пула в срок не входит.
+    Не успевшая панель отдаётся с TimeoutError; её запрос дорабатывает в фоне, а следующий
+    перезапуск дожидается его же (см. _submit_panel), а не запускает новый.
     """
+    panels = list(panels or DASHBOARD_PANELS)
+    default = float(get_setting("DASHBOARD_PANEL_TIMEOUT", 30))
+    if not isinstance(timeout, dict):
+        timeout = dict.fromkeys(panels, default if timeout is None else timeout)
 
-    conn = app.get_connection()
-    cur = conn.cursor()
+    pending = {}
+    for name in panels:
+        future, run = _submit_panel(app, name, start_date, end_date)
+        pending[future] = (name, run, float(timeout.get(name, default)))
 
-    inserted_count = 0
+    while pending:
+        deadlines = [run['started'] + limit for _, run, limit in pending.values() if run['started'] is not None]
+        queued = len(deadlines) < len(pending)
+        wait_for = min(deadlines, default=time.monotonic() + PANEL_POLL_INTERVAL) - time.monotonic()
+        if queued:
+            wait_for = min(wait_for, PANEL_POLL_INTERVAL)
+        done, _ = wait(pending, timeout=max(0.0, wait_for), return_when=FIRST_COMPLETED)
+        for future in done:
+            name, _, _ = pending.pop(future)
+            error = future.exception()
+            yield name, None if error is not None else future.result(), error
+        now = time.monotonic()
+        for future, (name, run, limit) in list(pending.items()):
+            if run['started'] is not None and run['started'] + limit <= now:
+                del pending[future]
+                yield name, None, TimeoutError(f"данные не получены за {limit:.0f} с")
 
-    for _, row in df.iterrows():
-        try:
-            # === 1️⃣ Определяем тип операции ===
-            cur.execute("SELECT id_operation FROM operation_types WHERE name_operation = ?", (row['Тип операции'],))
-            type_row = cur.fetchone()
-            if not type_row:
-                cur.execute("INSERT INTO operation_types (name_operation) VALUES (?)", (row['Тип операции'],))
-                conn.commit()
-                type_id = cur.lastrowid
-            else:
-                type_id = type_row[0]
-
-            # === 2️⃣ Категория ===
-            cur.execute("SELECT id_categories FROM categories WHERE name = ?", (row['Категория'],))
-            cat_row = cur.fetchone()
-            if not cat_row:
-                cur.execute("INSERT INTO categories (operation_type_id, name) VALUES (?, ?)", (type_id, row['Категория']))
-                conn.commit()
-                category_id = cur.lastrowid
-            else:
-                category_id = cat_row[0]
-
-            # === 3️⃣ Подкатегория ===
-            subcat_id = None
-            if pd.notna(row['Подкатегория']):
-                cur.execute(
-                    "SELECT id_subcategories FROM subcategories WHERE category_id = ? AND name = ?",
-                    (category_id, row['Подкатегория'])
-                )
-                s_row = cur.fetchone()
-                if not s_row:
-                    cur.execute("INSERT INTO subcategories (category_id, name) VALUES (?, ?)",
-                                (category_id, row['Подкатегория']))
-                    conn.commit()
-                    subcat_id = cur.lastrowid
-                else:
-                    subcat_id = s_row[0]
-
-            # === 4️⃣ Группа ===
-            group_id = None
-            if pd.notna(row['Группа']):
-                cur.execute(
-                    "SELECT id_groups FROM groups WHERE subcategory_id = ? AND name = ?",
-                    (subcat_id, row['Группа'])
-                )
-                g_row = cur.fetchone()
-                if not g_row:
-                    cur.execute("INSERT INTO groups (subcategory_id, name) VALUES (?, ?)", (subcat_id, row['Группа']))
-                    conn.commit()
-                    group_id = cur.lastrowid
-                else:
-                    group_id = g_row[0]
-
-            # === 5️⃣ Подгруппа ===
-            subgroup_id = None
-            if pd.notna(row['Подгруппа']):
-                cur.execute(
-                    "SELECT id_subgroups FROM subgroups WHERE group_id = ? AND name = ?",
-                    (group_id, row['Подгруппа'])
-                )
-                sg_row = cur.fetchone()
-                if not sg_row:
-                    cur.execute("INSERT INTO subgroups (group_id, name) VALUES (?, ?)", (group_id, row['Подгруппа']))
-                    conn.commit()
-                    subgroup_id = cur.lastrowid
-                else:
-                    subgroup_id = sg_row[0]
-
-            # === 6️⃣ Тип занятия ===
-            lesson_type_id = None
-            if pd.notna(row['Тип занятия']):
-                cur.execute("SELECT id_lesson_type FROM lesson_types WHERE name = ?", (row['Тип занятия'],))
-                lt_row = cur.fetchone()
-                if not lt_row:
-                    cur.execute("INSERT INTO lesson_types (name) VALUES (?)", (row['Тип занятия'],))
-                    conn.commit()
-                    lesson_type_id = cur.lastrowid
-                else:
-                    lesson_type_id = lt_row[0]
-
-            # === 7️⃣ Добавляем саму операцию ===
-            cur.execute('''
-                INSERT INTO financial_operations 
-                (operation_date, operation_type_id, amount, category_id, subcategory_id, group_id, subgroup_id, lesson_type_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                pd.to_datetime(row['Дата']).strftime('%Y-%m-%d'),
-                type_id,
-                float(row['Сумма']),
-                category_id,
-                subcat_id,
-                group_id,
-                subgroup_id,
-                lesson_type_id
+
+# === Пакетные отчёты (без Streamlit) ===
+
+# Период отчёта -> частота pandas
+REPORT_PERIODS = {'month': 'M', 'quarter': 'Q', 'year': 'Y'}
+
+# Отчёт -> лист XLSX
+REPORTS = {
+    'kpi': 'Итоги',
+    'categories': 'Категории',
+    'hierarchy': 'Иерархия',
+    'monthly': 'По месяцам',
+}
+
+
+def _report_periods(start_date, end_date, period):
+    """Все периоды между датами: метка, начало и конец (крайние обрезаны по start_date/end_date)"""
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    periods = pd.period_range(start, end, freq=REPORT_PERIODS[period])
+    return pd.DataFrame({
+        'period': periods.astype(str),
+        'period_start': pd.Series(periods.start_time).clip(lower=start).dt.date,
+        'period_end': pd.Series(periods.end_time.normalize()).clip(upper=end).dt.date,
+    })
+
+
+def _income_expense(frame, keys):
+    """Доходы, расходы и прибыль по ключам keys"""
+    sums = (
+        frame.groupby(keys + ['operation_type'])['total'].sum()
+        .unstack('operation_type')
+        .reindex(columns=list(OPERATION_TYPES))
+        .fillna(0.0)
+        .astype(float)
+    )
+    sums.columns = ['income', 'expense']
+    sums['profit'] = sums['income'] - sums['expense']
+    return sums.round(2)
+
+
+def _hierarchy_report(leaves):
+    """Узлы дерева справочников всех уровней с суммами; строки идут в порядке обхода дерева"""
+    nodes = []
+    for depth in range(1, len(TREE_LEVELS) + 1):
+        rows = leaves[leaves[TREE_LEVELS[depth - 1]] != 0]
+        keys = ['period', 'operation_type'] + TREE_LEVELS[:depth] + TREE_NAMES[:depth]
+        nodes.append(
+            rows.groupby(keys, dropna=False)[['total', 'operations_count']].sum()
+            .reset_index()
+            .assign(level=depth)
+        )
+    tree = pd.concat(nodes, ignore_index=True)
+    path = tree['category'].astype(object)
+    for column in TREE_NAMES[1:]:
+        path = path.where(tree[column].isna(), path + ' / ' + tree[column].astype(object))
+    tree['path'] = path
+    tree = tree.sort_values(['period', 'operation_type'] + TREE_NAMES, na_position='first', kind='stable')
+    return tree[['period', 'operation_type', 'level', 'path'] + TREE_NAMES + ['total', 'operations_count']]
+
+
+@timed("build_reports")
+def build_reports(app, start_date, end_date, period='month'):
+    """
+    Отчёты за все периоды (REPORT_PERIODS) между start_date и end_date одним запросом к БД:
+    суммы по месяцам и листьям дерева (get_monthly_tree) сворачиваются в pandas.
+    Возвращает {отчёт: DataFrame} в порядке REPORTS, у каждой строки — метка периода:
+      kpi — доходы, расходы, прибыль и число операций (строка на каждый период, пустые — нули);
+      categories — суммы по категориям и их доля в типе операции за период;
+      hierarchy — узлы дерева справочников всех уровней;
+      monthly — помесячная динамика внутри периода с накопленной прибылью.
+    """
+    freq = REPORT_PERIODS[period]
+    periods = _report_periods(start_date, end_date, period)
+    leaves = app.get_monthly_tree(start_date, end_date)
+    leaves['period'] = pd.PeriodIndex(leaves['month'], freq='M').asfreq(freq).astype(str)
+
+    kpi = periods.join(_income_expense(leaves, ['period']), on='period')
+    kpi['operations_count'] = kpi['period'].map(leaves.groupby('period')['operations_count'].sum())
+    kpi = kpi.fillna({'income': 0.0, 'expense': 0.0, 'profit': 0.0, 'operations_count': 0})
+    kpi['operations_count'] = kpi['operations_count'].astype('int64')
+
+    categories = (
+        leaves.groupby(['period', 'operation_type', 'category_id', 'category'], dropna=False)
+        [['total', 'operations_count']].sum()
+        .reset_index()
+    )
+    type_totals = categories.groupby(['period', 'operation_type'])['total'].transform('sum')
+    categories['share'] = (categories['total'] / type_totals.where(type_totals != 0)).astype(float)
+    categories = categories.sort_values(['period', 'operation_type', 'total'], ascending=[True, True, False])
+
+    months = pd.period_range(pd.Timestamp(start_date), pd.Timestamp(end_date), freq='M')
+    monthly = (
+        pd.DataFrame({'period': months.asfreq(freq).astype(str), 'month': months.astype(str)})
+        .join(_income_expense(leaves, ['period', 'month']), on=['period', 'month'])
+        .fillna({'income': 0.0, 'expense': 0.0, 'profit': 0.0})
+    )
+    monthly['cum_profit'] = monthly.groupby('period')['profit'].cumsum().round(2)
+
+    return {
+        'kpi': kpi,
+        'categories': categories.drop(columns='category_id').reset_index(drop=True),
+        'hierarchy': _hierarchy_report(leaves).reset_index(drop=True),
+        'monthly': monthly,
+    }
+
+
+def _write_reports_xlsx(reports, path):
+    with open(path, 'wb') as file, pd.ExcelWriter(file, engine='openpyxl') as writer:
+        for name, df in reports.items():
+            df.to_excel(writer, sheet_name=REPORTS[name], index=False)
+    return [path]
+
+
+def _write_reports_parquet(reports, path):
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise RuntimeError("для выгрузки в Parquet нужен пакет pyarrow")
+    # Parquet — одна таблица на файл: path — каталог, в нём файл на отчёт
+    os.makedirs(path, exist_ok=True)
+    paths = []
+    for name, df in reports.items():
+        paths.append(os.path.join(path, f"{name}.parquet"))
+        df.to_parquet(paths[-1], index=False)
+    return paths
+
+
+def _write_reports_json(reports, path):
+    data = {}
+    for name, df in reports.items():
+        # Границы периодов — даты без времени
+        dates = {col: df[col].astype(str) for col in ('period_start', 'period_end') if col in df}
+        data[name] = json.loads(df.assign(**dates).to_json(orient='records', force_ascii=False))
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False, indent=1)
+    return [path]
+
+
+REPORT_FORMATS = {
+    'XLSX': _write_reports_xlsx,
+    'Parquet': _write_reports_parquet,
+    'JSON': _write_reports_json,
+}
+
+
+def write_reports(reports, path, fmt):
+    """Записывает отчёты build_reports в формате fmt (см. REPORT_FORMATS); возвращает записанные файлы"""
+    return REPORT_FORMATS[fmt](reports, path)
+
+
+# === Отрисовка панелей дашборда ===
+
+def panel_fragment(name):
+    """
+    Декоратор: st.fragment для части панели. Смена виджета внутри перезапускает только
+    функцию фрагмента с данными периода из последнего полного перезапуска, без запросов к БД.
+    Такой перезапуск замеряется отдельно под именем name (история, PERF_LOG, панель).
+    Первый аргумент функции — FinanceApp.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(app, *args, **kwargs):
+            if _perf_var().get() is not None:
+                # Полный перезапуск скрипта: фрагмент — обычный участок в его замерах
+                with perf_section(name):
+                    return func(app, *args, **kwargs)
+            perf = start_perf(name)
+            try:
+                result = func(app, *args, **kwargs)
+            finally:
+                finish_perf(perf, app.perf_history)
+            if perf_panel_enabled():
+                summary = perf.summary()
+                st.caption(f"⏱ {name}: {summary['total_ms']:.0f} мс, запросов: {summary['queries']}")
+            return result
+        return _fragment(wrapper)
+    return decorator
+
+
+def render_kpi(app, kpis):
+    """Ключевые метрики: доходы, расходы, прибыль"""
+    with perf_section("panel.kpi"):
+        total_income = kpis['total_income']
+        total_expense = kpis['total_expense']
+        profit = kpis['profit']
+        c1, c2, c3 = st.columns(3)
+
+        # c1.metric("Доходы", f"{total_income:,.2f} ₽")
+        # c2.metric("Расходы", f"{total_expense:,.2f} ₽")
+        # c3.metric("Прибыль", f"{profit:,.2f} ₽")
+        c1.metric("Доходы", f"{total_income:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+        c2.metric("Расходы", f"{total_expense:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+        c3.metric("Прибыль", f"{profit:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+
+
+def render_dynamics(app, data):
+    """Линии доходов и расходов по корзинам времени"""
+    pivot, bucket = data
+    with perf_section("panel.monthly"):
+        import plotly.graph_objects as go
+
+        line_fig = go.Figure()
+
+        # Линия расходов (красная)
+        if 'расход' in pivot.columns:
+            line_fig.add_trace(go.Scatter(
+                x=pivot.index,
+                y=pivot['расход'],
+                mode='lines+markers',
+                name='Расход',
+                line=dict(color='red', width=2),
+                fill='tozeroy',
+                fillcolor='rgba(255, 0, 0, 0.2)'
             ))
 
-            inserted_count += 1
+        # Линия доходов (зелёная)
+        if 'доход' in pivot.columns:
+            line_fig.add_trace(go.Scatter(
+                x=pivot.index,
+                y=pivot['доход'],
+                mode='lines+markers',
+                name='Доход',
+                line=dict(color='green', width=2),
+                fill='tozeroy',
+                fillcolor='rgba(0, 200, 0, 0.2)'
+            ))
 
-        except Exception as e:
-            st.error(f"Ошибка при добавлении строки: {e}")
 
-    conn.commit()
-    conn.close()
-    return inserted_count
+        line_fig.update_layout(
+            title=f"Динамика {TIME_BUCKETS[bucket][3][1]}",
+            xaxis_title=TIME_BUCKETS[bucket][3][0],
+            yaxis_title="Сумма (₽)",
+            template="plotly_white",
+            hovermode="x unified"
+        )
+
+        st.plotly_chart(line_fig, use_container_width=True)
+
+
+@panel_fragment("fragment.expenses")
+def expense_subcategories(app, totals):
+    """Подкатегории выбранной категории расходов: выбор категории перерисовывает только эту диаграмму"""
+    # Выпадающий список категорий
+    categories = sorted(tree_slice(totals, 'расход', 1)['category'].dropna().unique())
+    selected_category = st.selectbox(
+        "Выберите категорию расходов:",
+        options=categories,
+        index=0 if categories else None
+    )
+
+    # Подкатегории — готовые узлы второго уровня дерева
+    sub_expense = (
+        tree_slice(totals, 'расход', 2, category=selected_category)
+        .dropna(subset=['subcategory'])[['subcategory', 'total']]
+        .sort_values('total', ascending=False)
+    )
+
+    pie_chart_sub = px.pie(
+        sub_expense,
+        names='subcategory',
+        values='total',
+        title=f"Подкатегории — {selected_category}",
+        hole=0.4
+    )
+    pie_chart_sub.update_traces(textinfo='percent')
+    st.plotly_chart(pie_chart_sub, use_container_width=True)
+
+
+def render_expenses(app, totals):
+    """Круговые диаграммы расходов: по категориям и по подкатегориям выбранной"""
+    with perf_section("panel.expenses"):
+        cat_expense = (
+            tree_slice(totals, 'расход', 1)[['category', 'total']]
+            .sort_values('total', ascending=False)
+        )
+
+        if not cat_expense.empty:
+            #import plotly.express as px
+            # Создаём два столбца
+            col1, col2 = st.columns(2)
+
+            with col1:
+                st.markdown("**Общая структура расходов по категориям**")
+                pie_chart_total = px.pie(
+                    cat_expense,
+                    names='category',
+                    values='total',
+                    title="По категориям",
+                    hole=0.4
+                )
+                pie_chart_total.update_traces(textinfo='percent+label')
+                st.plotly_chart(pie_chart_total, use_container_width=True)
+
+            with col2:
+                expense_subcategories(app, totals)
+        else:
+            st.info("Нет данных по расходам для выбранного периода.")
+
+
+@panel_fragment("fragment.income")
+def income_filters(app, totals):
+    """Фильтры доходов и диаграмма по ним: смена фильтра перерисовывает только этот фрагмент"""
+    col1, col2, col3, cols4 = st.columns(4)
+    # Выбранные узлы дерева: варианты следующего фильтра и диаграмма — выборки из итогов
+    names = {}
+    depth = 0
+
+    # === Фильтр по категории ===
+    with col1:
+        categories = sorted(tree_slice(totals, 'доход', 1)['category'].dropna().unique())
+        selected_category = st.selectbox(
+            "Выберите категорию доходов:",
+            options=["Все"] + categories,
+            index=0
+        )
+        if selected_category != "Все":
+            names['category'], depth = selected_category, 1
+
+    # === Фильтр по подкатегории ===
+    with col2:
+        subcategories = sorted(tree_slice(totals, 'доход', 2, **names)['subcategory'].dropna().unique())
+        selected_subcategory = st.selectbox(
+            "Выберите подкатегорию доходов:",
+            options=["Все"] + subcategories,
+            index=0
+        )
+        if selected_subcategory != "Все":
+            names['subcategory'], depth = selected_subcategory, 2
+
+    # === Фильтр по группе ===
+    with col3:
+        groups = sorted(tree_slice(totals, 'доход', 3, **names)['group_name'].dropna().unique())
+        selected_group = st.selectbox(
+            "Выберите подкатегорию доходов:",
+            options=["Все"] + groups,
+            index=0
+        )
+        if selected_group != "Все":
+            names['group_name'], depth = selected_group, 3
+
+    # === Фильтр по типу занятия ===
+    with cols4:
+        lesson_types = sorted(
+            tree_slice(totals, 'доход', depth, by_lesson_type=True, **names)['lesson_type'].dropna().unique()
+        )
+        selected_lesson_type = st.selectbox(
+            "Тип занятия:",
+            options=["Все"] + lesson_types,
+            index=0
+        )
+        lesson_type = selected_lesson_type if selected_lesson_type != "Все" else None
+
+    # === Итоговая группировка ===
+    # Без фильтра по группе хватает узлов подкатегорий, с ним — узлов групп
+    grouped_income = (
+        tree_slice(totals, 'доход', 3 if 'group_name' in names else 2, lesson_type=lesson_type, **names)
+        .groupby('subcategory')['total']
+        .sum()
+        .reset_index()
+        .sort_values('total', ascending=False)
+    )
+
+    if not grouped_income.empty:
+        pie_chart = px.pie(
+            grouped_income,
+            names='subcategory',
+            values='total',
+            title="Структура доходов по подкатегориям",
+            hole=0.4
+        )
+        pie_chart.update_traces(textinfo='percent+label')
+        pie_chart.update_layout(template="plotly_white")
+
+        st.plotly_chart(pie_chart, use_container_width=True)
+    else:
+        st.info("Нет данных для выбранных фильтров.")
+
+
+def render_income(app, totals):
+    """Структура доходов с фильтрами по справочникам"""
+    with perf_section("panel.income"):
+        if not tree_slice(totals, 'доход', 0).empty:
+            income_filters(app, totals)
+        else:
+            st.info("Нет данных по доходам для выбранного периода.")
+
+
+def render_profit(app, df_sorted):
+    """Площадной график накопленной прибыли"""
+    with perf_section("panel.profit"):
+        profit_fig = px.area(
+            df_sorted,
+            x='operation_date',
+            y='cum_profit',
+            title="Накопительная прибыль",
+            labels={'cum_profit': 'Накопленная прибыль (₽)', 'operation_date': 'Дата'}
+        )
+        st.plotly_chart(profit_fig, use_container_width=True)
+
+
+# Панель страницы -> (заголовок, отрисовка, источник данных в DASHBOARD_PANELS)
+DASHBOARD_RENDERERS = {
+    'kpi': ("Ключевые метрики", render_kpi, 'kpi'),
+    'monthly': ("Динамика доходов и расходов", render_dynamics, 'monthly'),
+    'expenses': ("Структура расходов по категориям", render_expenses, 'tree'),
+    'income': ("Анализ доходов по фильтрам", render_income, 'tree'),
+    'profit': ("Кумулятивная прибыль", render_profit, 'profit'),
+}
+
+
+def _format_eta(seconds):
+    if pd.isna(seconds):
+        return "оценивается"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes} мин {seconds} с" if minutes else f"{seconds} с"
+
+
+@_fragment(run_every=IMPORT_PROGRESS_EVERY)
+def import_progress(app, job_ids):
+    """Прогресс фоновых задач импорта: обновляется сам, пока задачи идут, затем перезапускает страницу"""
+    jobs = list_import_jobs(app, job_ids)
+    active = jobs[jobs['status'].isin(['queued', 'running'])]
+    for job in active.itertuples():
+        if job.status == 'queued':
+            st.progress(0.0, text=f"Импорт #{job.id}: в очереди")
+            continue
+        of_total = f" из {job.rows_total:,.0f}" if pd.notna(job.rows_total) else ""
+        st.progress(job.progress, text=f"Импорт #{job.id}: {job.rows_done:,.0f}{of_total} строк".replace(",", " "))
+        st.caption(
+            f"{job.files}. {job.rows_per_sec:,.0f} строк/с, осталось {_format_eta(job.eta_sec)}".replace(",", " ")
+        )
+    if active.empty:
+        # Задачи завершились: полный перезапуск покажет итоги и обновит дашборд
+        st.rerun()
+
+
+def render_import_jobs(app):
+    """Фоновые задачи импорта в боковой панели: идущие (в т.ч. подхваченные после перезапуска) и итоги своих"""
+    watched = st.session_state.setdefault('import_jobs', [])
+    jobs = list_import_jobs(app, watched, statuses=('queued', 'running'))
+
+    for job in jobs[jobs['status'] == 'done'].itertuples():
+        counted = "будет добавлено" if job.dry_run else "добавлено"
+        st.sidebar.success(
+            f"Импорт #{job.id} завершён. Листов: {job.sheets}, {counted}: {job.new_rows}, "
+            f"уже загружено ранее: {job.duplicates}, с ошибками: {job.rejected}"
+        )
+        for reason in job.skipped:
+            st.sidebar.warning(f"Пропущено — {reason}")
+        if job.errors:
+            st.sidebar.error("Ошибки в строках: " + "; ".join(job.errors[:5]))
+        watched.remove(job.id)
+
+    for job in jobs[jobs['status'] == 'failed'].itertuples():
+        st.sidebar.error(f"Импорт #{job.id} прерван на строке {job.rows_done}: {job.error}")
+        if st.sidebar.button("Продолжить импорт", key=f"resume_import_{job.id}"):
+            requeue_import_job(app, job.id)
+            import_worker(app).wake()
+            st.rerun()
+
+    active = jobs[jobs['status'].isin(['queued', 'running'])]['id'].tolist()
+    if active:
+        watched.extend(job_id for job_id in active if job_id not in watched)
+        with st.sidebar:
+            import_progress(app, active)
+
 
 def main():
     st.set_page_config(
@@ -403,33 +4076,46 @@ def main():
         initial_sidebar_state="expanded"
     )
 
-    app = FinanceApp()
+    perf = start_perf()
+    with perf_section("FinanceApp()"):
+        app = FinanceApp()
+
+    connected, info = app.check_connection()
+    if connected:
+        st.sidebar.caption(f"✅ Подключение к БД: {info}")
+        # Воркер импорта стартует с первой сессией и подхватывает задачи, прерванные перезапуском
+        import_worker(app)
+    else:
+        st.error(f"❌ Ошибка подключения: {info}")
 
     # Сайдбар с навигацией
 
     page = st.sidebar.radio("Навигация", ["Дашборд", "Журнал операций"])
 
-    # --- Загрузка Excel-файла ---
+    # --- Загрузка файла ---
     st.sidebar.header("Импорт данных")
-    uploaded_file = st.sidebar.file_uploader("Загрузите Excel-файл (.xlsx)", type=["xlsx"])
+    uploaded_files = st.sidebar.file_uploader(
+        "Загрузите файлы (.xlsx, .csv)", type=["xlsx", "csv"], accept_multiple_files=True
+    )
 
-    if uploaded_file:
-        st.sidebar.info("Файл загружен. Нажмите кнопку для импорта данных в базу.")
+    if uploaded_files:
+        st.sidebar.info(
+            f"Загружено файлов: {len(uploaded_files)}. Нажмите кнопку для импорта данных в базу "
+            f"(все листы каждого файла)."
+        )
+        dry_run = st.sidebar.checkbox(
+            "Только проверить", help="Посчитать новые строки и дубликаты, ничего не записывая"
+        )
         if st.sidebar.button("📤 Импортировать данные"):
-            try:
-                df_new = pd.read_excel(uploaded_file)
-
-                required_columns = [
-                    'Дата', 'Тип операции', 'Сумма', 'Категория',
-                    'Подкатегория', 'Группа', 'Подгруппа', 'Тип занятия'
-                ]
-                if not all(col in df_new.columns for col in required_columns):
-                    st.error("Ошибка: в файле отсутствуют обязательные столбцы.")
-                else:
-                    imported = import_excel_to_db(app, df_new)
-                    st.success(f"Импорт завершён! Добавлено {imported} операций.")
-            except Exception as e:
-                st.error(f"Ошибка при обработке файла: {e}")
+            # Импорт идёт в фоновом потоке: сессия не блокируется, а при обрыве связи
+            # или перезапуске задача продолжится с последней контрольной точки
+            job_id = create_import_job(
+                app, [(file.name, file.getvalue()) for file in uploaded_files], dry_run=dry_run
+            )
+            st.session_state.setdefault('import_jobs', []).append(job_id)
+            import_worker(app).wake()
+
+    render_import_jobs(app)
 
     # Период для анализа
     st.sidebar.header("Период анализа")
@@ -463,231 +4149,30 @@ def main():
 
     if page == "Дашборд":
         st.title("Дашборд финансов")
-        # Загружаем операции
-        df = app.get_operations(start_date, end_date)
-
-        if df.empty:
-            st.warning("Нет данных за выбранный период.")
-        else:
-            # Преобразуем типы
-            df['operation_date'] = pd.to_datetime(df['operation_date'])
-            df['amount'] = df['amount'].astype(float)
-
-            # === 1️⃣ Общие показатели ===
-            total_income = df.loc[df['operation_type'] == 'доход', 'amount'].sum()
-            total_expense = df.loc[df['operation_type'] == 'расход', 'amount'].sum()
-            profit = total_income - total_expense
-            operations_count = len(df)
-
-            st.subheader("Ключевые метрики")
-            c1, c2, c3 = st.columns(3)
-
-            # c1.metric("Доходы", f"{total_income:,.2f} ₽")
-            # c2.metric("Расходы", f"{total_expense:,.2f} ₽")
-            # c3.metric("Прибыль", f"{profit:,.2f} ₽")
-            c1.metric("Доходы", f"{total_income:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
-            c2.metric("Расходы", f"{total_expense:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
-            c3.metric("Прибыль", f"{profit:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
-
-
-            # === 2️⃣ Динамика доходов и расходов по времени ===
-            st.subheader("Динамика доходов и расходов")
-            df_month = df.copy()
-            df_month['month'] = df_month['operation_date'].dt.to_period('M').astype(str)
-            monthly = df_month.groupby(['month', 'operation_type'])['amount'].sum().reset_index()
-            pivot = monthly.pivot(index='month', columns='operation_type', values='amount').fillna(0)
-
-            import plotly.graph_objects as go
-
-            line_fig = go.Figure()
-
-            # Линия расходов (красная)
-            if 'расход' in pivot.columns:
-                line_fig.add_trace(go.Scatter(
-                    x=pivot.index,
-                    y=pivot['расход'],
-                    mode='lines+markers',
-                    name='Расход',
-                    line=dict(color='red', width=2),
-                    fill='tozeroy',
-                    fillcolor='rgba(255, 0, 0, 0.2)'
-                ))
-
-            # Линия доходов (зелёная)
-            if 'доход' in pivot.columns:
-                line_fig.add_trace(go.Scatter(
-                    x=pivot.index,
-                    y=pivot['доход'],
-                    mode='lines+markers',
-                    name='Доход',
-                    line=dict(color='green', width=2),
-                    fill='tozeroy',
-                    fillcolor='rgba(0, 200, 0, 0.2)'
-                ))
-
-
-            line_fig.update_layout(
-                title="Динамика по месяцам",
-                xaxis_title="Месяц",
-                yaxis_title="Сумма (₽)",
-                template="plotly_white",
-                hovermode="x unified"
-            )
-
-            st.plotly_chart(line_fig, use_container_width=True)
-
-            st.subheader("Структура расходов по категориям")
-            expense_df = df[df['operation_type'] == 'расход']
-
-            if not expense_df.empty:
-                #import plotly.express as px
-                # Создаём два столбца
-                col1, col2 = st.columns(2)
-
-                with col1:
-                    st.markdown("**Общая структура расходов по категориям**")
-                    cat_expense = (
-                        expense_df.groupby('category')['amount']
-                        .sum()
-                        .reset_index()
-                        .sort_values('amount', ascending=False)
-                    )
-
-                    pie_chart_total = px.pie(
-                        cat_expense,
-                        names='category',
-                        values='amount',
-                        title="По категориям",
-                        hole=0.4
-                    )
-                    pie_chart_total.update_traces(textinfo='percent+label')
-                    st.plotly_chart(pie_chart_total, use_container_width=True)
-
-                with col2:
-
-
-                    # Выпадающий список категорий
-                    categories = sorted(expense_df['category'].dropna().unique())
-                    selected_category = st.selectbox(
-                        "Выберите категорию расходов:",
-                        options=categories,
-                        index=0 if categories else None
-                    )
-
-                    filtered = expense_df[expense_df['category'] == selected_category]
-
-                    # Группируем подкатегории
-                    sub_expense = (
-                        filtered.groupby('subcategory')['amount']
-                        .sum()
-                        .reset_index()
-                        .sort_values('amount', ascending=False)
-                    )
-
-                    pie_chart_sub = px.pie(
-                        sub_expense,
-                        names='subcategory',
-                        values='amount',
-                        title=f"Подкатегории — {selected_category}",
-                        hole=0.4
-                    )
-                    pie_chart_sub.update_traces(textinfo='percent')
-                    st.plotly_chart(pie_chart_sub, use_container_width=True)
-            else:
-                st.info("Нет данных по расходам для выбранного периода.")
-
-            # === 5️⃣ Доход по фильтрам ===
-            st.subheader("Анализ доходов по фильтрам")
-
-            income_df = df[df['operation_type'] == 'доход']
-            # st.write(income_df)
-            if not income_df.empty:
-                col1, col2, col3, cols4 = st.columns(4)
-
-                # === Фильтр по категории ===
-                with col1:
-                    categories = sorted(income_df['category'].dropna().unique())
-                    selected_category = st.selectbox(
-                        "Выберите категорию доходов:",
-                        options=["Все"] + categories,
-                        index=0
-                    )
-                    if selected_category != "Все":
-                        income_df = income_df[income_df['category'] == selected_category]
-
-                # === Фильтр по подкатегории ===
-                with col2:
-                    subcategories = sorted(income_df['subcategory'].dropna().unique())
-                    selected_subcategory = st.selectbox(
-                        "Выберите подкатегорию доходов:",
-                        options=["Все"] + subcategories,
-                        index=0
-                    )
-                    if selected_subcategory != "Все":
-                        income_df = income_df[income_df['subcategory'] == selected_subcategory]
-
-                # === Фильтр по группе ===
-                with col3:
-                    groups = sorted(income_df['group_name'].dropna().unique())
-                    selected_group = st.selectbox(
-                        "Выберите подкатегорию доходов:",
-                        options=["Все"] + groups,
-                        index=0
-                    )
-                    if selected_group != "Все":
-                        income_df = income_df[income_df['group_name'] == selected_group]
-
-                # === Фильтр по типу занятия ===
-                with cols4:
-                    lesson_types = sorted(income_df['lesson_type'].dropna().unique())
-                    selected_lesson_type = st.selectbox(
-                        "Тип занятия:",
-                        options=["Все"] + lesson_types,
-                        index=0
-                    )
-                    if selected_lesson_type != "Все":
-                        income_df = income_df[income_df['lesson_type'] == selected_lesson_type]
-
-                # === Итоговая группировка ===
-                grouped_income = (
-                    income_df.groupby('subcategory')['amount']
-                    .sum()
-                    .reset_index()
-                    .sort_values('amount', ascending=False)
-                )
-
-                if not grouped_income.empty:
-                    pie_chart = px.pie(
-                        grouped_income,
-                        names='subcategory',
-                        values='amount',
-                        title="Структура доходов по подкатегориям",
-                        hole=0.4
-                    )
-                    pie_chart.update_traces(textinfo='percent+label')
-                    pie_chart.update_layout(template="plotly_white")
-
-                    st.plotly_chart(pie_chart, use_container_width=True)
-                else:
-                    st.info("Нет данных для выбранных фильтров.")
-            else:
-                st.info("Нет данных по доходам для выбранного периода.")
-
-            # === 6️⃣ Кумулятивная прибыль ===
-            st.subheader("Кумулятивная прибыль")
-            df_sorted = df.sort_values('operation_date')
-            df_sorted['profit'] = df_sorted.apply(
-                lambda x: x['amount'] if x['operation_type'] == 'доход' else -x['amount'], axis=1)
-            df_sorted['cum_profit'] = df_sorted['profit'].cumsum()
-
-            profit_fig = px.area(
-                df_sorted,
-                x='operation_date',
-                y='cum_profit',
-                title="Накопительная прибыль",
-                labels={'cum_profit': 'Накопленная прибыль (₽)', 'operation_date': 'Дата'}
-            )
-            st.plotly_chart(profit_fig, use_container_width=True)
+        # Панели независимы: их запросы идут параллельно, а каждая панель
+        # рисуется в своём месте страницы, как только готовы её данные
+        slots = {name: st.empty() for name in DASHBOARD_RENDERERS}
+        no_data = False
+        for name, data, error in load_dashboard(app, start_date, end_date):
+            if no_data:
+                continue
+            if name == 'kpi' and error is None and data['summary'].empty:
+                no_data = True
+                for slot in slots.values():
+                    slot.empty()
+                slots['kpi'].warning("Нет данных за выбранный период.")
+                continue
+            for panel, (title, render, source) in DASHBOARD_RENDERERS.items():
+                if source != name:
+                    continue
+                with slots[panel].container():
+                    st.subheader(title)
+                    if isinstance(error, TimeoutError):
+                        st.warning(f"Панель не загрузилась: {error}. Обновите страницу позже.")
+                    elif error is not None:
+                        st.error(f"Ошибка загрузки панели: {error}")
+                    else:
+                        render(app, data)
     # Журнал операций
     elif page == "Журнал операций":
         st.title("📋 Журнал операций")
@@ -723,52 +4208,97 @@ def main():
 
 
 
-        # --- ЗАГРУЗКА ДАННЫХ ---
-        df = app.get_operations(start_date, end_date)
+        with perf_section("panel.journal"):
+            # --- ЗАГРУЗКА ДАННЫХ ---
+            # Фильтры, сортировка и лимит выполняются в БД; страницы листаются по ключу (дата, id)
+            filters = dict(
+                start_date=start_date, end_date=end_date,
+                operation_types=selected_type, categories=selected_cat,
+                min_amount=min_amount if min_amount or max_amount else None,
+                max_amount=max_amount if min_amount or max_amount else None,
+                limit=limit
+            )
+            if st.session_state.get("journal_filters") != filters:
+                st.session_state.journal_filters = filters
+                st.session_state.journal_cursor = None
+
+            cursor = st.session_state.journal_cursor
+            df, has_more = app.get_journal_page(
+                **filters,
+                after=cursor[1] if cursor and cursor[0] == "after" else None,
+                before=cursor[1] if cursor and cursor[0] == "before" else None
+            )
+            if df.empty and cursor is not None:
+                # Страница опустела (данные изменились) — возвращаемся к началу
+                st.session_state.journal_cursor = None
+                st.rerun()
+            has_prev = has_more if cursor and cursor[0] == "before" else cursor is not None
+            has_next = True if cursor and cursor[0] == "before" else has_more
+
+            # Приведение типов
+            if not df.empty:
+                df['amount'] = df['amount'].astype(float)
+                df['operation_date'] = pd.to_datetime(df['operation_date']).dt.date
 
-        # Приведение типов
-        if not df.empty:
-            df['amount'] = df['amount'].astype(float)
-            df['operation_date'] = pd.to_datetime(df['operation_date']).dt.date
+            # --- ИТОГИ ВЫБОРКИ ---
+            summary = load_journal_summary(app, **{k: v for k, v in filters.items() if k != 'limit'})
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Операций", f"{summary['operations_count']:,}".replace(",", " "))
+            m2.metric("Доходы", f"{summary['total_income']:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+            m3.metric("Расходы", f"{summary['total_expense']:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+            m4.metric("Сальдо", f"{summary['balance']:,.2f}".replace(",", " ").replace(".", ",") + " ₽")
+            if not summary['by_category'].empty:
+                with st.expander("Итоги по категориям"):
+                    st.dataframe(
+                        summary['by_category'].rename(columns={
+                            'category': 'Категория', 'total': 'Сумма', 'operations_count': 'Операций',
+                        }),
+                        use_container_width=True, hide_index=True,
+                    )
 
-            # Фильтрация
-            if selected_type:
-                df = df[df['operation_type'].isin(selected_type)]
-            if selected_cat:
-                df = df[df['category'].isin(selected_cat)]
-            if min_amount or max_amount:
-                df = df[(df['amount'] >= min_amount) & (df['amount'] <= max_amount)]
+            # --- ВЫВОД ТАБЛИЦЫ ---
+            st.subheader("Последние операции")
+            if df.empty:
+                st.info("Нет операций за выбранный период и условия.")
+            else:
+                # Немного косметики
+                df_view = df[list(JOURNAL_COLUMNS)].rename(columns=JOURNAL_COLUMNS)
+                st.dataframe(df_view, use_container_width=True, hide_index=True)
 
-            # Сортировка по дате
-            df = df.sort_values(by='operation_date', ascending=False)
+                def set_cursor(direction, row):
+                    st.session_state.journal_cursor = (direction, (str(row['operation_date']), int(row['id'])))
 
-            # Ограничение кол-ва строк
-            df = df.head(limit)
+                nav1, nav2 = st.columns(2)
+                with nav1:
+                    st.button("⬅️ Предыдущая страница", disabled=not has_prev,
+                              on_click=set_cursor, args=("before", df.iloc[0]))
+                with nav2:
+                    st.button("Следующая страница ➡️", disabled=not has_next,
+                              on_click=set_cursor, args=("after", df.iloc[-1]))
 
-        # --- ВЫВОД ТАБЛИЦЫ ---
-        st.subheader("Последние операции")
-        if df.empty:
-            st.info("Нет операций за выбранный период и условия.")
-        else:
-            # Немного косметики
-            df_view = df[[
-                'operation_date', 'operation_type', 'category', 'subcategory',
-                'group_name', 'subgroup', 'lesson_type', 'amount', 'comment', 'created_at'
-            ]]
-            df_view.columns = [
-                'Дата', 'Тип', 'Категория', 'Подкатегория',
-                'Группа', 'Подгруппа', 'Тип занятия', 'Сумма', 'Комментарий', 'Создано'
-            ]
-            st.dataframe(df_view, use_container_width=True, hide_index=True)
-
-            # Кнопка выгрузки CSV
-            csv = df_view.to_csv(index=False).encode('utf-8')
-            st.download_button(
-                label="📥 Скачать как CSV",
-                data=csv,
-                file_name="operations_journal.csv",
-                mime="text/csv",
-            )
+                # Выгрузка всех строк по фильтрам (не только текущей страницы) потоком из БД
+                exp1, exp2 = st.columns([1, 3])
+                with exp1:
+                    export_format = st.selectbox("Формат выгрузки", list(EXPORT_FORMATS))
+                with exp2:
+                    if st.button("📥 Подготовить выгрузку журнала"):
+                        export_filters = {k: v for k, v in filters.items() if k != 'limit'}
+                        _, mime, extension = EXPORT_FORMATS[export_format]
+                        try:
+                            with tempfile.NamedTemporaryFile(suffix=f".{extension}") as file:
+                                exported = export_journal(app, file, export_format, **export_filters)
+                                file.flush()
+                                # Кнопке отдаётся файл, а не его байты: скрипт не держит выгрузку
+                                # в памяти (из файлов Streamlit принимает только открытые на чтение)
+                                with open(file.name, 'rb') as data:
+                                    st.download_button(
+                                        label=f"💾 Скачать {extension.upper()} ({exported} строк)",
+                                        data=data,
+                                        file_name=f"operations_journal.{extension}",
+                                        mime=mime,
+                                    )
+                        except Exception as e:
+                            st.error(f"Ошибка при выгрузке: {e}")
 
     #     # Добавление операции
     # elif page == "Добавить операцию":
@@ -931,5 +4461,39 @@ def main():
     #         if success:
     #             st.success("Операция успешно добавлена!")
 
+    # Статистика общего кэша запросов
+    with st.sidebar.expander("Кэш запросов"):
+        stats = app.query_cache.stats()
+        st.caption(
+            f"Попаданий: {stats['hits']}, промахов: {stats['misses']} ({stats['hit_rate']:.0%}), "
+            f"записей: {stats['entries']}, {stats['bytes'] / 1024:.0f} КБ"
+        )
+        resident = app.resident.stats()
+        st.caption(
+            f"Окна операций: {resident['windows']} ({resident['rows']} строк), "
+            f"полных загрузок: {resident['full_loads']}, догрузок: {resident['delta_syncs']}, "
+            f"без изменений: {resident['unchanged']}"
+        )
+
+    with st.sidebar.expander("Пул соединений"):
+        pool = app.db.metrics()
+        st.caption(
+            f"Выдач: {pool['checkouts']}, новых соединений: {pool['connects']}, "
+            f"ожидание: ср. {pool['wait_avg_ms']:.1f} мс / макс. {pool['wait_max_ms']:.1f} мс, "
+            f"занято сейчас: {pool['checked_out']}"
+        )
+
+    finish_perf(perf, app.perf_history)
+    if perf_panel_enabled():
+        with st.sidebar.expander("⏱ Производительность"):
+            summary = perf.summary()
+            st.caption(
+                f"Перезапуск: {summary['total_ms']:.0f} мс, запросов: {summary['queries']}, "
+                f"в БД: {summary['db_ms']:.0f} мс"
+            )
+            st.dataframe(perf.frame(), hide_index=True, use_container_width=True)
+            st.caption("Скользящие перцентили (все сессии)")
+            st.dataframe(app.perf_history.percentiles(), hide_index=True, use_container_width=True)
+
 if __name__ == "__main__":
     main()
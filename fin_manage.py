@@ -0,0 +1,188 @@
+"""
+Обслуживание базы финансов из командной строки.
+
+    python fin_manage.py rollup-rebuild [--start 2025-01-01 --end 2025-12-31]
+    python fin_manage.py rollup-check [--start ... --end ...]
+    python fin_manage.py export --format Parquet --output journal.parquet [--start ... --end ...]
+    python fin_manage.py migrate [--status] [--target N]
+    python fin_manage.py check-plans [--start ... --end ...]
+    python fin_manage.py import branch1.xlsx branch2.xlsx ... [--dry-run] [--workers N]
+    python fin_manage.py import-jobs [--resume ID]
+    python fin_manage.py report --start 2025-01-01 --end 2025-12-31 [--period month] --format XLSX --output reports.xlsx
+
+DB_URL берётся из переменной окружения или задаётся через --db-url.
+Streamlit для команд не нужен — их можно запускать из cron.
+"""
+import argparse
+import sys
+
+from fin_dash import (
+    EXPORT_FORMATS, IMPORT_CHUNK_SIZE, REPORT_FORMATS, REPORT_PERIODS, FinanceApp, build_reports,
+    check_query_plans, claim_import_job, create_import_job, export_journal, get_setting, list_import_jobs,
+    migrate, migration_status, run_import_job, write_reports,
+)
+from sqlalchemy import create_engine
+
+
+def rollup_rebuild(app, args):
+    """Пересчитывает дневные агрегаты за период (по умолчанию целиком) и дерево справочников"""
+    rows = app.rebuild_daily_rollup(args.start, args.end)
+    print(f"Дневные агрегаты пересчитаны: {rows} строк")
+    nodes = app.rebuild_dimension_tree()
+    print(f"Дерево справочников пересчитано: {nodes} узлов")
+    return 0
+
+
+def rollup_check(app, args):
+    """Сверяет дневные агрегаты с операциями; код возврата 1 при расхождениях"""
+    mismatches = app.check_daily_rollup(args.start, args.end)
+    if mismatches.empty:
+        print("Расхождений нет")
+        return 0
+    print(f"Найдено расхождений: {len(mismatches)}")
+    print(mismatches.to_string(index=False))
+    return 1
+
+
+def export(app, args):
+    """Выгружает журнал операций за период в файл потоком из БД"""
+    with open(args.output, "wb") as file:
+        rows = export_journal(
+            app, file, args.format, chunk_size=args.chunk_size,
+            start_date=args.start, end_date=args.end,
+        )
+    print(f"Выгружено строк: {rows} -> {args.output}")
+    return 0
+
+
+def migrate_schema(args):
+    """Применяет недостающие миграции схемы (или показывает их состояние с --status)"""
+    engine = create_engine(args.db_url or get_setting("DB_URL"))
+    if not args.status:
+        applied = migrate(engine, args.target)
+        for version, name in applied:
+            print(f"Применена миграция {version}: {name}")
+        if not applied:
+            print("Схема в актуальном состоянии")
+    print(migration_status(engine).to_string(index=False))
+    return 0
+
+
+def check_plans(app, args):
+    """Разбирает планы горячих запросов; код возврата 1, если есть полный просмотр без индекса"""
+    plans = check_query_plans(app, args.start, args.end)
+    print(plans.to_string(index=False))
+    seq_scans = plans[plans['seq_scan']]
+    if seq_scans.empty:
+        print("Полных просмотров больших таблиц нет")
+        return 0
+    print(f"Запросов с полным просмотром: {seq_scans['check'].nunique()}")
+    return 1
+
+
+def _run_job(app, job_id, args, dry_run):
+    """Выполняет задачу импорта здесь же и печатает итоги; при сбое подсказывает, как продолжить"""
+    try:
+        counts = run_import_job(app, job_id, workers=args.workers)
+    except BaseException as e:
+        print(f"Импорт #{job_id} прерван: {e}. Продолжить: fin_manage.py import-jobs --resume {job_id}")
+        return 1
+    for reason in counts['skipped']:
+        print(f"Пропущено — {reason}")
+    action = "Будет добавлено" if dry_run else "Добавлено"
+    print(f"Листов: {counts['sheets']}. {action}: {counts['new']}, дубликатов: {counts['duplicates']}, "
+          f"с ошибками: {counts['rejected']}")
+    return 0
+
+
+def import_file(app, args):
+    """Импортирует .xlsx/.csv (все листы) задачей с контрольными точками (--dry-run — только подсчёт)"""
+    job_id = create_import_job(app, [(path, path) for path in args.paths], args.chunk_size, args.dry_run)
+    claim_import_job(app, job_id)
+    print(f"Импорт #{job_id}")
+    return _run_job(app, job_id, args, args.dry_run)
+
+
+def import_jobs(app, args):
+    """Показывает задачи импорта; --resume ID продолжает прерванную с контрольной точки"""
+    if args.resume is None:
+        jobs = list_import_jobs(app)
+        columns = ['id', 'status', 'files', 'rows_done', 'rows_total', 'new_rows', 'duplicates', 'rejected',
+                   'created_at', 'error']
+        print(jobs[columns].to_string(index=False) if not jobs.empty else "Задач импорта нет")
+        return 0
+    if claim_import_job(app, args.resume) is None:
+        print(f"Импорт #{args.resume} не продолжить: он завершён или ещё выполняется "
+              f"(отметка жизни свежее IMPORT_JOB_STALE)")
+        return 1
+    jobs = list_import_jobs(app, [args.resume])
+    print(f"Импорт #{args.resume}: продолжение со строки {jobs['rows_done'].iloc[0]}")
+    return _run_job(app, args.resume, args, bool(jobs['dry_run'].iloc[0]))
+
+
+def report(app, args):
+    """Считает отчёты (итоги, категории, иерархия, по месяцам) за все периоды одним запросом и пишет в файл"""
+    reports = build_reports(app, args.start, args.end, args.period)
+    for path in write_reports(reports, args.output, args.format):
+        print(f"Записан {path}")
+    print(f"Периодов: {len(reports['kpi'])}, " + ", ".join(f"{name}: {len(df)} строк" for name, df in reports.items()))
+    return 0
+
+
+COMMANDS = {
+    "rollup-rebuild": rollup_rebuild,
+    "rollup-check": rollup_check,
+    "export": export,
+    "migrate": migrate_schema,
+    "check-plans": check_plans,
+    "import": import_file,
+    "import-jobs": import_jobs,
+    "report": report,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Обслуживание базы финансов")
+    parser.add_argument("--db-url", help="строка подключения (по умолчанию DB_URL)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    for name in ("rollup-rebuild", "rollup-check", "export", "check-plans"):
+        cmd = sub.add_parser(name, help=COMMANDS[name].__doc__)
+        cmd.add_argument("--start", help="начало периода, YYYY-MM-DD")
+        cmd.add_argument("--end", help="конец периода, YYYY-MM-DD")
+        if name == "export":
+            cmd.add_argument("--format", choices=list(EXPORT_FORMATS), default="CSV")
+            cmd.add_argument("--output", required=True, help="путь к файлу выгрузки")
+            cmd.add_argument("--chunk-size", type=int, help="строк в порции (по умолчанию EXPORT_CHUNK_SIZE)")
+
+    cmd = sub.add_parser("migrate", help=migrate_schema.__doc__)
+    cmd.add_argument("--status", action="store_true", help="только показать состояние")
+    cmd.add_argument("--target", type=int, help="применить миграции до этой версии включительно")
+
+    cmd = sub.add_parser("import", help=import_file.__doc__)
+    cmd.add_argument("paths", nargs="+", help="файлы .xlsx или .csv")
+    cmd.add_argument("--dry-run", action="store_true", help="только посчитать новые строки и дубликаты")
+    cmd.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE, help="строк в порции")
+    cmd.add_argument("--workers", type=int, help="процессов разбора (по умолчанию IMPORT_WORKERS или число ядер)")
+
+    cmd = sub.add_parser("import-jobs", help=import_jobs.__doc__)
+    cmd.add_argument("--resume", type=int, metavar="ID", help="продолжить задачу с контрольной точки")
+    cmd.add_argument("--workers", type=int, help="процессов разбора (по умолчанию IMPORT_WORKERS или число ядер)")
+
+    cmd = sub.add_parser("report", help=report.__doc__)
+    cmd.add_argument("--start", required=True, help="начало первого периода, YYYY-MM-DD")
+    cmd.add_argument("--end", required=True, help="конец последнего периода, YYYY-MM-DD")
+    cmd.add_argument("--period", choices=list(REPORT_PERIODS), default="month", help="длина периода отчёта")
+    cmd.add_argument("--format", choices=list(REPORT_FORMATS), default="XLSX")
+    cmd.add_argument("--output", required=True, help="файл отчётов (для Parquet — каталог, файл на отчёт)")
+
+    args = parser.parse_args(argv)
+    if args.command == "migrate":
+        # Миграции не требуют FinanceApp (он сам мигрирует схему при DB_AUTO_MIGRATE)
+        return migrate_schema(args)
+    app = FinanceApp(args.db_url)
+    return COMMANDS[args.command](app, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
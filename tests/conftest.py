@@ -0,0 +1,43 @@
+"""Общие фикстуры: копия БД из репозитория (в состоянии до миграций) и приложение на ней"""
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+LEGACY_DB = os.path.join(ROOT, "millimon_finsnce.db")
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    path = tmp_path / "finance.db"
+    shutil.copy(LEGACY_DB, path)
+    return f"sqlite:///{path}"
+
+
+@pytest.fixture
+def app(db_url):
+    from fin_dash import FinanceApp
+    return FinanceApp(db_url)
+
+
+@pytest.fixture
+def sheet():
+    """Строки файла импорта: sheet([(дата, тип, сумма, категория, подкатегория), ...])"""
+    def make(rows):
+        return pd.DataFrame([
+            {'Дата': day, 'Тип операции': kind, 'Сумма': amount, 'Категория': category,
+             'Подкатегория': subcategory, 'Группа': None, 'Подгруппа': None, 'Тип занятия': None}
+            for day, kind, amount, category, subcategory in rows
+        ])
+    return make
+
+
+@pytest.fixture
+def csv_file(sheet):
+    """Файл импорта .csv (байты) из тех же строк, что и sheet"""
+    return lambda rows: sheet(rows).to_csv(sep=';', index=False).encode('utf-8')
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fin_dash import _lttb_indices, downsample_series
+
+
+@pytest.mark.parametrize("n, points", [(10, 3), (100, 7), (1000, 50), (1001, 1000)])
+def test_lttb_indices_invariants(n, points):
+    x = np.arange(n, dtype=float)
+    y = np.random.default_rng(n).normal(size=n).cumsum()
+    idx = _lttb_indices(x, y, points)
+    assert len(idx) == points
+    assert idx[0] == 0 and idx[-1] == n - 1
+    assert (np.diff(idx) > 0).all()
+    # Внутренние точки — по одной из каждой корзины
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    assert ((idx[1:-1] >= edges[:-1]) & (idx[1:-1] < edges[1:])).all()
+
+
+@pytest.mark.parametrize("points", [2, 10, 11])
+def test_lttb_keeps_short_series(points):
+    assert _lttb_indices(np.arange(10.0), np.zeros(10), points).tolist() == list(range(10))
+
+
+def test_lttb_keeps_extremes():
+    y = np.zeros(500)
+    y[137], y[402] = 100.0, -100.0
+    idx = _lttb_indices(np.arange(500.0), y, 20)
+    assert {137, 402} <= set(idx)
+
+
+def test_downsample_series_merges_columns():
+    days = pd.date_range('2031-01-01', periods=3000, freq='D')
+    df = pd.DataFrame({'operation_date': days, 'a': np.zeros(3000), 'b': np.zeros(3000)})
+    df.loc[100, 'a'] = 50.0
+    df.loc[2000, 'b'] = -50.0
+    result = downsample_series(df, ['a', 'b'], x='operation_date', points=100)
+    assert len(result) <= 200
+    assert result.index.is_monotonic_increasing
+    assert {0, 100, 2000, 2999} <= set(result.index)
+
+
+def test_downsample_series_within_budget_is_unchanged():
+    df = pd.DataFrame({'cum_profit': np.arange(50.0)})
+    assert downsample_series(df, ['cum_profit'], points=100) is df
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from fin_dash import import_excel_to_db
+
+ROWS = [
+    ('2031-01-05', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-01-06', 'доход', 500, 'Урок', 'Информатика'),
+    ('2031-01-20', 'расход', 300, 'Маркетинг', 'ВК'),
+    ('2031-03-31', 'доход', 200, 'Урок', 'Информатика'),
+    ('2031-04-01', 'расход', 50, 'Маркетинг', 'Авито'),
+    ('2031-07-14', 'доход', 700, 'Урок', 'Информатика'),
+]
+
+# Корзина -> частота периодов pandas с теми же границами (неделя — с понедельника)
+FREQS = {'day': 'D', 'week': 'W-SUN', 'month': 'M', 'quarter': 'Q'}
+
+
+@pytest.fixture
+def dynamics(app, sheet):
+    import_excel_to_db(app, sheet(ROWS))
+    return app
+
+
+def expected(start_date, end_date, bucket):
+    freq = FREQS[bucket]
+    buckets = pd.period_range(start_date, end_date, freq=freq).start_time
+    ops = pd.DataFrame(ROWS, columns=['date', 'operation_type', 'amount', 'category', 'subcategory'])
+    ops = ops[ops['date'].between(start_date, end_date)]
+    ops['bucket'] = pd.PeriodIndex(ops['date'], freq=freq).start_time
+    totals = ops.groupby(['bucket', 'operation_type'])['amount'].sum()
+    index = pd.MultiIndex.from_product([buckets, ['доход', 'расход']], names=['bucket', 'operation_type'])
+    return totals.reindex(index, fill_value=0).astype(float)
+
+
+@pytest.mark.parametrize("bucket", list(FREQS))
+@pytest.mark.parametrize("period", [('2031-01-01', '2031-07-31'), ('2031-01-03', '2031-04-02')])
+def test_buckets_are_dense_and_aligned(dynamics, bucket, period):
+    df = dynamics.get_dynamics(*period, bucket=bucket)
+    actual = df.set_index(['bucket', 'operation_type'])['total'].astype(float)
+    pd.testing.assert_series_equal(actual, expected(*period, bucket), check_names=False, check_index_type=False)
+
+
+def test_gap_months_are_zero(dynamics):
+    df = dynamics.get_dynamics('2031-01-01', '2031-07-31', bucket='month')
+    income = df[df['operation_type'] == 'доход'].set_index('bucket')['total'].astype(float)
+    assert income.index.strftime('%Y-%m').tolist() == [f'2031-0{m}' for m in range(1, 8)]
+    assert income.tolist() == [1500, 0, 200, 0, 0, 0, 700]
+
+
+def test_whole_history_has_no_gaps(dynamics):
+    df = dynamics.get_dynamics(bucket='month')
+    months = df['bucket'].drop_duplicates()
+    assert (months.dt.to_period('M').diff().dropna().map(lambda step: step.n) == 1).all()
+    with dynamics.get_connection() as conn:
+        total = pd.read_sql("SELECT SUM(amount) AS total FROM financial_operations", conn)['total'].iloc[0]
+    assert df['total'].astype(float).sum() == pytest.approx(float(total))
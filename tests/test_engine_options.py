@@ -0,0 +1,25 @@
+import pytest
+
+from fin_dash import _engine_options
+
+PG_URL = "postgresql+psycopg2://user@db.example.com/postgres"
+
+
+def test_sslmode_defaults_to_require(monkeypatch):
+    monkeypatch.delenv("DB_SSLMODE", raising=False)
+    assert _engine_options(PG_URL)["connect_args"] == {"sslmode": "require"}
+
+
+@pytest.mark.parametrize("value, expected", [("disable", {"sslmode": "disable"}), ("", None)])
+def test_sslmode_from_setting(monkeypatch, value, expected):
+    monkeypatch.setenv("DB_SSLMODE", value)
+    assert _engine_options(PG_URL).get("connect_args") == expected
+
+
+def test_sslmode_in_url_wins(monkeypatch):
+    monkeypatch.setenv("DB_SSLMODE", "require")
+    assert "connect_args" not in _engine_options(PG_URL + "?sslmode=verify-full")
+
+
+def test_sqlite_has_no_sslmode():
+    assert "connect_args" not in _engine_options("sqlite:///finance.db")
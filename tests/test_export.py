@@ -0,0 +1,46 @@
+import io
+
+import pandas as pd
+import pytest
+
+from fin_dash import EXPORT_FORMATS, JOURNAL_COLUMNS, export_journal
+
+READERS = {
+    'CSV': lambda file: pd.read_csv(file, encoding='utf-8-sig'),
+    'XLSX': lambda file: pd.read_excel(file, sheet_name='Журнал'),
+    'Parquet': pd.read_parquet,
+}
+
+
+def export(app, fmt, **filters):
+    file = io.BytesIO()
+    count = export_journal(app, file, fmt, chunk_size=4, **filters)
+    file.seek(0)
+    return count, READERS[fmt](file)
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+def test_export_round_trip(app, fmt):
+    journal, _ = app.get_journal_page(limit=10_000)
+    count, df = export(app, fmt)
+    assert count == len(journal) == len(df) > 4
+    assert list(df.columns) == list(JOURNAL_COLUMNS.values())
+    assert df['Сумма'].astype(float).round(2).tolist() == journal['amount'].astype(float).round(2).tolist()
+    assert df['Категория'].tolist() == journal['category'].tolist()
+    assert pd.to_datetime(df['Дата']).dt.date.tolist() == pd.to_datetime(journal['operation_date']).dt.date.tolist()
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+def test_export_respects_filters(app, fmt):
+    filters = dict(operation_types=['доход'], start_date='2025-01-01', end_date='2025-12-31')
+    journal, _ = app.get_journal_page(limit=10_000, **filters)
+    count, df = export(app, fmt, **filters)
+    assert count == len(df) == len(journal)
+    assert set(df['Тип']) == {'доход'}
+
+
+@pytest.mark.parametrize("fmt", list(EXPORT_FORMATS))
+def test_empty_export_keeps_header(app, fmt):
+    count, df = export(app, fmt, start_date='2090-01-01', end_date='2090-12-31')
+    assert count == 0 and df.empty
+    assert list(df.columns) == list(JOURNAL_COLUMNS.values())
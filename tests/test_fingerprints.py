@@ -0,0 +1,71 @@
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from fin_dash import _fingerprint_ordinals, _store_import_frame, _prepare_import_frame, import_excel_to_db, import_files
+
+ROWS = [
+    ('2025-05-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2025-05-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2025-05-02', 'расход', 250.5, 'Маркетинг', 'ВК'),
+]
+
+
+def count_operations(app):
+    with app.get_connection() as conn:
+        return conn.execute(text("SELECT COUNT(*) FROM financial_operations")).scalar()
+
+
+def test_ordinals_number_identical_rows():
+    keys = pd.Series(['a', 'b', 'a', 'a'])
+    assert _fingerprint_ordinals(keys).tolist() == [0, 0, 1, 2]
+
+
+def test_ordinals_continue_after_seen():
+    seen = {'a': 2}
+    keys = pd.Series(['a', 'b', 'a'])
+    assert _fingerprint_ordinals(keys, seen).tolist() == [2, 0, 3]
+    assert seen == {'a': 4, 'b': 1}
+
+
+def test_reimport_is_deduplicated(app, sheet):
+    before = count_operations(app)
+    assert import_excel_to_db(app, sheet(ROWS)) == {'new': 3, 'duplicates': 0, 'rejected': 0}
+    assert import_excel_to_db(app, sheet(ROWS)) == {'new': 0, 'duplicates': 3, 'rejected': 0}
+    assert count_operations(app) == before + 3
+
+
+def test_identical_rows_across_chunks_and_files(app, csv_file):
+    files = [('a.csv', csv_file(ROWS)), ('b.csv', csv_file(ROWS[:1]))]
+    totals = import_files(app, files, chunk_size=1, workers=1)
+    assert (totals['new'], totals['duplicates']) == (4, 0)
+    # Другая нарезка на порции даёт те же отпечатки
+    totals = import_files(app, files, chunk_size=10, workers=1, dry_run=True)
+    assert (totals['new'], totals['duplicates']) == (0, 4)
+
+
+def test_manual_operations_get_free_fingerprints(app, sheet):
+    income = app.get_operation_types().set_index('name_operation').loc['доход', 'id_operation']
+    category = app.get_categories(income).set_index('name').loc['Урок', 'id_categories']
+    subcategory = app.get_subcategories(category).set_index('name').loc['Информатика', 'id_subcategories']
+    operation = ('2025-05-01', income, 1000, category, subcategory)
+    assert app.add_operations([operation, operation])['error'].isna().all()
+    assert app.add_operations([operation])['error'].isna().all()
+
+    with app.get_connection() as conn:
+        fingerprints = conn.execute(text(
+            "SELECT fingerprint FROM financial_operations WHERE operation_date = '2025-05-01'"
+        )).scalars().all()
+    assert len(fingerprints) == 3 and len(set(fingerprints)) == 3 and None not in fingerprints
+    # Файл с теми же операциями распознаёт введённые вручную
+    assert import_excel_to_db(app, sheet(ROWS[:2] * 2)) == {'new': 1, 'duplicates': 3, 'rejected': 0}
+
+
+def test_constraint_violation_is_not_swallowed(app, sheet):
+    frame, _ = _prepare_import_frame(sheet(ROWS[:1]))
+    frame['fingerprint'] = 'f' * 32
+    frame['amount'] = -1
+    before = count_operations(app)
+    with pytest.raises(Exception, match="CHECK"):
+        _store_import_frame(app, frame)
+    assert count_operations(app) == before
@@ -0,0 +1,92 @@
+import time
+
+import pytest
+from sqlalchemy import text
+
+import fin_dash
+from fin_dash import claim_import_job, create_import_job, list_import_jobs, run_import_job
+
+ROWS = [
+    ('2031-06-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-06-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-06-02', 'расход', 300, 'Маркетинг', 'ВК'),
+    ('2031-06-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-06-03', 'расход', 700, 'Маркетинг', 'Авито'),
+]
+
+
+@pytest.fixture(autouse=True)
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv("IMPORT_JOBS_DIR", str(tmp_path / "jobs"))
+
+
+def june_operations(app):
+    with app.get_connection() as conn:
+        return conn.execute(text(
+            "SELECT COUNT(*) FROM financial_operations WHERE operation_date >= '2031-06-01'"
+        )).scalar()
+
+
+def job_row(app, job_id):
+    return list_import_jobs(app, [job_id]).iloc[0]
+
+
+def crash_after(chunks):
+    """on_progress, прерывающий импорт после заданного числа записанных порций"""
+    def on_progress(done, total, label, totals):
+        if label is not None and totals['new'] >= chunks * 2:
+            raise KeyboardInterrupt
+    return on_progress
+
+
+def test_failed_job_resumes_from_checkpoint(app, csv_file):
+    job_id = create_import_job(app, [('june.csv', csv_file(ROWS))], chunk_size=2)
+    assert claim_import_job(app) == job_id
+    with pytest.raises(KeyboardInterrupt):
+        run_import_job(app, job_id, workers=1, on_progress=crash_after(1))
+
+    job = job_row(app, job_id)
+    assert job.status == 'failed' and job.rows_done == 2
+    assert june_operations(app) == 2
+
+    assert claim_import_job(app, job_id) == job_id
+    totals = run_import_job(app, job_id, workers=1)
+    assert (totals['new'], totals['duplicates'], totals['sheets']) == (5, 0, 1)
+    assert june_operations(app) == 5
+    assert job_row(app, job_id).status == 'done'
+
+
+def test_stale_running_job_is_reclaimed(app, csv_file):
+    job_id = create_import_job(app, [('june.csv', csv_file(ROWS))], chunk_size=2)
+    claim_import_job(app)
+    with pytest.raises(KeyboardInterrupt):
+        run_import_job(app, job_id, workers=1, on_progress=crash_after(2))
+    # Процесс «убит»: задача осталась running, отметка жизни давно не обновлялась
+    with app.begin() as conn:
+        conn.execute(text(
+            "UPDATE import_jobs SET status = 'running', heartbeat_at = '2000-01-01 00:00:00' WHERE id = :id"
+        ), {"id": job_id})
+
+    assert claim_import_job(app) == job_id
+    assert claim_import_job(app) is None
+    assert run_import_job(app, job_id, workers=1)['new'] == 5
+    assert june_operations(app) == 5
+
+
+def test_heartbeat_is_renewed_while_parsing(app, csv_file, monkeypatch):
+    monkeypatch.setenv("IMPORT_JOB_STALE", "1")
+    job_id = create_import_job(app, [('june.csv', csv_file(ROWS))])
+    claim_import_job(app)
+    parse = fin_dash._iter_import_sheet
+    beats = []
+
+    def slow_parse(*args):
+        time.sleep(2.1)  # долгий разбор без записанных порций
+        job = job_row(app, job_id)
+        beats.append(job.heartbeat_at > job.started_at)
+        assert claim_import_job(app) is None
+        yield from parse(*args)
+
+    monkeypatch.setattr(fin_dash, "_iter_import_sheet", slow_parse)
+    run_import_job(app, job_id, workers=1)
+    assert beats == [True]
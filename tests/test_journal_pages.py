@@ -0,0 +1,65 @@
+import pytest
+
+ROWS = [('2031-01-15', 'доход', 100 + n, 'Урок', 'Информатика') for n in range(7)] + [
+    ('2031-01-14', 'расход', 50, 'Маркетинг', 'ВК'),
+    ('2031-01-16', 'расход', 60, 'Маркетинг', 'Авито'),
+]
+
+
+@pytest.fixture
+def journal(app, sheet):
+    """Журнал с серией операций одного дня, которая попадает на границы страниц"""
+    from fin_dash import import_excel_to_db
+    import_excel_to_db(app, sheet(ROWS))
+    return app
+
+
+def key(page, row):
+    return page['operation_date'].iloc[row], page['id'].iloc[row]
+
+
+def all_keys(app, **filters):
+    page, _ = app.get_journal_page(limit=10_000, **filters)
+    return list(zip(page['operation_date'], page['id']))
+
+
+@pytest.mark.parametrize("limit", [1, 3, 4, 7])
+def test_forward_pages_cover_journal_once(journal, limit):
+    expected = all_keys(journal)
+    assert expected == sorted(expected, reverse=True)
+    seen, after = [], None
+    while True:
+        page, has_more = journal.get_journal_page(limit=limit, after=after)
+        assert len(page) <= limit
+        seen += list(zip(page['operation_date'], page['id']))
+        if not has_more:
+            break
+        after = key(page, -1)
+    assert seen == expected
+
+
+def test_backward_pages_repeat_forward_pages(journal):
+    pages, after = [], None
+    while True:
+        page, has_more = journal.get_journal_page(limit=3, after=after)
+        pages.append(list(page['id']))
+        if not has_more:
+            break
+        after = key(page, -1)
+
+    before = key(page, 0)
+    for expected in reversed(pages[:-1]):
+        page, has_more = journal.get_journal_page(limit=3, before=before)
+        assert list(page['id']) == expected
+        before = key(page, 0)
+    assert not has_more
+
+
+def test_pages_respect_filters(journal):
+    filters = dict(start_date='2031-01-01', end_date='2031-01-31', operation_types=['доход'])
+    expected = all_keys(journal, **filters)
+    assert len(expected) == 7
+    first, has_more = journal.get_journal_page(limit=4, **filters)
+    second, last = journal.get_journal_page(limit=4, after=key(first, -1), **filters)
+    assert has_more and not last
+    assert list(zip(first['operation_date'], first['id'])) + list(zip(second['operation_date'], second['id'])) == expected
@@ -0,0 +1,56 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy import inspect as inspect_db
+
+from fin_dash import MIGRATIONS, FinanceApp, migrate, migration_status
+
+VERSIONS = [(version, name) for version, name, _ in MIGRATIONS]
+
+
+@pytest.fixture
+def engine(db_url):
+    engine = create_engine(db_url)
+    yield engine
+    engine.dispose()
+
+
+def operations_snapshot(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT id, operation_date, amount FROM financial_operations ORDER BY id")).all()
+
+
+def test_legacy_database_is_migrated(engine):
+    before = operations_snapshot(engine)
+    assert migration_status(engine)['applied_at'].isna().all()
+
+    assert migrate(engine) == VERSIONS
+    assert migration_status(engine)['applied_at'].notna().all()
+    assert operations_snapshot(engine) == before
+
+    inspector = inspect_db(engine)
+    assert {'operations_daily_rollup', 'dimension_tree', 'import_jobs'} <= set(inspector.get_table_names())
+    indexes = {index['name'] for index in inspector.get_indexes('financial_operations')}
+    assert {'ix_operations_date_id', 'ix_operations_type_date', 'ux_operations_fingerprint',
+            'ix_operations_updated_at'} <= indexes
+
+
+def test_migrations_are_applied_once(engine):
+    migrate(engine)
+    assert migrate(engine) == []
+
+
+def test_migrations_resume_from_partial_schema(engine):
+    assert migrate(engine, target=3) == VERSIONS[:3]
+    assert migrate(engine) == VERSIONS[3:]
+
+
+def test_migrated_data_is_consistent(engine, db_url):
+    migrate(engine)
+    with engine.connect() as conn:
+        fingerprints = conn.execute(text("SELECT fingerprint FROM financial_operations")).scalars().all()
+        tree_nodes = conn.execute(text("SELECT COUNT(*) FROM dimension_tree")).scalar()
+    assert None not in fingerprints and len(set(fingerprints)) == len(fingerprints)
+    assert tree_nodes > 0
+
+    app = FinanceApp(db_url)
+    assert app.check_daily_rollup().empty
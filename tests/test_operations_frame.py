@@ -0,0 +1,58 @@
+import pandas as pd
+import pytest
+
+from fin_dash import import_excel_to_db, load_journal_summary
+
+ROWS = [
+    ('2031-03-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-03-02', 'доход', 99.99, 'Урок', None),
+    ('2031-03-02', 'расход', 250.5, 'Маркетинг', 'ВК'),
+    ('2031-03-10', 'расход', 40, 'Маркетинг', 'Авито'),
+]
+PERIOD = ('2031-03-01', '2031-03-31')
+
+
+@pytest.fixture
+def filled(app, sheet):
+    import_excel_to_db(app, sheet(ROWS))
+    return app
+
+
+def test_compact_dtypes_and_signed_kopecks(filled):
+    frame = filled.get_operations_frame(*PERIOD)
+    assert list(frame['amount_kop']) == [100000, 9999, -25050, -4000]
+    assert frame['amount_kop'].dtype == 'int64'
+    assert frame['operation_date'].dtype == 'datetime64[ns]'
+    for column in ('operation_type', 'category', 'subcategory', 'group_name', 'subgroup', 'lesson_type'):
+        assert isinstance(frame[column].dtype, pd.CategoricalDtype)
+    assert list(frame['category']) == ['Урок', 'Урок', 'Маркетинг', 'Маркетинг']
+    assert frame['subcategory'].isna().tolist() == [False, True, False, False]
+    assert 'comment' not in frame
+
+
+def journal_rows(app, **filters):
+    df, _ = app.get_journal_page(*PERIOD, limit=1000, **filters)
+    return df['amount'].astype(float), df['operation_type'].astype(str)
+
+
+@pytest.mark.parametrize("filters", [
+    {},
+    {'operation_types': ['расход']},
+    {'categories': ['Урок']},
+    {'operation_types': ['доход'], 'categories': ['Маркетинг']},
+    {'min_amount': 50.0, 'max_amount': 250.5},
+])
+def test_summary_matches_journal(filled, filters):
+    summary = load_journal_summary(filled, *PERIOD, **filters)
+    amount, kind = journal_rows(filled, **filters)
+    assert summary['operations_count'] == len(amount)
+    assert summary['total_income'] == pytest.approx(amount[kind == 'доход'].sum())
+    assert summary['total_expense'] == pytest.approx(amount[kind == 'расход'].sum())
+    assert summary['balance'] == pytest.approx(summary['total_income'] - summary['total_expense'])
+    assert summary['by_category']['operations_count'].sum() == len(amount)
+
+
+def test_summary_by_category(filled):
+    by_category = load_journal_summary(filled, *PERIOD)['by_category']
+    assert by_category['category'].astype(str).tolist() == ['Урок', 'Маркетинг']
+    assert by_category['total'].tolist() == pytest.approx([1099.99, -290.5])
@@ -0,0 +1,68 @@
+import datetime
+
+import pandas as pd
+import pytest
+from sqlalchemy import bindparam
+
+from fin_dash import import_excel_to_db
+
+pytest.importorskip("pyarrow")
+
+ROWS = [
+    ('2031-02-03', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-02-04', 'расход', 250.5, 'Маркетинг', 'ВК'),
+]
+PERIOD = ('2031-02-01', '2031-02-28')
+
+
+@pytest.fixture
+def filled(app, sheet):
+    import_excel_to_db(app, sheet(ROWS))
+    return app
+
+
+def test_operations_are_arrow_backed(filled):
+    assert filled.arrow_fetch
+    df = filled.get_operations(*PERIOD)
+    assert len(df) == 2
+    assert all(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes)
+    assert str(df['id'].dtype) == 'int64[pyarrow]'
+    assert str(df['operation_date'].dtype) == 'date32[day][pyarrow]'
+    assert str(df['amount'].dtype) == 'double[pyarrow]'
+    assert str(df['category'].dtype) == 'string[pyarrow]'
+    assert str(df['created_at'].dtype) == 'timestamp[us][pyarrow]'
+    assert df['operation_date'].tolist() == [datetime.date(2031, 2, 4), datetime.date(2031, 2, 3)]
+    assert df['amount'].tolist() == [250.5, 1000.0]
+
+
+def test_empty_result_keeps_types(filled):
+    df = filled.get_operations('2031-05-01', '2031-05-31')
+    assert df.empty
+    assert str(df['operation_date'].dtype) == 'date32[day][pyarrow]'
+    assert str(df['amount'].dtype) == 'double[pyarrow]'
+
+
+def test_expanding_params(filled):
+    df = filled._read_sql(
+        "SELECT id_categories, name FROM categories WHERE name IN :names ORDER BY name",
+        {'names': ['Урок', 'Маркетинг']},
+        [bindparam('names', expanding=True)],
+    )
+    assert df['name'].tolist() == ['Маркетинг', 'Урок']
+    assert str(df['name'].dtype) == 'string[pyarrow]'
+
+
+def test_totals_are_float(filled):
+    df = filled.get_breakdown('расход', *PERIOD)
+    assert df['total'].dtype == 'float64'
+    assert df['total'].tolist() == [250.5]
+    assert str(df['category'].dtype) == 'string[pyarrow]'
+    assert df['group_name'].isna().all()
+
+
+def test_pandas_fallback(filled):
+    filled.arrow_fetch = False
+    df = filled.get_operations(*PERIOD)
+    assert not any(isinstance(dtype, pd.ArrowDtype) for dtype in df.dtypes)
+    assert df['amount'].dtype == 'float64'
+    assert df['category'].dtype == object
@@ -0,0 +1,66 @@
+from sqlalchemy import text
+
+from fin_dash import _reserve_operation_ids
+
+
+def max_id(conn):
+    return conn.execute(text("SELECT MAX(id) FROM financial_operations")).scalar()
+
+
+def insert_operation(conn, id_=None):
+    columns, values = ("id, ", ":id, ") if id_ is not None else ("", "")
+    return conn.execute(text(
+        f"INSERT INTO financial_operations ({columns}operation_date, operation_type_id, amount, category_id) "
+        f"VALUES ({values}'2031-04-01', 1, 10, 3) RETURNING id"
+    ), {"id": id_}).scalar()
+
+
+def test_reserved_ranges_are_contiguous_and_disjoint(app):
+    with app.begin() as conn:
+        seq = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'financial_operations'")).scalar()
+        first = _reserve_operation_ids(conn, 3)
+        second = _reserve_operation_ids(conn, 2)
+    assert first == [seq + 1, seq + 2, seq + 3]
+    assert second == [seq + 4, seq + 5]
+    # AUTOINCREMENT продолжает после зарезервированных id
+    with app.begin() as conn:
+        assert insert_operation(conn) == seq + 6
+
+
+def test_reserve_skips_ids_above_sequence(app):
+    with app.begin() as conn:
+        top = insert_operation(conn, id_=max_id(conn) + 100)
+        conn.execute(text("UPDATE sqlite_sequence SET seq = 1 WHERE name = 'financial_operations'"))
+        assert _reserve_operation_ids(conn, 2) == [top + 1, top + 2]
+
+
+def test_reserve_without_sequence_row(app):
+    with app.begin() as conn:
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'financial_operations'"))
+        top = max_id(conn)
+        assert _reserve_operation_ids(conn, 4) == [top + 1, top + 2, top + 3, top + 4]
+        assert _reserve_operation_ids(conn, 1) == [top + 5]
+
+
+def test_rolled_back_reservation_is_released(app):
+    with app.begin() as conn:
+        expected = _reserve_operation_ids(conn, 1)
+    try:
+        with app.begin() as conn:
+            _reserve_operation_ids(conn, 5)
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    with app.begin() as conn:
+        assert _reserve_operation_ids(conn, 1) == [expected[0] + 1]
+
+
+def test_add_operations_returns_reserved_ids(app):
+    operations = [('2031-04-02', 1, 100 + n, 3, 2) for n in range(3)]
+    result = app.add_operations(operations)
+    with app.get_connection() as conn:
+        stored = conn.execute(text(
+            "SELECT id, amount FROM financial_operations WHERE operation_date = '2031-04-02' ORDER BY id"
+        )).all()
+    assert [row.id for row in stored] == result['id'].tolist()
+    assert [float(row.amount) for row in stored] == [100, 101, 102]
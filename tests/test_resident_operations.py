@@ -0,0 +1,80 @@
+import threading
+
+import pytest
+from sqlalchemy import text
+
+from fin_dash import import_excel_to_db
+
+ROWS = [
+    ('2031-05-01', 'доход', 1000, 'Урок', 'Информатика'),
+    ('2031-05-02', 'расход', 300, 'Маркетинг', 'ВК'),
+    ('2031-05-20', 'доход', 500, 'Урок', 'Информатика'),
+]
+PERIOD = ('2031-05-01', '2031-05-31')
+
+
+@pytest.fixture
+def resident(app, sheet):
+    import_excel_to_db(app, sheet(ROWS))
+    app.get_operations_frame(*PERIOD)
+    return app
+
+
+def counters(app):
+    stats = app.resident.stats()
+    return stats['full_loads'], stats['delta_syncs'], stats['unchanged']
+
+
+def test_rerun_without_changes_reuses_window(resident):
+    frame = resident.get_operations_frame(*PERIOD)
+    assert list(frame['amount_kop']) == [100000, -30000, 50000]
+    assert counters(resident) == (1, 0, 1)
+
+
+def test_subperiod_is_cut_from_window(resident):
+    frame = resident.get_operations_frame('2031-05-02', '2031-05-10')
+    assert list(frame['amount_kop']) == [-30000]
+    assert counters(resident) == (1, 0, 1)
+
+
+def test_new_rows_are_merged_by_delta(resident, sheet):
+    import_excel_to_db(resident, sheet([
+        ('2031-05-15', 'расход', 40, 'Маркетинг', 'Авито'),
+        ('2031-07-01', 'доход', 70, 'Урок', 'Информатика'),
+    ]))
+    frame = resident.get_operations_frame(*PERIOD)
+    assert list(frame['amount_kop']) == [100000, -30000, -4000, 50000]
+    assert counters(resident) == (1, 1, 0)
+
+
+def test_deleted_rows_are_dropped(resident):
+    with resident.begin() as conn:
+        conn.execute(text("DELETE FROM financial_operations WHERE operation_date = '2031-05-02'"))
+    frame = resident.get_operations_frame(*PERIOD)
+    assert list(frame['amount_kop']) == [100000, 50000]
+    assert counters(resident) == (1, 1, 0)
+
+
+def test_backdated_change_reloads_window(resident):
+    with resident.begin() as conn:
+        conn.execute(text(
+            "INSERT INTO financial_operations (operation_date, operation_type_id, category_id, amount, updated_at) "
+            "SELECT '2031-05-03', operation_type_id, category_id, 1, '2000-01-01 00:00:00' "
+            "FROM financial_operations WHERE operation_date = '2031-05-01'"
+        ))
+    frame = resident.get_operations_frame(*PERIOD)
+    assert list(frame['amount_kop']) == [100000, -30000, 100, 50000]
+    assert counters(resident) == (2, 0, 0)
+
+
+def test_concurrent_sessions_load_window_once(app, sheet):
+    import_excel_to_db(app, sheet(ROWS))
+    frames = []
+    threads = [threading.Thread(target=lambda: frames.append(app.get_operations_frame(*PERIOD)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert [len(frame) for frame in frames] == [3] * 4
+    assert counters(app) == (1, 0, 3)
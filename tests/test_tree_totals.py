@@ -0,0 +1,82 @@
+import pandas as pd
+import pytest
+from sqlalchemy import text
+
+from fin_dash import TREE_LEVELS, import_excel_to_db
+
+
+@pytest.fixture
+def tree(app, sheet):
+    """Исходные операции плюс строки с типами занятий и полной глубиной дерева"""
+    rows = sheet([
+        ('2031-02-01', 'доход', 900, 'Урок', 'Информатика'),
+        ('2031-02-02', 'доход', 450, 'Урок', 'Информатика'),
+        ('2031-02-02', 'расход', 120, 'Маркетинг', 'ВК'),
+    ])
+    rows['Группа'] = ['ААИ1', 'ААИ1', 'Группа']
+    rows['Подгруппа'] = ['Пн', None, None]
+    rows['Тип занятия'] = ['инд', 'груп', None]
+    import_excel_to_db(app, rows)
+    return app
+
+
+def expected_totals(app, start_date=None, end_date=None):
+    """Итоги всех уровней дерева группировками pandas по самим операциям"""
+    with app.get_connection() as conn:
+        ops = pd.read_sql(text(
+            f"SELECT operation_date, operation_type_id, lesson_type_id, {', '.join(TREE_LEVELS)}, amount "
+            f"FROM financial_operations"
+        ), conn)
+    if start_date:
+        ops = ops[ops['operation_date'].between(start_date, end_date)]
+    ops = ops.fillna({col: 0 for col in ['lesson_type_id'] + TREE_LEVELS})
+    rows = set()
+    for by_lesson in (True, False):
+        for level in range(len(TREE_LEVELS) + 1):
+            keys = ['operation_type_id'] + (['lesson_type_id'] if by_lesson else []) + TREE_LEVELS[:level]
+            grouped = ops.groupby(keys)['amount'].agg(['sum', 'size']).reset_index()
+            for row in grouped.to_dict('records'):
+                ids = [int(row[col]) for col in TREE_LEVELS[:level]] + [None] * (len(TREE_LEVELS) - level)
+                lesson = int(row['lesson_type_id']) if by_lesson else None
+                rows.add((int(row['operation_type_id']), level, lesson, *ids, round(row['sum'], 2), row['size']))
+    return rows
+
+
+def actual_totals(app, start_date=None, end_date=None):
+    types = app.get_operation_types().set_index('name_operation')['id_operation']
+    totals = app.get_tree_totals(start_date, end_date)
+    rows = set()
+    for row in totals.to_dict('records'):
+        ids = [None if pd.isna(row[col]) else int(row[col]) for col in ['lesson_type_id'] + TREE_LEVELS]
+        rows.add((int(types[row['operation_type']]), row['level'], *ids,
+                  round(float(row['total']), 2), row['operations_count']))
+    return rows
+
+
+@pytest.mark.parametrize("period", [(None, None), ('2025-03-01', '2025-06-30'), ('2031-02-02', '2031-02-02')])
+def test_sqlite_rollup_matches_grouping_sets(tree, period):
+    assert actual_totals(tree, *period) == expected_totals(tree, *period)
+
+
+def test_tree_nodes_have_names(tree):
+    totals = tree.get_tree_totals()
+    nodes = totals[totals['level'] > 0]
+    assert nodes['category'].notna().all()
+    assert nodes.loc[nodes['level'] == 4, 'path'].notna().all()
+
+
+def test_tree_rebuilds_after_out_of_band_dimension(tree):
+    tree.get_tree_totals()
+    with tree.begin() as conn:
+        category = conn.execute(text(
+            "INSERT INTO categories (operation_type_id, name) VALUES (2, 'Аренда') RETURNING id_categories"
+        )).scalar()
+        conn.execute(text(
+            "INSERT INTO financial_operations (operation_date, operation_type_id, amount, category_id) "
+            "VALUES ('2031-03-01', 2, 5000, :category)"
+        ), {"category": category})
+    tree.rebuild_daily_rollup()
+
+    totals = tree.get_tree_totals()
+    node = totals[(totals['category_id'] == category) & (totals['level'] == 1) & totals['lesson_type_id'].isna()]
+    assert node['category'].tolist() == ['Аренда']